@@ -1,20 +1,53 @@
 import os
 import base64
 import json
+import itertools
+import collections
+import logging
 import time
 from io import BytesIO
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory, flash, Response
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory, flash, Response, stream_with_context, g
 import requests
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageOps
 from google import genai
 from google.genai import types
-from pydantic import BaseModel, Field
 from typing import List, Optional
+from client_pool import ClientPool, hash_api_key
+from response_cache import ResponseCache, MemoryBackend, SQLiteBackend, make_cache_key, normalize_prompt
+from near_duplicates import NearDuplicateCache
+from jobs import JobStore, JobQueueFull
+from hedging import HedgePolicy, LatencyTracker, run_hedged
+from concurrent.futures import ThreadPoolExecutor
+from image_preprocessing import PreparedImage, PreprocessStats, prepare_image, passthrough_image
+from ingest import UploadStore
+from batch import BatchRunner, iter_archive_images
+from json_stream import JsonArrayStreamParser
+from streams import StreamRegistry
+from chat_sessions import ChatSessionStore, ChatSessionBusy, estimate_image_tokens
+from image_files import ImageFileStore
+from scheduler import CallScheduler, call_priority
+from singleflight import SingleFlight, flight_key
+from results import ResultWriter
+from rendering import FontCache, draw_boxes, draw_outlined_text, draw_centered_text
+from frames import FrameSampler, iter_frames, encode_frame
+from perceptual import phash
+from tiling import open_large_image, plan_tiles, encode_tile, merge_detections, preview_image
+from schemas import Cat, BoundingBox, SegmentMask, json_config, schema_key, parse_items, validate_item
+from fake_gemini import FakeGeminiBackend, FakeGeminiClient, load_recordings
+from instrumentation import metrics, stage, start_request, route_context, configure_logging, REQUEST_SECONDS
+from compositing import (MaskStack, rgb_array, decode_mask, segment_color, segment_colors, composite_masks,
+                         composite_crop, encode_rle)
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
+# Logging, DEBUG also logs the raw model responses
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'text')  # 'text' or 'json', one object per line
+configure_logging(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'])
+logger = logging.getLogger(__name__)
+
 # Session key for API key
 API_KEY_SESSION_KEY = 'gemini_api_key'
 
@@ -24,33 +57,473 @@ RESULTS_FOLDER = os.path.join('static', 'results')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['RESULTS_FOLDER'] = RESULTS_FOLDER
 
+# Result images are encoded in worker processes and written in the background
+# Format: 'PNG', 'WEBP', 'JPEG' or 'AVIF' (needs pillow-avif-plugin, WebP otherwise)
+app.config['RESULT_FORMAT'] = os.environ.get('RESULT_FORMAT', 'PNG')
+app.config['RESULT_QUALITY'] = int(os.environ.get('RESULT_QUALITY', 85))  # lossy formats only
+app.config['RESULT_PNG_COMPRESS_LEVEL'] = int(os.environ.get('RESULT_PNG_COMPRESS_LEVEL', 1))  # 0-9, 9 is smallest and slowest
+app.config['RESULT_WRITER_PROCESSES'] = int(os.environ.get('RESULT_WRITER_PROCESSES', 2))  # 0 encodes on threads
+# Created before anything starts a thread, the worker processes are forked from here
+result_writer = ResultWriter(RESULTS_FOLDER, os.path.join('static', 'results'),
+                             image_format=app.config['RESULT_FORMAT'],
+                             quality=app.config['RESULT_QUALITY'],
+                             png_compress_level=app.config['RESULT_PNG_COMPRESS_LEVEL'],
+                             processes=app.config['RESULT_WRITER_PROCESSES'])
+
+# Fonts for labels and placeholder text, resolved once and shared by every request
+app.config['FONT_PATH'] = os.environ.get('FONT_PATH')  # a .ttf file, or the first of rendering.FONT_CANDIDATES found
+font_cache = FontCache(app.config['FONT_PATH'])
+
+# Scheduler in front of every model call: rate limits per API key and model, priorities and retries
+app.config['SCHEDULER_REQUESTS_PER_MINUTE'] = int(os.environ.get('SCHEDULER_REQUESTS_PER_MINUTE', 0))  # 0 learns the limit from 429s
+# Per-model overrides, e.g. "gemini-2.0-flash=2000,gemini-2.5-pro-exp-03-25=5"
+app.config['SCHEDULER_MODEL_LIMITS'] = {
+    model.strip(): int(limit)
+    for model, limit in (
+        item.split('=', 1) for item in os.environ.get('SCHEDULER_MODEL_LIMITS', '').split(',') if '=' in item
+    )
+}
+app.config['SCHEDULER_MAX_RETRIES'] = int(os.environ.get('SCHEDULER_MAX_RETRIES', 4))
+app.config['SCHEDULER_MAX_WAIT'] = float(os.environ.get('SCHEDULER_MAX_WAIT', 120))
+call_scheduler = CallScheduler(requests_per_minute=app.config['SCHEDULER_REQUESTS_PER_MINUTE'],
+                               overrides=app.config['SCHEDULER_MODEL_LIMITS'],
+                               max_retries=app.config['SCHEDULER_MAX_RETRIES'],
+                               max_wait=app.config['SCHEDULER_MAX_WAIT'])
+
+# Gemini backend, 'fake' answers from recorded responses without calling the API (for offline load tests)
+app.config['GEMINI_BACKEND'] = os.environ.get('GEMINI_BACKEND', 'live')
+app.config['FAKE_GEMINI_RECORDINGS'] = os.environ.get('FAKE_GEMINI_RECORDINGS')  # JSON file, see fake_gemini.py
+app.config['FAKE_GEMINI_LATENCY'] = float(os.environ.get('FAKE_GEMINI_LATENCY', 0.5))
+app.config['FAKE_GEMINI_JITTER'] = float(os.environ.get('FAKE_GEMINI_JITTER', 0.2))
+app.config['FAKE_GEMINI_ERROR_RATE'] = float(os.environ.get('FAKE_GEMINI_ERROR_RATE', 0))
+fake_gemini = None
+if app.config['GEMINI_BACKEND'] == 'fake':
+    fake_gemini = FakeGeminiBackend(load_recordings(app.config['FAKE_GEMINI_RECORDINGS']),
+                                    latency=app.config['FAKE_GEMINI_LATENCY'],
+                                    jitter=app.config['FAKE_GEMINI_JITTER'],
+                                    error_rate=app.config['FAKE_GEMINI_ERROR_RATE'])
+
+# Helper function to create the Gemini client for an API key, every model call goes through the scheduler
+def create_gemini_client(api_key):
+    if fake_gemini is not None:
+        client = FakeGeminiClient(fake_gemini)
+    else:
+        client = genai.Client(api_key=api_key)
+    return call_scheduler.wrap(client, hash_api_key(api_key))
+
+# Reusable Gemini clients, one per API key, shared across requests
+app.config['CLIENT_POOL_MAX_CLIENTS'] = int(os.environ.get('CLIENT_POOL_MAX_CLIENTS', 32))
+app.config['CLIENT_POOL_IDLE_SECONDS'] = int(os.environ.get('CLIENT_POOL_IDLE_SECONDS', 900))
+client_pool = ClientPool(max_clients=app.config['CLIENT_POOL_MAX_CLIENTS'],
+                         idle_timeout=app.config['CLIENT_POOL_IDLE_SECONDS'],
+                         factory=create_gemini_client)
+
+# Content-addressed cache for image QA, bounding box and segmentation responses
+app.config['RESPONSE_CACHE_MAX_BYTES'] = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['RESPONSE_CACHE_DB'] = os.environ.get('RESPONSE_CACHE_DB', os.path.join('cache', 'responses.sqlite3'))
+app.config['RESPONSE_CACHE_DB_MAX_ENTRIES'] = int(os.environ.get('RESPONSE_CACHE_DB_MAX_ENTRIES', 100000))
+app.config['RESPONSE_CACHE_DB_MAX_BYTES'] = int(os.environ.get('RESPONSE_CACHE_DB_MAX_BYTES', 1024 * 1024 * 1024))
+app.config['RESPONSE_CACHE_TTLS'] = {
+    'image_qa': int(os.environ.get('RESPONSE_CACHE_TTL_IMAGE_QA', 24 * 3600)),
+    'bounding_boxes': int(os.environ.get('RESPONSE_CACHE_TTL_BOUNDING_BOXES', 24 * 3600)),
+    'image_segmentation': int(os.environ.get('RESPONSE_CACHE_TTL_IMAGE_SEGMENTATION', 24 * 3600)),
+}
+# Comma separated list of routes that should always call the model
+app.config['RESPONSE_CACHE_DISABLED_ROUTES'] = set(
+    route.strip() for route in os.environ.get('RESPONSE_CACHE_DISABLED_ROUTES', '').split(',') if route.strip()
+)
+response_cache = ResponseCache(
+    memory=MemoryBackend(max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES']),
+    disk=SQLiteBackend(app.config['RESPONSE_CACHE_DB'],
+                       max_entries=app.config['RESPONSE_CACHE_DB_MAX_ENTRIES'],
+                       max_bytes=app.config['RESPONSE_CACHE_DB_MAX_BYTES']) if app.config['RESPONSE_CACHE_DB'] else None,
+)
+
+# Answers for images that look the same as an earlier one (recompressed, resized, new EXIF) under the same prompt
+app.config['NEAR_DUPLICATE_ENABLED'] = os.environ.get('NEAR_DUPLICATE_ENABLED', '1') != '0'
+app.config['NEAR_DUPLICATE_MAX_DISTANCE'] = int(os.environ.get('NEAR_DUPLICATE_MAX_DISTANCE', 4))  # bits of 64
+app.config['NEAR_DUPLICATE_MAX_ENTRIES'] = int(os.environ.get('NEAR_DUPLICATE_MAX_ENTRIES', 1_000_000))
+near_duplicate_cache = NearDuplicateCache(response_cache, max_distance=app.config['NEAR_DUPLICATE_MAX_DISTANCE'],
+                                          max_entries=app.config['NEAR_DUPLICATE_MAX_ENTRIES'])
+
+# Identical requests in flight at the same time share one model call
+# Routes listed here always make their own call; by default the image generating ones,
+# so every request gets its own sample
+app.config['SINGLE_FLIGHT_DISABLED_ROUTES'] = set(
+    route.strip()
+    for route in os.environ.get('SINGLE_FLIGHT_DISABLED_ROUTES', 'image_generation,image_editing').split(',')
+    if route.strip()
+)
+single_flight = SingleFlight()
+
+# Background jobs for image generation and editing
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 4))
+app.config['JOB_MAX_QUEUED'] = int(os.environ.get('JOB_MAX_QUEUED', 64))
+app.config['JOB_RESULT_TTL'] = int(os.environ.get('JOB_RESULT_TTL', 600))
+job_store = JobStore(workers=app.config['JOB_WORKERS'],
+                     max_queued=app.config['JOB_MAX_QUEUED'],
+                     result_ttl=app.config['JOB_RESULT_TTL'])
+
+# Hedging policy for the image generation and editing fallback chains
+app.config['HEDGE_MODE'] = os.environ.get('HEDGE_MODE', 'hedge')  # 'hedge', 'parallel' or 'serial'
+app.config['HEDGE_DELAY'] = os.environ.get('HEDGE_DELAY', 'auto')  # seconds, or 'auto' to tune from latency percentiles
+app.config['HEDGE_PERCENTILE'] = float(os.environ.get('HEDGE_PERCENTILE', 90))
+app.config['HEDGE_WORKERS'] = int(os.environ.get('HEDGE_WORKERS', 16))
+hedge_policy = HedgePolicy(mode=app.config['HEDGE_MODE'],
+                           delay=app.config['HEDGE_DELAY'],
+                           percentile=app.config['HEDGE_PERCENTILE'])
+model_latency = LatencyTracker()
+hedge_executor = ThreadPoolExecutor(max_workers=app.config['HEDGE_WORKERS'], thread_name_prefix='hedge')
+
+# Downscaling and re-encoding of uploads before they are sent to the model
+app.config['PREPROCESS_ENABLED'] = os.environ.get('PREPROCESS_ENABLED', '1') != '0'
+app.config['PREPROCESS_MAX_EDGE'] = int(os.environ.get('PREPROCESS_MAX_EDGE', 1536))
+app.config['PREPROCESS_FORMAT'] = os.environ.get('PREPROCESS_FORMAT', 'JPEG').upper()  # JPEG, WEBP or PNG
+app.config['PREPROCESS_QUALITY'] = int(os.environ.get('PREPROCESS_QUALITY', 85))
+preprocess_stats = PreprocessStats()
+
+# Batch bounding box detection
+app.config['BATCH_CONCURRENCY'] = int(os.environ.get('BATCH_CONCURRENCY', 8))
+app.config['BATCH_RENDER_WORKERS'] = int(os.environ.get('BATCH_RENDER_WORKERS', 4))
+app.config['BATCH_MAX_CALLS_PER_SECOND'] = float(os.environ.get('BATCH_MAX_CALLS_PER_SECOND', 0))  # 0 means unlimited
+app.config['BATCH_MAX_IMAGES'] = int(os.environ.get('BATCH_MAX_IMAGES', 200))
+batch_runner = BatchRunner(concurrency=app.config['BATCH_CONCURRENCY'],
+                           render_workers=app.config['BATCH_RENDER_WORKERS'],
+                           max_calls_per_second=app.config['BATCH_MAX_CALLS_PER_SECOND'])
+
+# Tiled detection of very large images, the tiles' model calls go through the batch runner
+app.config['TILED_TILE_SIZE'] = int(os.environ.get('TILED_TILE_SIZE', 1024))  # pixels, per side
+app.config['TILED_MAX_TILE_SIZE'] = int(os.environ.get('TILED_MAX_TILE_SIZE', 4096))  # largest tile_size a request may ask for
+app.config['TILED_OVERLAP'] = int(os.environ.get('TILED_OVERLAP', 128))  # pixels shared by neighbouring tiles
+app.config['TILED_NMS_THRESHOLD'] = float(os.environ.get('TILED_NMS_THRESHOLD', 0.5))
+app.config['TILED_MAX_TILES'] = int(os.environ.get('TILED_MAX_TILES', 2048))
+app.config['TILED_PREVIEW_MAX_EDGE'] = int(os.environ.get('TILED_PREVIEW_MAX_EDGE', 4096))  # of the rendered overlay
+# Largest image tiled detection decodes; every other route keeps Pillow's own decompression bomb limit
+app.config['TILED_MAX_IMAGE_PIXELS'] = int(os.environ.get('TILED_MAX_IMAGE_PIXELS', 1_000_000_000))
+
+# Frame sequences (videos, animated images, archives of frames), near-duplicate frames skip the model
+app.config['FRAMES_HASH_THRESHOLD'] = int(os.environ.get('FRAMES_HASH_THRESHOLD', 6))  # bits of a 64-bit phash
+app.config['FRAMES_MAX_GAP'] = int(os.environ.get('FRAMES_MAX_GAP', 0))  # keep at least every Nth frame, 0 = off
+app.config['FRAMES_MAX_FRAMES'] = int(os.environ.get('FRAMES_MAX_FRAMES', 20000))  # decoded per request
+frame_sampler = FrameSampler(threshold=app.config['FRAMES_HASH_THRESHOLD'], max_gap=app.config['FRAMES_MAX_GAP'])
+
+# Token streaming for the text streaming demo
+app.config['STREAM_WORKERS'] = int(os.environ.get('STREAM_WORKERS', 16))
+app.config['STREAM_BUFFER_EVENTS'] = int(os.environ.get('STREAM_BUFFER_EVENTS', 512))
+app.config['STREAM_RESUME_SECONDS'] = int(os.environ.get('STREAM_RESUME_SECONDS', 10))
+app.config['STREAM_HEARTBEAT_SECONDS'] = int(os.environ.get('STREAM_HEARTBEAT_SECONDS', 15))
+text_streams = StreamRegistry(workers=app.config['STREAM_WORKERS'],
+                              buffer_size=app.config['STREAM_BUFFER_EVENTS'],
+                              resume_seconds=app.config['STREAM_RESUME_SECONDS'])
+
+# Server-side chat sessions
+app.config['CHAT_MODEL'] = os.environ.get('CHAT_MODEL', 'gemini-2.0-flash-001')  # context caching needs a pinned model version
+app.config['CHAT_MAX_SESSIONS'] = int(os.environ.get('CHAT_MAX_SESSIONS', 256))
+app.config['CHAT_IDLE_SECONDS'] = int(os.environ.get('CHAT_IDLE_SECONDS', 1800))
+app.config['CHAT_HISTORY_TOKENS'] = int(os.environ.get('CHAT_HISTORY_TOKENS', 8000))
+app.config['CHAT_CACHE_MIN_TOKENS'] = int(os.environ.get('CHAT_CACHE_MIN_TOKENS', 4096))
+app.config['CHAT_SUMMARIZE'] = os.environ.get('CHAT_SUMMARIZE', '1') != '0'  # 0 drops old turns instead of summarizing them
+chat_sessions = ChatSessionStore(model=app.config['CHAT_MODEL'],
+                                 max_sessions=app.config['CHAT_MAX_SESSIONS'],
+                                 idle_timeout=app.config['CHAT_IDLE_SECONDS'],
+                                 history_tokens=app.config['CHAT_HISTORY_TOKENS'],
+                                 cache_min_tokens=app.config['CHAT_CACHE_MIN_TOKENS'],
+                                 summarize=app.config['CHAT_SUMMARIZE'])
+
+# Images uploaded once through the Files API and asked about by handle
+app.config['IMAGE_FILES_MAX'] = int(os.environ.get('IMAGE_FILES_MAX', 1024))
+app.config['IMAGE_QA_MAX_QUESTIONS'] = int(os.environ.get('IMAGE_QA_MAX_QUESTIONS', 20))
+image_files = ImageFileStore(max_files=app.config['IMAGE_FILES_MAX'])
+
 # Helper function to configure Gemini client with the session API key
 def configure_gemini_client():
     api_key = session.get(API_KEY_SESSION_KEY)
     if api_key:
-        # Create a new client with the API key
-        client = genai.Client(api_key=api_key)
-        return client
+        # Reuse the pooled client (and its keep-alive connections) for this key
+        return client_pool.get(api_key)
     return None
 
 # Ensure directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULTS_FOLDER, exist_ok=True)
 
-# Define Pydantic model for structured output
-class Cat(BaseModel):
-    name: str = Field(..., description="The cat's name")
-    color: str = Field(..., description="The cat's fur color")
-    special_ability: str = Field(..., description="The cat's unique special ability")
+# Uploads are read once into memory and written to disk in the background
+# under a content-addressed name, so concurrent users never overwrite each other.
+# Uploads larger than UPLOAD_SPOOL_MAX_SIZE are spooled straight to disk instead
+app.config['UPLOAD_SPOOL_MAX_SIZE'] = int(os.environ.get('UPLOAD_SPOOL_MAX_SIZE', 16 * 1024 * 1024))
+upload_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix='upload-writer')
+upload_store = UploadStore(UPLOAD_FOLDER, upload_writer, spool_max_size=app.config['UPLOAD_SPOOL_MAX_SIZE'])
 
-# Helper function to save uploaded file
-def save_uploaded_file(file):
+# Helper function to read an uploaded file
+def ingest_uploaded_file(file):
     if file:
-        filename = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(filename)
-        return filename
+        return upload_store.ingest(file)
     return None
 
+# Helper function to shrink an upload before sending it to the model
+def prepare_upload(image_data, mime_type, requested=None):
+    # Callers can send preprocess=0 to send the original bytes
+    if requested is None:
+        requested = request.form.get('preprocess', '1').lower() not in ('0', 'false', 'no', 'off')
+    try:
+        with stage('preprocess'):
+            if app.config['PREPROCESS_ENABLED'] and requested:
+                prepared = prepare_image(image_data, mime_type,
+                                         max_edge=app.config['PREPROCESS_MAX_EDGE'],
+                                         output_format=app.config['PREPROCESS_FORMAT'],
+                                         quality=app.config['PREPROCESS_QUALITY'])
+            else:
+                prepared = passthrough_image(image_data, mime_type)
+    except Exception as e:
+        # PIL can't read it, let the model have a go at the original bytes
+        logger.warning("Could not preprocess image, sending it unchanged: %s", e)
+        prepared = PreparedImage(image_data, mime_type, None, None, len(image_data), 0.0)
+
+    preprocess_stats.record(prepared)
+    return prepared
+
+# Helper function to decide whether the current request may use the response cache
+def response_cache_enabled(route):
+    # Callers can opt out per request, operators per route
+    no_cache = request.form.get('no_cache', '').lower() in ('1', 'true', 'yes', 'on')
+    return not no_cache and route not in app.config['RESPONSE_CACHE_DISABLED_ROUTES']
+
+# Helper function to decide whether the current request may share a model call with identical ones in flight
+def coalescing_enabled(route):
+    # Callers can opt out per request with coalesce=0, operators per route
+    coalesce = request.form.get('coalesce', '1').lower() not in ('0', 'false', 'no', 'off')
+    return coalesce and route not in app.config['SINGLE_FLIGHT_DISABLED_ROUTES']
+
+# Helper function to build the contents, config and cache key of a question about an image, with any cached answer
+def prepare_image_call(client, route, model, prompt, image_data, mime_type, use_cache=True, image_file=None,
+                       schema=None):
+    """Returns (contents, config, cache_key, cached_text), shared by the sync and async modes.
+
+    Hashing the image and the cache lookup block, so the async mode runs
+    this in a thread; only the model call itself differs between modes.
+    """
+    # An image_file uploaded through the Files API is referred to by URI instead of sending the bytes
+    # With a schema (a pydantic model) the answer is a bare JSON array of such objects
+    config = json_config(schema) if schema else None
+    key_schema = schema_key(schema) if schema else None
+    if image_file is not None:
+        cache_key = make_cache_key(model, None, prompt, image_hash=image_file.sha256, schema=key_schema,
+                                   api_key_hash=client.api_key_hash)
+        image_part = image_file.part()
+    else:
+        cache_key = make_cache_key(model, image_data, prompt, schema=key_schema, api_key_hash=client.api_key_hash)
+        image_part = types.Part.from_bytes(data=image_data, mime_type=mime_type)
+    cached_text = cached_answer(route, cache_key) if use_cache else None
+    return [prompt, image_part], config, cache_key, cached_text
+
+# Helper function to look up an earlier answer in the response cache
+def cached_answer(route, cache_key):
+    cached_text = response_cache.get(cache_key)
+    if cached_text is not None:
+        logger.debug("Response cache hit for %s", route)
+    return cached_text
+
+# Helper function to keep an answer in the response cache for its route's lifetime
+def cache_answer(route, cache_key, text):
+    response_cache.set(cache_key, text, ttl=app.config['RESPONSE_CACHE_TTLS'].get(route))
+
+# Helper function to ask the model about an image, answering repeat questions from the response cache
+def generate_text_for_image(client, route, model, prompt, image_data, mime_type, use_cache=None, image_file=None,
+                            coalesce=None, schema=None):
+    if use_cache is None:
+        use_cache = response_cache_enabled(route)
+    if coalesce is None:
+        coalesce = coalescing_enabled(route)
+    contents, config, cache_key, cached_text = prepare_image_call(client, route, model, prompt, image_data, mime_type,
+                                                                  use_cache=use_cache, image_file=image_file,
+                                                                  schema=schema)
+    if cached_text is not None:
+        return cached_text, True
+
+    def call():
+        # Includes waiting for quota and retries, the API calls themselves are timed by the scheduler
+        with stage('model'):
+            response = client.models.generate_content(
+                model=model,
+                contents=contents,
+                config=config
+            )
+        return response.text
+
+    if coalesce:
+        # The cache key already covers the model, image and prompt
+        text, shared = single_flight.do(cache_key, call)
+        if shared:
+            logger.debug("Shared an identical %s call already in flight", route)
+            return text, False
+    else:
+        text = call()
+
+    if use_cache and text:
+        cache_answer(route, cache_key, text)
+    return text, False
+
+# Helper function to hash an image as the model is sent it, None if PIL can't read it
+def image_phash(image_data):
+    try:
+        with Image.open(BytesIO(image_data)) as image:
+            # A JPEG only needs decoding at a fraction of its size for a 32x32 hash
+            image.draft('L', (128, 128))
+            return phash(image)
+    except Exception as e:
+        logger.debug("Could not hash image: %s", e)
+        return None
+
+# Helper function to decide whether an answer may come from a visually identical earlier image
+def near_duplicates_enabled(use_cache, prepared):
+    return use_cache and app.config['NEAR_DUPLICATE_ENABLED'] and prepared.sent_size
+
+# Helper function to find the answer about a prepared upload or a near-duplicate of it, shared by both modes
+def find_similar_answer(client, route, model, prompt, prepared, schema=None):
+    """Returns (answer, pending).
+
+    answer is (text, cached, match) on a hit and None on a miss; pending is
+    handed to remember_similar_answer() once the model has answered.
+    """
+    # Exact repeats first, hashing needs a decode
+    key_schema = schema_key(schema) if schema else None
+    cache_key = make_cache_key(model, prepared.data, prompt, schema=key_schema, api_key_hash=client.api_key_hash)
+    cached_text = cached_answer(route, cache_key)
+    if cached_text is not None:
+        return (cached_text, True, None), None
+
+    namespace = near_duplicate_cache.namespace(client.api_key_hash, route, model, normalize_prompt(prompt),
+                                               key_schema)
+    with stage('near_duplicate_lookup'):
+        image_hash = image_phash(prepared.data)
+        found = near_duplicate_cache.get(namespace, image_hash) if image_hash is not None else None
+    if found:
+        text, distance, size = found
+        logger.debug("Near-duplicate hit for %s at distance %d", route, distance)
+        return (text, True, {'distance': distance, 'size': list(size)}), None
+    return None, (cache_key, namespace, image_hash)
+
+# Helper function to keep a fresh answer for exact and near-duplicate repeats of the image
+def remember_similar_answer(route, pending, prepared, text):
+    cache_key, namespace, image_hash = pending
+    cache_answer(route, cache_key, text)
+    if image_hash is not None:
+        near_duplicate_cache.add(namespace, image_hash, cache_key, prepared.sent_size)
+
+# Helper function to ask about a prepared upload, reusing the answer about a visually identical earlier image
+def generate_text_for_similar_image(client, route, model, prompt, prepared, schema=None):
+    """Like generate_text_for_image, returns (text, cached, match).
+
+    match is None unless the answer was about a near-duplicate image, then
+    it holds the Hamming distance and the size of the image that was sent
+    for that answer.
+    """
+    use_cache = response_cache_enabled(route)
+    if not near_duplicates_enabled(use_cache, prepared):
+        text, cached = generate_text_for_image(client, route, model, prompt, prepared.data, prepared.mime_type,
+                                               use_cache=use_cache, schema=schema)
+        return text, cached, None
+
+    answer, pending = find_similar_answer(client, route, model, prompt, prepared, schema=schema)
+    if answer is not None:
+        return answer
+
+    # The response cache was already checked above, so it is filled here rather than by generate_text_for_image
+    text, _ = generate_text_for_image(client, route, model, prompt, prepared.data, prepared.mime_type,
+                                      use_cache=False, schema=schema)
+    if text:
+        remember_similar_answer(route, pending, prepared, text)
+    return text, False, None
+
+# Helper function to stream the model's answer about an image, returns (chunks, cached)
+def stream_text_for_image(client, route, model, prompt, image_data, mime_type, use_cache=None, schema=None):
+    if use_cache is None:
+        use_cache = response_cache_enabled(route)
+    config = json_config(schema) if schema else None
+    cache_key = make_cache_key(model, image_data, prompt, schema=schema_key(schema) if schema else None,
+                               api_key_hash=client.api_key_hash)
+    if use_cache:
+        cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            logger.debug("Response cache hit for %s", route)
+            return iter([cached_text]), True
+
+    def chunks():
+        # Only hold on to the whole text when it is going into the cache
+        parts = []
+        for chunk in client.models.generate_content_stream(
+            model=model,
+            contents=[prompt, types.Part.from_bytes(data=image_data, mime_type=mime_type)],
+            config=config
+        ):
+            text = chunk.text
+            if text:
+                if use_cache:
+                    parts.append(text)
+                yield text
+        if use_cache and parts:
+            response_cache.set(cache_key, ''.join(parts), ttl=app.config['RESPONSE_CACHE_TTLS'].get(route))
+
+    return chunks(), False
+
+# Helper function to format one server-sent event
+def format_sse(data, event_id=None):
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+    return f"data: {json.dumps(data)}\n\n"
+
+# Label each request's logs and timings with its route
+@app.before_request
+def start_request_timer():
+    g.request_id = start_request(request.endpoint or 'unmatched')
+    g.request_started = time.perf_counter()
+    g.result_writes = result_writer.track_writes()
+    g.upload_writes = upload_store.track_writes()
+    # A result that is still being encoded, or an upload still being saved, is served once it is on disk
+    if request.endpoint == 'static':
+        filename = request.view_args.get('filename', '')
+        if filename.startswith('results/'):
+            result_writer.wait(filename)
+        elif filename.startswith('uploads/'):
+            upload_store.wait(filename)
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        # Streamed responses are only timed until their headers go out
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, route=request.endpoint or 'unmatched',
+                                method=request.method, status=response.status_code)
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+# Helper function to wait until the results and uploads queued so far are written
+def wait_for_writes(result_writes, upload_writes):
+    result_writer.wait_for(result_writes)
+    upload_store.wait_for(upload_writes)
+
+# Helper function to hold back each chunk of a streamed response until the files queued so far are written
+def wait_between_chunks(chunks, result_writes, upload_writes):
+    try:
+        for chunk in chunks:
+            wait_for_writes(result_writes, upload_writes)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+# Result and upload paths only go out once their files are written, the next request may reach another worker process
+@app.after_request
+def wait_for_result_writes(response):
+    result_writes = g.get('result_writes')
+    upload_writes = g.get('upload_writes')
+    if result_writes is None or upload_writes is None:
+        return response
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = wait_between_chunks(response.response, result_writes, upload_writes)
+    else:
+        wait_for_writes(result_writes, upload_writes)
+    return response
+
 # Routes
 @app.route('/')
 def index():
@@ -91,8 +564,8 @@ def save_settings():
 
     # Test the API key
     try:
-        # Create a client with the API key
-        client = genai.Client(api_key=api_key)
+        # Get (or create) the pooled client for the API key
+        client = client_pool.get(api_key)
 
         # Simple test to verify the API key works
         response = client.models.generate_content(
@@ -105,13 +578,17 @@ def save_settings():
                                 message='API key saved successfully! Using Gemini 2.0 Flash.',
                                 message_type='success'))
     except Exception as e:
-        # If there's an error, the API key might be invalid
+        # If there's an error, the API key might be invalid, so don't keep its client around
+        client_pool.discard(api_key)
         return redirect(url_for('settings',
                                 message=f'Error with API key: {str(e)}',
                                 message_type='danger'))
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
+    result_writer.wait(filename)
+    upload_store.wait(filename)
+
     # Handle paths that start with 'static/'
     if filename.startswith('static/'):
         # Remove 'static/' prefix to get the relative path
@@ -135,6 +612,42 @@ def download_file(filename):
     # File not found
     return jsonify({'error': f'File not found: {filename}'}), 404
 
+# Helper function to gather the runtime counters of the shared subsystems
+def collect_stats():
+    return {
+        'client_pool': client_pool.stats(),
+        'response_cache': response_cache.stats(),
+        'near_duplicates': near_duplicate_cache.stats(),
+        'jobs': job_store.stats(),
+        'model_latency': model_latency.stats(),
+        'hedging': hedge_policy.stats(),
+        'preprocessing': preprocess_stats.stats(),
+        'uploads': upload_store.stats(),
+        'batch': batch_runner.stats(),
+        'frames': frame_sampler.stats(),
+        'text_streams': text_streams.stats(),
+        'chat_sessions': chat_sessions.stats(),
+        'image_files': image_files.stats(),
+        'scheduler': call_scheduler.stats(),
+        'single_flight': single_flight.stats(),
+        'result_writer': result_writer.stats(),
+        'fonts': font_cache.stats(),
+        **({'fake_gemini': fake_gemini.stats()} if fake_gemini is not None else {}),
+    }
+
+@app.route('/stats')
+def stats():
+    # Runtime counters for the shared subsystems
+    return jsonify(collect_stats())
+
+# The same counters are exported next to the latency histograms
+metrics.add_collector(collect_stats)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text exposition format
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/image_qa')
 def image_qa():
     return render_template('image_qa.html')
@@ -145,44 +658,264 @@ def image_qa_process():
     client = configure_gemini_client()
     if not client:
         return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+    api_key = session.get(API_KEY_SESSION_KEY)
 
-    if 'image' not in request.files:
-        return jsonify({'error': 'No image uploaded'}), 400
-
-    file = request.files['image']
-    question = request.form.get('question', 'What is in this image?')
-
-    # Save the uploaded file
-    image_path = save_uploaded_file(file)
-
-    if not image_path:
-        return jsonify({'error': 'Failed to save image'}), 400
+    # Several questions can be asked at once by repeating the questions field
+    questions = [question.strip() for question in request.form.getlist('questions') if question.strip()]
+    if not questions:
+        questions = [request.form.get('question', 'What is in this image?')]
+    if len(questions) > app.config['IMAGE_QA_MAX_QUESTIONS']:
+        return jsonify({'error': f"At most {app.config['IMAGE_QA_MAX_QUESTIONS']} questions per request"}), 413
+
+    # keep_image=1 uploads the image once through the Files API and returns a handle for later questions
+    keep_image = request.form.get('keep_image', '').lower() in ('1', 'true', 'yes', 'on')
+    image_handle = request.form.get('image_handle')
+    image_file = None
+    image_data = mime_type = preprocessing = prepared = None
+
+    if image_handle:
+        # The image was uploaded by an earlier request, no bytes to send this time
+        image_file = image_files.get(image_handle, api_key)
+        if image_file is None:
+            return jsonify({'error': 'Image handle not found or expired, please upload the image again'}), 404
+        image_path = image_file.image_path
+    else:
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image uploaded'}), 400
+
+        file = request.files['image']
+
+        # Read the uploaded file once, it is saved to disk in the background
+        upload = ingest_uploaded_file(file)
+
+        if not upload:
+            return jsonify({'error': 'Failed to read image'}), 400
+
+        image_path = upload.path
+
+        # Downscale and re-encode the image before sending it to the model
+        prepared = prepare_upload(upload.data, file.content_type)
+        image_data, mime_type = prepared.data, prepared.mime_type
+        preprocessing = prepared.summary()
+
+        if keep_image or len(questions) > 1:
+            try:
+                with stage('file_upload'):
+                    image_file, reused = image_files.upload(client, api_key, image_data, mime_type, image_path)
+                if reused:
+                    logger.debug("Image already uploaded, reusing its file")
+            except Exception as e:
+                # Still answer, sending the bytes with each question
+                logger.warning("Could not upload image to the Files API: %s", e)
 
-    # Read the image file
-    with open(image_path, "rb") as image_file:
-        image_data = image_file.read()
+    result = {'image_path': image_path}
+    if image_file is not None:
+        result['image_handle'] = image_file.handle
+        result['image_handle_expires_in'] = image_file.expires_in()
+    if preprocessing:
+        result['preprocessing'] = preprocessing
 
     # Ask Gemini about the image
     try:
-        print("Using Gemini 2.0 Flash for image QA")
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[question, types.Part.from_bytes(data=image_data, mime_type=file.content_type)]
-        )
-        print("Successfully processed image QA request")
-
-        return jsonify({
-            'answer': response.text,
-            'image_path': image_path
-        })
+        logger.debug("Using Gemini 2.0 Flash for image QA")
+        if len(questions) == 1:
+            if image_file is None:
+                answer, cached, match = generate_text_for_similar_image(client, 'image_qa', "gemini-2.0-flash",
+                                                                        questions[0], prepared)
+                if match:
+                    result['near_duplicate'] = {'distance': match['distance']}
+            else:
+                answer, cached = generate_text_for_image(client, 'image_qa', "gemini-2.0-flash", questions[0],
+                                                         image_data, mime_type, image_file=image_file)
+            logger.debug("Successfully processed image QA request")
+            result.update({'answer': answer, 'cached': cached})
+            return jsonify(result)
+
+        # Answer all the questions concurrently on the batch model pool
+        use_cache = response_cache_enabled('image_qa')
+        coalesce = coalescing_enabled('image_qa')
+
+        def ask(index, question):
+            return generate_text_for_image(client, 'image_qa', "gemini-2.0-flash", question, image_data, mime_type,
+                                           use_cache=use_cache, image_file=image_file, coalesce=coalesce)
+
+        def collect(index, question, answered):
+            answer, cached = answered
+            return {'index': index, 'answer': answer, 'cached': cached}
+
+        answers = sorted(batch_runner.run(enumerate(questions), ask, collect), key=lambda item: item['index'])
+        for item in answers:
+            item['question'] = questions[item['index']]
+        logger.debug("Answered %d questions about one image", len(questions))
+        result['answers'] = answers
+        return jsonify(result)
     except Exception as e:
-        print(f"Error in image QA: {str(e)}")
+        logger.exception("Error in image QA: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/image_generation')
 def image_generation():
     return render_template('image_generation.html')
 
+# Helper functions to check whether a response actually contains an image
+def has_inline_image(response):
+    for candidate in getattr(response, 'candidates', None) or []:
+        content = getattr(candidate, 'content', None)
+        for part in getattr(content, 'parts', None) or []:
+            inline_data = getattr(part, 'inline_data', None)
+            if inline_data is not None and inline_data.data:
+                return True
+    return False
+
+def has_generated_image(response):
+    return bool(getattr(response, 'generated_images', None))
+
+# Helper function to generate an image, hedging Gemini with Imagen 3 according to the hedge policy
+def generate_image_with_fallback(client, prompt):
+    attempts = [
+        # Use Gemini 2.0 Flash with image generation capability
+        ("gemini-2.0-flash-exp-image-generation", lambda: client.models.generate_content(
+            model="gemini-2.0-flash-exp-image-generation",
+            contents=prompt,
+            config=types.GenerateContentConfig(response_modalities=["Text", "Image"]),
+        ), has_inline_image),
+        # Fall back to Imagen 3 for image generation
+        ("imagen-3.0-generate-002", lambda: client.models.generate_images(
+            model="imagen-3.0-generate-002",
+            prompt=prompt,
+            config=types.GenerateImagesConfig(number_of_images=1),
+        ), has_generated_image),
+    ]
+
+    try:
+        logger.debug("Attempting to use Gemini 2.0 Flash for image generation")
+        with stage('model'):
+            model, response = run_hedged(attempts, hedge_policy, model_latency, hedge_executor)
+        logger.debug("Successfully used %s for image generation", model)
+    except Exception as gemini_error:
+        logger.warning("Gemini API error: %s", gemini_error)
+        # Create a placeholder response
+        return {"text": f"Could not generate image for: {prompt}"}, False
+
+    # Flag to indicate whether the Imagen API answered
+    using_imagen_api = model == "imagen-3.0-generate-002"
+    return response, using_imagen_api
+
+# Helper function to generate and save an image, sharing the work with identical requests in flight
+def generate_image_result(client, prompt, coalesce=True):
+    def run():
+        response, using_imagen_api = generate_image_with_fallback(client, prompt)
+        return process_generation_response(response, using_imagen_api, prompt)
+
+    if not coalesce:
+        return run()
+    result, shared = single_flight.do(flight_key('image_generation', client.api_key_hash, prompt), run)
+    if shared:
+        logger.debug("Shared an identical image generation already in flight")
+    # Each caller gets its own copy to add to
+    return dict(result)
+
+# Helper function to turn a generation response into a saved image (or a placeholder)
+def process_generation_response(response, using_imagen_api, prompt):
+    # Process the response
+    result = {'text': '', 'image_path': None}
+    logger.debug("Response type: %s", type(response))
+
+    # Try to extract image from response
+    image_extracted = False
+
+    # Check if we have a dictionary (placeholder response)
+    if isinstance(response, dict) and 'text' in response:
+        result['text'] = response['text']
+        logger.debug("Using placeholder response: %s", response['text'])
+
+    # Check if we're using Imagen API
+    elif using_imagen_api:
+        try:
+            logger.debug("Processing Imagen API response")
+            # Handle Imagen API response format
+            if hasattr(response, 'generated_images'):
+                logger.debug("Found %d generated images", len(response.generated_images))
+                # Save the first generated image
+                image_bytes = response.generated_images[0].image.image_bytes
+                with stage('save'):
+                    result['image_path'] = result_writer.save_bytes(image_bytes, 'generated')
+                result['text'] = 'Image generated successfully with Imagen 3 (fallback model)'
+                logger.debug("Saved image from Imagen API")
+                image_extracted = True
+        except Exception as e:
+            logger.warning("Error processing Imagen response: %s", e)
+
+    # Handle Gemini API response format
+    else:
+        try:
+            logger.debug("Processing Gemini API response")
+            # Check for candidates in the response
+            if hasattr(response, 'candidates') and response.candidates:
+                logger.debug("Found %d candidates", len(response.candidates))
+                for i, candidate in enumerate(response.candidates):
+                    if hasattr(candidate, 'content') and candidate.content:
+                        # Check for text
+                        if hasattr(candidate.content, 'text') and candidate.content.text:
+                            result['text'] = candidate.content.text
+                            logger.debug("Found text in candidate %d", i)
+
+                        # Check for parts in content
+                        if hasattr(candidate.content, 'parts'):
+                            logger.debug("Found %d parts in candidate %d", len(candidate.content.parts), i)
+                            for j, part in enumerate(candidate.content.parts):
+                                if hasattr(part, 'text') and part.text:
+                                    result['text'] = part.text
+                                    logger.debug("Found text in part %d", j)
+
+                                if getattr(part, 'inline_data', None) is not None and part.inline_data.data:
+                                    try:
+                                        # Save the generated image, PNG and JPEG bytes are written as they are
+                                        with stage('save'):
+                                            result['image_path'] = result_writer.save_bytes(part.inline_data.data,
+                                                                                            'generated')
+                                        result['text'] = 'Image generated successfully with Gemini 2.0 Flash (primary model)'
+                                        logger.debug("Saved image from part %d", j)
+                                        image_extracted = True
+                                    except Exception as e:
+                                        logger.warning("Error saving image from part: %s", e)
+        except Exception as e:
+            logger.warning("Error processing Gemini response: %s", e)
+
+    # If no image was generated, create a placeholder image with the prompt text
+    if not result['image_path']:
+        try:
+            # Get error message if available
+            error_message = "Image generation failed. Please try a different prompt."
+            if isinstance(response, dict) and 'text' in response:
+                result['text'] = response['text']
+            elif not result['text']:
+                result['text'] = "Could not generate image. Created placeholder instead."
+
+            # Create a simple image with the prompt text
+            width, height = 800, 600
+            image = Image.new('RGB', (width, height), color=(240, 240, 240))
+            draw = ImageDraw.Draw(image)
+
+            # Add text with the prompt, centered
+            font = font_cache.get(24)
+            draw_centered_text(draw, width // 2, height // 2 - 12, f"Generated image for: {prompt}", font)
+
+            # Add a note about the error
+            draw_centered_text(draw, width // 2, height // 2 + 30, error_message, font, fill=(255, 0, 0))
+
+            # Save the placeholder image
+            with stage('save'):
+                result['image_path'] = result_writer.save_image(image, 'placeholder')
+
+            logger.info("Created placeholder image")
+
+        except Exception as placeholder_error:
+            result['text'] = f'Failed to create image: {str(placeholder_error)}'
+            logger.error("Error creating placeholder: %s", placeholder_error)
+
+    return result
+
 @app.route('/image_generation_process', methods=['POST'])
 def image_generation_process():
     # Check if API key is set and get client
@@ -196,171 +929,7 @@ def image_generation_process():
         return jsonify({'error': 'No prompt provided'}), 400
 
     try:
-        # First try using Gemini 2.0 Flash for image generation
-        try:
-            print("Attempting to use Gemini 2.0 Flash for image generation")
-            # Use Gemini 2.0 Flash with image generation capability
-            response = client.models.generate_content(
-                model="gemini-2.0-flash-exp-image-generation",
-                contents=prompt,
-                config=types.GenerateContentConfig(response_modalities=["Text", "Image"]),
-            )
-            # Flag to indicate we're using Gemini API
-            using_imagen_api = False
-            print("Successfully used Gemini 2.0 Flash for image generation")
-
-        except Exception as gemini_error:
-            # Log the error for debugging
-            print(f"Gemini API error: {str(gemini_error)}")
-
-            # Fall back to Imagen 3 for image generation
-            try:
-                print("Falling back to Imagen 3 for image generation")
-                response = client.models.generate_images(
-                    model="imagen-3.0-generate-002",
-                    prompt=prompt,
-                    response_count=1
-                )
-                using_imagen_api = True
-                print("Successfully used Imagen 3 for image generation")
-
-            except Exception as gemini_error:
-                print(f"Gemini API error: {str(gemini_error)}")
-                # Create a placeholder response
-                response = {"text": f"Could not generate image for: {prompt}"}
-                using_imagen_api = False
-
-        # Process the response
-        result = {'text': '', 'image_path': None}
-        print(f"Response type: {type(response)}")
-
-        # Try to extract image from response
-        image_extracted = False
-
-        # Check if we have a dictionary (placeholder response)
-        if isinstance(response, dict) and 'text' in response:
-            result['text'] = response['text']
-            print(f"Using placeholder response: {response['text']}")
-
-        # Check if we're using Imagen API
-        elif 'using_imagen_api' in locals() and using_imagen_api:
-            try:
-                print("Processing Imagen API response")
-                # Handle Imagen API response format
-                if hasattr(response, 'generated_images'):
-                    print(f"Found {len(response.generated_images)} generated images")
-                    # Save the first generated image
-                    image_bytes = response.generated_images[0].image.image_bytes
-                    image = Image.open(BytesIO(image_bytes))
-                    image_filename = f"generated_{os.urandom(4).hex()}.png"
-                    image_path = os.path.join(app.config['RESULTS_FOLDER'], image_filename)
-                    image.save(image_path)
-                    result['image_path'] = os.path.join('static', 'results', image_filename)
-                    result['text'] = 'Image generated successfully with Imagen 3 (fallback model)'
-                    print("Saved image from Imagen API")
-                    image_extracted = True
-            except Exception as e:
-                print(f"Error processing Imagen response: {str(e)}")
-
-        # Handle Gemini API response format
-        else:
-            try:
-                print("Processing Gemini API response")
-                # Check for candidates in the response
-                if hasattr(response, 'candidates') and response.candidates:
-                    print(f"Found {len(response.candidates)} candidates")
-                    for i, candidate in enumerate(response.candidates):
-                        if hasattr(candidate, 'content') and candidate.content:
-                            # Check for text
-                            if hasattr(candidate.content, 'text') and candidate.content.text:
-                                result['text'] = candidate.content.text
-                                print(f"Found text in candidate {i}")
-
-                            # Check for parts in content
-                            if hasattr(candidate.content, 'parts'):
-                                print(f"Found {len(candidate.content.parts)} parts in candidate {i}")
-                                for j, part in enumerate(candidate.content.parts):
-                                    if hasattr(part, 'text') and part.text:
-                                        result['text'] = part.text
-                                        print(f"Found text in part {j}")
-
-                                    if hasattr(part, 'inline_data'):
-                                        try:
-                                            # Save the generated image
-                                            image = Image.open(BytesIO(part.inline_data.data))
-                                            image_filename = f"generated_{os.urandom(4).hex()}.png"
-                                            image_path = os.path.join(app.config['RESULTS_FOLDER'], image_filename)
-                                            image.save(image_path)
-                                            result['image_path'] = os.path.join('static', 'results', image_filename)
-                                            result['text'] = 'Image generated successfully with Gemini 2.0 Flash (primary model)'
-                                            print(f"Saved image from part {j}")
-                                            image_extracted = True
-                                        except Exception as e:
-                                            print(f"Error saving image from part: {str(e)}")
-            except Exception as e:
-                print(f"Error processing Gemini response: {str(e)}")
-
-        # If no image was generated, create a placeholder image with the prompt text
-        if not result['image_path']:
-            try:
-                # Get error message if available
-                error_message = "Image generation failed. Please try a different prompt."
-                if isinstance(response, dict) and 'text' in response:
-                    result['text'] = response['text']
-                elif not result['text']:
-                    result['text'] = "Could not generate image. Created placeholder instead."
-
-                # Create a simple image with the prompt text
-                width, height = 800, 600
-                image = Image.new('RGB', (width, height), color=(240, 240, 240))
-                draw = ImageDraw.Draw(image)
-
-                # Add text with the prompt
-                text = f"Generated image for: {prompt}"
-                position = (width//2, height//2)  # Center
-                text_color = (0, 0, 0)  # Black
-
-                # Try to get a font, use default if not available
-                try:
-                    font = ImageFont.truetype("arial.ttf", 24)
-                except IOError:
-                    font = ImageFont.load_default()
-
-                # Calculate text size and position for centering
-                try:
-                    text_width = draw.textlength(text, font=font)
-                except AttributeError:
-                    # For older PIL versions
-                    text_width = font.getsize(text)[0]
-
-                text_position = (position[0] - text_width//2, position[1] - 12)  # Approximate centering
-
-                # Draw text
-                draw.text(text_position, text, font=font, fill=text_color)
-
-                # Add a note about the error
-                error_position = (position[0], position[1] + 30)
-                try:
-                    error_width = draw.textlength(error_message, font=font)
-                except AttributeError:
-                    # For older PIL versions
-                    error_width = font.getsize(error_message)[0]
-
-                error_text_position = (error_position[0] - error_width//2, error_position[1])
-                draw.text(error_text_position, error_message, font=font, fill=(255, 0, 0))
-
-                # Save the placeholder image
-                image_filename = f"placeholder_{os.urandom(4).hex()}.png"
-                image_path = os.path.join(app.config['RESULTS_FOLDER'], image_filename)
-                image.save(image_path)
-                result['image_path'] = os.path.join('static', 'results', image_filename)
-
-                print("Created placeholder image")
-
-            except Exception as placeholder_error:
-                result['text'] = f'Failed to create image: {str(placeholder_error)}'
-                print(f"Error creating placeholder: {str(placeholder_error)}")
-
+        result = generate_image_result(client, prompt, coalesce=coalescing_enabled('image_generation'))
         return jsonify(result)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -369,6 +938,108 @@ def image_generation_process():
 def image_editing():
     return render_template('image_editing.html')
 
+# Helper function to edit an image, hedging with Gemini 2.0 Flash if the first model is slow or returns nothing
+def edit_image_with_fallback(client, edit_prompt, image_data, mime_type):
+    attempts = [
+        # Generate edited image with Gemini 2.0 Flash
+        ("gemini-2.0-flash-exp-image-generation", lambda: client.models.generate_content(
+            model="gemini-2.0-flash-exp-image-generation",
+            contents=[edit_prompt, types.Part.from_bytes(data=image_data, mime_type=mime_type)],
+            config=types.GenerateContentConfig(response_modalities=["Text", "Image"]),
+        ), has_inline_image),
+        # If that fails, try with a different approach
+        ("gemini-2.0-flash", lambda: client.models.generate_content(
+            model="gemini-2.0-flash",
+            contents=[f"Edit this image: {edit_prompt}", types.Part.from_bytes(data=image_data, mime_type=mime_type)],
+            config=types.GenerateContentConfig(response_modalities=["Text", "Image"]),
+        ), has_inline_image),
+    ]
+
+    logger.debug("Attempting to edit image with Gemini 2.0 Flash")
+    with stage('model'):
+        model, response = run_hedged(attempts, hedge_policy, model_latency, hedge_executor)
+    logger.debug("Completed image editing request with %s", model)
+    return response
+
+# Helper function to edit an image and save the result, sharing the work with identical requests in flight
+def edit_image_result(client, edit_prompt, image_data, prepared, coalesce=True):
+    def run():
+        response = edit_image_with_fallback(client, edit_prompt, prepared.data, prepared.mime_type)
+        return process_editing_response(response, image_data, edit_prompt)
+
+    if not coalesce:
+        result = run()
+    else:
+        key = flight_key('image_editing', client.api_key_hash, edit_prompt, prepared.data)
+        result, shared = single_flight.do(key, run)
+        if shared:
+            logger.debug("Shared an identical image edit already in flight")
+        result = dict(result)
+    result['preprocessing'] = prepared.summary()
+    return result
+
+# Helper function to turn an editing response into a saved image (or a basic local edit)
+def process_editing_response(response, image_data, edit_prompt):
+    # Process the response
+    result = {'text': '', 'image_path': None}
+
+    # Handle different response formats
+    # Format 1: Response with parts (standard Gemini response)
+    if hasattr(response, 'parts'):
+        for part in response.parts:
+            if hasattr(part, 'text') and part.text:
+                result['text'] = part.text
+            elif getattr(part, 'inline_data', None) is not None and part.inline_data.data:
+                # Save the edited image, PNG and JPEG bytes are written as they are
+                with stage('save'):
+                    result['image_path'] = result_writer.save_bytes(part.inline_data.data, 'edited')
+
+    # Format 2: Response with candidates (newer Gemini API format)
+    elif hasattr(response, 'candidates') and response.candidates:
+        for candidate in response.candidates:
+            if hasattr(candidate, 'content') and candidate.content:
+                # Check for text
+                if hasattr(candidate.content, 'text') and candidate.content.text:
+                    result['text'] = candidate.content.text
+
+                # Check for parts
+                if hasattr(candidate.content, 'parts'):
+                    for part in candidate.content.parts:
+                        if hasattr(part, 'text') and part.text:
+                            result['text'] = part.text
+                        elif getattr(part, 'inline_data', None) is not None and part.inline_data.data:
+                            # Save the edited image, PNG and JPEG bytes are written as they are
+                            with stage('save'):
+                                result['image_path'] = result_writer.save_bytes(part.inline_data.data, 'edited')
+
+    # If no image was generated, create a simple edited version
+    if not result['image_path']:
+        try:
+            # Open the original image again, upright
+            original_image = ImageOps.exif_transpose(Image.open(BytesIO(image_data)))
+
+            # Apply a simple edit (add text to the image)
+            edited_image = original_image.copy()
+            draw = ImageDraw.Draw(edited_image)
+
+            # Add the edit prompt in the top-left corner, white with a black outline
+            draw_outlined_text(draw, (10, 10), edit_prompt, font_cache.get(20))
+
+            # Save the edited image
+            with stage('save'):
+                result['image_path'] = result_writer.save_image(edited_image, 'edited')
+            result['text'] = 'Basic image edit applied'
+            logger.info("Created placeholder edited image")
+        except Exception as edit_error:
+            # If even the basic edit fails, just return the original image
+            logger.error("Error creating placeholder: %s", edit_error)
+            result['text'] = f'Could not generate edited image: {str(edit_error)}'
+            # Copy the original image to results folder
+            result['image_path'] = result_writer.save_bytes(image_data, 'original')
+            logger.info("Returned original image as fallback")
+
+    return result
+
 @app.route('/image_editing_process', methods=['POST'])
 def image_editing_process():
     # Check if API key is set and get client
@@ -382,129 +1053,245 @@ def image_editing_process():
     file = request.files['image']
     edit_prompt = request.form.get('edit_prompt', 'Edit this image')
 
-    # Save the uploaded file
-    image_path = save_uploaded_file(file)
+    # Read the uploaded file once, it is saved to disk in the background
+    upload = ingest_uploaded_file(file)
 
-    if not image_path:
-        return jsonify({'error': 'Failed to save image'}), 400
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
 
-    # Open the image
-    with open(image_path, "rb") as image_file:
-        image_data = image_file.read()
+    image_data = upload.data
 
-    try:
-        # Generate edited image with Gemini 2.0 Flash
-        print("Attempting to edit image with Gemini 2.0 Flash")
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp-image-generation",
-            contents=[edit_prompt, types.Part.from_bytes(data=image_data, mime_type=file.content_type)],
-            config=types.GenerateContentConfig(response_modalities=["Text", "Image"]),
-        )
-        print("Successfully requested image editing")
-
-        # If that fails, try with a different approach
-        if not hasattr(response, 'candidates') or not response.candidates:
-            print("No candidates in response, trying alternative approach")
-            response = client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=[f"Edit this image: {edit_prompt}", types.Part.from_bytes(data=image_data, mime_type=file.content_type)],
-                config=types.GenerateContentConfig(response_modalities=["Text", "Image"]),
-            )
-            print("Completed alternative image editing request")
-
-
-        # Process the response
-        result = {'text': '', 'image_path': None}
-
-        # Handle different response formats
-        # Format 1: Response with parts (standard Gemini response)
-        if hasattr(response, 'parts'):
-            for part in response.parts:
-                if hasattr(part, 'text') and part.text:
-                    result['text'] = part.text
-                elif hasattr(part, 'inline_data'):
-                    # Save the edited image
-                    edited_image = Image.open(BytesIO(part.inline_data.data))
-                    edited_filename = f"edited_{os.urandom(4).hex()}.png"
-                    edited_path = os.path.join(app.config['RESULTS_FOLDER'], edited_filename)
-                    edited_image.save(edited_path)
-                    result['image_path'] = os.path.join('static', 'results', edited_filename)
-
-        # Format 2: Response with candidates (newer Gemini API format)
-        elif hasattr(response, 'candidates') and response.candidates:
-            for candidate in response.candidates:
-                if hasattr(candidate, 'content') and candidate.content:
-                    # Check for text
-                    if hasattr(candidate.content, 'text') and candidate.content.text:
-                        result['text'] = candidate.content.text
-
-                    # Check for parts
-                    if hasattr(candidate.content, 'parts'):
-                        for part in candidate.content.parts:
-                            if hasattr(part, 'text') and part.text:
-                                result['text'] = part.text
-                            elif hasattr(part, 'inline_data'):
-                                # Save the edited image
-                                edited_image = Image.open(BytesIO(part.inline_data.data))
-                                edited_filename = f"edited_{os.urandom(4).hex()}.png"
-                                edited_path = os.path.join(app.config['RESULTS_FOLDER'], edited_filename)
-                                edited_image.save(edited_path)
-                                result['image_path'] = os.path.join('static', 'results', edited_filename)
-
-        # If no image was generated, create a simple edited version
-        if not result['image_path']:
-            try:
-                # Open the original image again
-                original_image = Image.open(image_path)
-
-                # Apply a simple edit (add text to the image)
-                edited_image = original_image.copy()
-                draw = ImageDraw.Draw(edited_image)
-
-                # Add text with the edit prompt
-                text = edit_prompt
-                position = (10, 10)  # Top-left corner
-                text_color = (255, 255, 255)  # White
-                outline_color = (0, 0, 0)  # Black outline
-
-                # Try to get a font, use default if not available
-                try:
-                    font = ImageFont.truetype("arial.ttf", 20)
-                except IOError:
-                    font = ImageFont.load_default()
-
-                # Draw text with outline
-                for dx, dy in [(-1, -1), (-1, 1), (1, -1), (1, 1)]:
-                    draw.text((position[0] + dx, position[1] + dy), text, font=font, fill=outline_color)
-                draw.text(position, text, font=font, fill=text_color)
-
-                # Save the edited image
-                edited_filename = f"edited_{os.urandom(4).hex()}.png"
-                edited_path = os.path.join(app.config['RESULTS_FOLDER'], edited_filename)
-                edited_image.save(edited_path)
-                result['image_path'] = os.path.join('static', 'results', edited_filename)
-                result['text'] = 'Basic image edit applied'
-                print("Created placeholder edited image")
-            except Exception as edit_error:
-                # If even the basic edit fails, just return the original image
-                print(f"Error creating placeholder: {str(edit_error)}")
-                result['text'] = f'Could not generate edited image: {str(edit_error)}'
-                # Copy the original image to results folder
-                edited_filename = f"original_{os.urandom(4).hex()}.png"
-                edited_path = os.path.join(app.config['RESULTS_FOLDER'], edited_filename)
-                original_image = Image.open(image_path)
-                original_image.save(edited_path)
-                result['image_path'] = os.path.join('static', 'results', edited_filename)
-                print("Returned original image as fallback")
+    # Downscale and re-encode the image before sending it to the model
+    prepared = prepare_upload(image_data, file.content_type)
 
+    try:
+        result = edit_image_result(client, edit_prompt, image_data, prepared,
+                                   coalesce=coalescing_enabled('image_editing'))
         return jsonify(result)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Helper function to queue a background job, answering 429 when the queue is full
+def submit_job(kind, func):
+    def run():
+        queued = result_writer.track_writes()
+        try:
+            # Background jobs give way to interactive requests for model quota, their timings are labelled by kind
+            with call_priority('background'), route_context(f"{kind}_job"):
+                return func()
+        finally:
+            # A finished job's result may be fetched from any worker process
+            result_writer.wait_for(queued)
+
+    try:
+        job = job_store.submit(kind, run, session.get(API_KEY_SESSION_KEY))
+    except JobQueueFull as e:
+        response = jsonify({'error': str(e)})
+        response.status_code = 429
+        response.headers['Retry-After'] = '5'
+        return response
+
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('job_status', job_id=job.id),
+        'events_url': url_for('job_events', job_id=job.id)
+    }), 202
+
+@app.route('/image_generation_jobs', methods=['POST'])
+def image_generation_jobs():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    prompt = request.form.get('prompt', '')
+
+    if not prompt:
+        return jsonify({'error': 'No prompt provided'}), 400
+
+    coalesce = coalescing_enabled('image_generation')
+
+    # Model calls and saving the image run on a job worker
+    def run():
+        return generate_image_result(client, prompt, coalesce=coalesce)
+
+    return submit_job('image_generation', run)
+
+@app.route('/image_editing_jobs', methods=['POST'])
+def image_editing_jobs():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+    edit_prompt = request.form.get('edit_prompt', 'Edit this image')
+    mime_type = file.content_type
+
+    # Read the uploaded file once, it is saved to disk in the background
+    upload = ingest_uploaded_file(file)
+
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
+
+    image_data = upload.data
+
+    # Downscale and re-encode the image before sending it to the model
+    prepared = prepare_upload(image_data, mime_type)
+
+    coalesce = coalescing_enabled('image_editing')
+
+    # Model calls and saving the image run on a job worker
+    def run():
+        return edit_image_result(client, edit_prompt, image_data, prepared, coalesce=coalesce)
+
+    return submit_job('image_editing', run)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_store.get(job_id, session.get(API_KEY_SESSION_KEY))
+    if job is None:
+        return jsonify({'error': f'Job not found: {job_id}'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    if job_store.get(job_id, session.get(API_KEY_SESSION_KEY)) is None:
+        return jsonify({'error': f'Job not found: {job_id}'}), 404
+
+    def generate():
+        last_status = None
+        while True:
+            job = job_store.wait_for_change(job_id, last_status, timeout=15)
+
+            if job is None:
+                # The job expired while we were waiting
+                yield format_sse({'error': 'Job expired', 'done': True})
+                return
+
+            if job.status == last_status:
+                # Nothing changed, send a comment to keep the connection open
+                yield ": keep-alive\n\n"
+                continue
+
+            # Send each status change as a server-sent event
+            last_status = job.status
+            yield format_sse(job.to_dict())
+            if job.finished:
+                return
+
+    return Response(generate(), mimetype='text/event-stream')
+
 @app.route('/bounding_boxes')
 def bounding_boxes():
     return render_template('bounding_boxes.html')
 
+# Helper function to build the bounding box prompt for an object type
+def build_bounding_box_prompt(object_name):
+    # Several object types can be detected in one call
+    if isinstance(object_name, (list, tuple)):
+        if len(object_name) > 1:
+            return build_multi_object_bounding_box_prompt(object_name)
+        object_name = object_name[0]
+
+    # The response schema (BoundingBox) describes the JSON format, the prompt only says what to find
+    prompt = f"Return bounding boxes for all {object_name}s in this image, labelled '{object_name}'."
+    return prompt
+
+def build_multi_object_bounding_box_prompt(object_names):
+    names = ', '.join(object_names)
+    prompt = (f"Return bounding boxes for every object of these types in this image: {names}. "
+              f"Label each box with its type, exactly as written in this list.")
+    return prompt
+
+# Helper function to parse the model's bounding box response into BoundingBox objects
+def extract_bounding_box_json(bbox_text):
+    # The model was asked for JSON matching the schema, so there is nothing to dig out
+    with stage('json_extract'):
+        return parse_items(bbox_text, BoundingBox)
+
+# Helper function to convert the model's boxes to pixel coordinates on the original image
+def compute_bounding_boxes(parsed_data, width, height, object_name):
+    boxes = []
+
+    # Process each detected object, the schema guarantees four coordinates
+    if isinstance(parsed_data, list):
+        for i, item in enumerate(parsed_data):
+            bbox = item.box_2d
+            label = item.label or object_name
+
+            # The schema asks for [y_min, x_min, y_max, x_max] normalized to 0-1000, whatever size the model saw
+            y_min, x_min, y_max, x_max = (float(coord) / 1000 for coord in bbox)
+            x_min = int(x_min * width)
+            y_min = int(y_min * height)
+            x_max = int(x_max * width)
+            y_max = int(y_max * height)
+
+            # Ensure coordinates are within image bounds
+            x_min = max(0, min(x_min, width))
+            y_min = max(0, min(y_min, height))
+            x_max = max(0, min(x_max, width))
+            y_max = max(0, min(y_max, height))
+
+            boxes.append((i, [x_min, y_min, x_max, y_max], label))
+            logger.debug("Processed object %d: %s at %s", i + 1, label, bbox)
+
+    return boxes
+
+# Helper function to parse the model's bounding boxes and draw them onto the image
+def render_bounding_boxes(bbox_text, original_image, object_name):
+    # Extract JSON from the response
+    parsed_data = extract_bounding_box_json(bbox_text)
+
+    # Convert the boxes and draw them
+    width, height = original_image.size
+    boxes = compute_bounding_boxes(parsed_data, width, height, object_name)
+    return draw_bounding_boxes(original_image, boxes)
+
+# Helper function to build the bounding box response for an upload, shared by the sync and async modes
+def bounding_box_result(bbox_text, upload, object_name, prepared, cached, match):
+    result = render_bounding_boxes(bbox_text, upload.open_image(), object_name)
+    result['cached'] = cached
+    if match:
+        result['near_duplicate'] = {'distance': match['distance']}
+    result['preprocessing'] = prepared.summary()
+    return result
+
+# Helper function to draw (index, bbox, label) boxes onto the image and save it
+def draw_bounding_boxes(original_image, boxes):
+    # Process the parsed data
+    detected_objects = []
+
+    with stage('render'):
+        # Colors need an RGB image, e.g. for grayscale uploads
+        if original_image.mode not in ('RGB', 'RGBA'):
+            original_image = original_image.convert('RGB')
+
+        # Draw all the boxes and labels on the original image in one pass
+        draw_boxes(original_image, boxes, font_cache.get(20))
+
+        # Add to detected objects list
+        for _, bbox, label in boxes:
+            detected_objects.append({
+                'bbox': list(bbox),
+                'label': label
+            })
+
+    # Save the image with bounding boxes, it is encoded in the background
+    with stage('save'):
+        bbox_path = result_writer.save_image(original_image, 'bbox')
+
+    # Return the result
+    return {
+        'objects': detected_objects,
+        'count': len(detected_objects),
+        'image_path': bbox_path
+    }
+
 @app.route('/bounding_boxes_process', methods=['POST'])
 def bounding_boxes_process():
     # Check if API key is set and get client
@@ -518,191 +1305,533 @@ def bounding_boxes_process():
     file = request.files['image']
     object_name = request.form.get('object_name', 'object')
 
-    # Save the uploaded file
-    image_path = save_uploaded_file(file)
+    # Read the uploaded file once, it is saved to disk in the background
+    upload = ingest_uploaded_file(file)
 
-    if not image_path:
-        return jsonify({'error': 'Failed to save image'}), 400
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
 
-    # Read the image file
-    with open(image_path, "rb") as image_file:
-        image_data = image_file.read()
+    image_data = upload.data
+
+    # Downscale and re-encode the image before sending it to the model
+    prepared = prepare_upload(image_data, file.content_type)
 
     # Prepare the prompt
-    prompt = f"""Return bounding boxes for all {object_name}s in this image.
-    Format the response as a JSON array where each item has:
-    - 'box_2d' with coordinates [y_min, x_min, y_max, x_max] in the 0-1000 range (normalized coordinates)
-    - 'label' with the object type
-
-    Example format:
-    [
-      {{
-        "box_2d": [100, 200, 400, 500],
-        "label": "{object_name}"
-      }}
-    ]
-    """
+    prompt = build_bounding_box_prompt(object_name)
 
     try:
         # Call Gemini API to get bounding box
-        print(f"Using Gemini 2.0 Flash for bounding box detection of {object_name}")
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[prompt, types.Part.from_bytes(data=image_data, mime_type=file.content_type)]
-        )
-        print("Successfully processed bounding box request")
+        logger.debug("Using Gemini 2.0 Flash for bounding box detection of %s", object_name)
+        response_text, cached, match = generate_text_for_similar_image(client, 'bounding_boxes', "gemini-2.0-flash",
+                                                                       prompt, prepared, schema=BoundingBox)
+        logger.debug("Successfully processed bounding box request")
 
         # Extract bounding box coordinates
-        bbox_text = response.text.strip()
-        print(f"Raw response: {bbox_text}")
+        bbox_text = response_text.strip()
+        logger.debug("Raw response: %.2000s", bbox_text)
 
-        # Extract JSON from the response
+        # Parse the boxes and draw them onto the image
         try:
-            # First, try to find JSON between code blocks
-            if "```" in bbox_text:
-                parts = bbox_text.split("```")
-                for i, part in enumerate(parts):
-                    if i > 0 and i % 2 == 1:  # This is inside a code block
-                        # Remove language identifier if present
-                        if part.startswith("json\n"):
-                            part = part[5:]
-                        elif part.lower().startswith("json"):
-                            part = part[4:]
-                        # Try to parse this part
-                        try:
-                            parsed_data = json.loads(part.strip())
-                            print(f"Successfully parsed JSON from code block")
-                            break
-                        except json.JSONDecodeError:
-                            continue
-                else:  # No valid JSON found in code blocks
-                    raise ValueError("No valid JSON found in code blocks")
-            else:
-                # Try to extract JSON array directly
-                start_idx = bbox_text.find("[")
-                end_idx = bbox_text.rfind("]")
-                if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                    json_str = bbox_text[start_idx:end_idx+1].strip()
-                    parsed_data = json.loads(json_str)
-                    print(f"Successfully parsed JSON from direct extraction")
-                else:
-                    raise ValueError("No JSON array found in response")
+            return jsonify(bounding_box_result(bbox_text, upload, object_name, prepared, cached, match))
 
-            # Process the parsed data
-            detected_objects = []
+        except Exception as e:
+            logger.warning("Error processing bounding boxes: %s", e)
+            return jsonify({
+                'error': f'Failed to parse bounding box: {str(e)}',
+                'raw_response': bbox_text
+            }), 400
 
-            # Open the original image for drawing
-            original_image = Image.open(image_path)
-            width, height = original_image.size
-            draw = ImageDraw.Draw(original_image)
+    except Exception as e:
+        logger.exception("API error: %s", e)
+        return jsonify({'error': str(e)}), 500
 
-            # Prepare font for labels
-            try:
-                font = ImageFont.truetype("arial.ttf", 20)
-            except IOError:
-                font = ImageFont.load_default()
-
-            # Define colors for different objects
-            colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255)]
-
-            # Process each detected object
-            if isinstance(parsed_data, list):
-                for i, item in enumerate(parsed_data):
-                    # Get bounding box coordinates
-                    if isinstance(item, dict) and "box_2d" in item:
-                        bbox = item["box_2d"]
-                        label = item.get("label", object_name)
-                    elif isinstance(item, list) and len(item) == 4:
-                        # Direct coordinates
-                        bbox = item
-                        label = object_name
-                    else:
-                        continue  # Skip invalid items
-
-                    # Ensure we have 4 coordinates
-                    if len(bbox) != 4:
+@app.route('/bounding_boxes_stream', methods=['POST'])
+def bounding_boxes_stream():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+    object_name = request.form.get('object_name', 'object')
+    render = request.form.get('render', '1').lower() not in ('0', 'false', 'no', 'off')
+
+    # Read the uploaded file once, it is saved to disk in the background
+    upload = ingest_uploaded_file(file)
+
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
+
+    # Downscale and re-encode the image before sending it to the model
+    prepared = prepare_upload(upload.data, file.content_type)
+    prompt = build_bounding_box_prompt(object_name)
+    use_cache = response_cache_enabled('bounding_boxes')
+
+    def generate():
+        try:
+            chunks, cached = stream_text_for_image(client, 'bounding_boxes', "gemini-2.0-flash", prompt,
+                                                   prepared.data, prepared.mime_type, use_cache=use_cache,
+                                                   schema=BoundingBox)
+            width, height = prepared.original_size or upload.open_image().size
+
+            # Send each box as soon as its JSON element is complete
+            parser = JsonArrayStreamParser()
+            boxes = []
+            for chunk in chunks:
+                for element in parser.feed(chunk):
+                    item = validate_item(element, BoundingBox)
+                    if item is None:
                         continue
+                    for _, bbox, label in compute_bounding_boxes([item], width, height, object_name):
+                        boxes.append((len(boxes), bbox, label))
+                        yield format_sse({'object': {'bbox': bbox, 'label': label}, 'done': False})
+
+            # Draw all the boxes once the response is complete
+            result = {'objects': [{'bbox': bbox, 'label': label} for _, bbox, label in boxes],
+                      'count': len(boxes), 'image_path': None}
+            if render:
+                result = draw_bounding_boxes(upload.open_image(), boxes)
+            result['cached'] = cached
+            result['preprocessing'] = prepared.summary()
+            result['done'] = True
+            yield format_sse(result)
 
-                    # Extract coordinates
-                    # The model may return coordinates in the format [y_min, x_min, y_max, x_max] or [x_min, y_min, x_max, y_max]
-                    # Also, coordinates might be normalized (0-1) or in a 0-1000 range
-
-                    # First, convert all values to float to handle normalized coordinates
-                    y_min, x_min, y_max, x_max = map(float, bbox)
-
-                    # Check if coordinates are in 0-1 range (normalized)
-                    if all(0 <= coord <= 1 for coord in bbox):
-                        print(f"Detected normalized coordinates (0-1 range): {bbox}")
-                        # Already normalized, just multiply by dimensions
-                        x_min = int(x_min * width)
-                        y_min = int(y_min * height)
-                        x_max = int(x_max * width)
-                        y_max = int(y_max * height)
-                    # Check if coordinates are in 0-1000 range (as mentioned in llms.md)
-                    elif all(0 <= coord <= 1000 for coord in bbox):
-                        print(f"Detected normalized coordinates (0-1000 range): {bbox}")
-                        # Normalize by dividing by 1000 and then multiply by dimensions
-                        x_min = int((x_min / 1000) * width)
-                        y_min = int((y_min / 1000) * height)
-                        x_max = int((x_max / 1000) * width)
-                        y_max = int((y_max / 1000) * height)
-                    else:
-                        # Assume these are already pixel coordinates
-                        print(f"Detected pixel coordinates: {bbox}")
-                        x_min, y_min, x_max, y_max = map(int, bbox)
-
-                    # Ensure coordinates are within image bounds
-                    x_min = max(0, min(x_min, width))
-                    y_min = max(0, min(y_min, height))
-                    x_max = max(0, min(x_max, width))
-                    y_max = max(0, min(y_max, height))
-
-                    # Select color for this object
-                    color = colors[i % len(colors)]
-
-                    # Draw bounding box
-                    draw.rectangle([(x_min, y_min), (x_max, y_max)], outline=color, width=3)
-
-                    # Draw label with background
-                    text_bbox = draw.textbbox((x_min, y_min-25), label, font=font)
-                    draw.rectangle([text_bbox[0]-5, text_bbox[1]-5, text_bbox[2]+5, text_bbox[3]+5], fill=color)
-                    draw.text((x_min, y_min-25), label, fill="white", font=font)
-
-                    # Add to detected objects list
-                    detected_objects.append({
-                        'bbox': [x_min, y_min, x_max, y_max],
-                        'label': label
-                    })
-
-                    print(f"Processed object {i+1}: {label} at {bbox}")
-
-            # Save the image with bounding boxes
-            bbox_filename = f"bbox_{os.urandom(4).hex()}.png"
-            bbox_path = os.path.join(app.config['RESULTS_FOLDER'], bbox_filename)
-            original_image.save(bbox_path)
-
-            # Return the result
-            return jsonify({
-                'objects': detected_objects,
-                'count': len(detected_objects),
-                'image_path': os.path.join('static', 'results', bbox_filename)
+        except Exception as e:
+            logger.exception("Bounding box streaming error: %s", e)
+            yield format_sse({'error': str(e), 'done': True})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+@app.route('/bounding_boxes_batch', methods=['POST'])
+def bounding_boxes_batch():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    # One or more object types, comma separated or as repeated fields
+    object_names = []
+    for value in request.form.getlist('object_names') or request.form.getlist('object_name'):
+        object_names.extend(name.strip() for name in value.split(',') if name.strip())
+    if not object_names:
+        object_names = ['object']
+
+    # render=0 returns only the coordinates, preprocess=0 sends the original bytes
+    render = request.form.get('render', '1').lower() not in ('0', 'false', 'no', 'off')
+    preprocess = request.form.get('preprocess', '1').lower() not in ('0', 'false', 'no', 'off')
+    use_cache = response_cache_enabled('bounding_boxes')
+    coalesce = coalescing_enabled('bounding_boxes')
+    max_images = app.config['BATCH_MAX_IMAGES']
+
+    # Collect images from multipart files and/or a zip or tar archive
+    uploads = []
+    try:
+        for file in request.files.getlist('images'):
+            upload = ingest_uploaded_file(file)
+            if upload:
+                uploads.append(upload)
+        archive = request.files.get('archive')
+        if archive:
+            for name, data in iter_archive_images(archive.stream, archive.filename):
+                uploads.append(upload_store.ingest_bytes(data, name))
+                if len(uploads) > max_images:
+                    break
+    except Exception as e:
+        return jsonify({'error': f'Failed to read archive: {str(e)}'}), 400
+
+    if not uploads:
+        return jsonify({'error': 'No images uploaded'}), 400
+    if len(uploads) > max_images:
+        return jsonify({'error': f'Too many images, the limit is {max_images} per batch'}), 413
+
+    # The same prompt is used for every image
+    label = ', '.join(object_names)
+    prompt = build_bounding_box_prompt(object_names)
+
+    # Runs on the batch model pool
+    def detect(index, upload):
+        prepared = prepare_upload(upload.data, upload.mime_type, requested=preprocess)
+        # Queued behind interactive requests when the quota is tight
+        with call_priority('batch'):
+            response_text, cached = generate_text_for_image(client, 'bounding_boxes', "gemini-2.0-flash", prompt,
+                                                            prepared.data, prepared.mime_type, use_cache=use_cache,
+                                                            coalesce=coalesce, schema=BoundingBox)
+        return prepared, response_text.strip(), cached
+
+    # Runs on the batch render pool
+    def finish(index, upload, detected):
+        prepared, bbox_text, cached = detected
+        if render:
+            result = render_bounding_boxes(bbox_text, upload.open_image(), label)
+        else:
+            # Coordinates only, no need to decode the full image
+            if prepared.original_size:
+                width, height = prepared.original_size
+            else:
+                width, height = upload.open_image().size
+            boxes = compute_bounding_boxes(extract_bounding_box_json(bbox_text), width, height, label)
+            result = {
+                'objects': [{'bbox': bbox, 'label': box_label} for _, bbox, box_label in boxes],
+                'count': len(boxes),
+                'image_path': None
+            }
+        result['index'] = index
+        result['filename'] = upload.filename
+        result['cached'] = cached
+        return result
+
+    def generate():
+        start = time.perf_counter()
+        failed = 0
+        # One JSON object per line, in the order the images finish
+        for result in batch_runner.run(enumerate(uploads), detect, finish):
+            if 'error' in result:
+                failed += 1
+                result['filename'] = uploads[result['index']].filename
+            yield json.dumps(result) + "\n"
+        yield json.dumps({
+            'done': True,
+            'images': len(uploads),
+            'failed': failed,
+            'seconds': round(time.perf_counter() - start, 3)
+        }) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/bounding_boxes_tiled', methods=['POST'])
+def bounding_boxes_tiled():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+    object_names = [name.strip() for name in request.form.get('object_name', 'object').split(',') if name.strip()]
+    if not object_names:
+        object_names = ['object']
+    label = ', '.join(object_names)
+    tile_size = request.form.get('tile_size', app.config['TILED_TILE_SIZE'], type=int)
+    overlap = request.form.get('overlap', app.config['TILED_OVERLAP'], type=int)
+    render = request.form.get('render', '1').lower() not in ('0', 'false', 'no', 'off')
+    use_cache = response_cache_enabled('bounding_boxes')
+    coalesce = coalescing_enabled('bounding_boxes')
+
+    if tile_size < 64 or not 0 <= overlap < tile_size // 2:
+        return jsonify({'error': 'tile_size must be at least 64 and overlap less than half of it'}), 400
+    # Each tile is decoded, cropped and encoded whole, so a huge tile_size would defeat tiling
+    if tile_size > app.config['TILED_MAX_TILE_SIZE']:
+        return jsonify({'error': f"tile_size must be at most {app.config['TILED_MAX_TILE_SIZE']}"}), 400
+
+    # Read the uploaded file once, it is saved to disk in the background
+    upload = ingest_uploaded_file(file)
+
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
+
+    # Decode once, every tile is cut from the same pixels; only this route goes past Pillow's size limit
+    try:
+        # Large uploads are decoded from their spooled file rather than read into memory first
+        with stage('preprocess'), upload.open() as stream:
+            image = open_large_image(stream, app.config['TILED_MAX_IMAGE_PIXELS'])
+            image.load()
+            # Tiles are cut from the upright image, as the results are reported
+            ImageOps.exif_transpose(image, in_place=True)
+    except Image.DecompressionBombError:
+        return jsonify({'error': f"The image is larger than {app.config['TILED_MAX_IMAGE_PIXELS']} pixels"}), 413
+    except OSError as e:
+        return jsonify({'error': f'Failed to read image: {str(e)}'}), 400
+
+    width, height = image.size
+    tiles = plan_tiles(width, height, tile_size, overlap)
+    if len(tiles) > app.config['TILED_MAX_TILES']:
+        return jsonify({'error': f"The image needs {len(tiles)} tiles, the limit is {app.config['TILED_MAX_TILES']}"}), 413
+    prompt = build_bounding_box_prompt(object_names)
+    quality = app.config['PREPROCESS_QUALITY']
+
+    # Runs on the batch model pool, at most BATCH_CONCURRENCY tiles are encoded and in flight at once
+    def detect(index, tile):
+        with stage('preprocess'):
+            tile_data = encode_tile(image, tile, quality)
+        # Queued behind interactive requests when the quota is tight
+        with call_priority('batch'):
+            response_text, cached = generate_text_for_image(client, 'bounding_boxes', "gemini-2.0-flash", prompt,
+                                                            tile_data, 'image/jpeg', use_cache=use_cache,
+                                                            coalesce=coalesce, schema=BoundingBox)
+        return response_text, cached
+
+    # Runs on the batch render pool: the tile's boxes in pixel coordinates of the whole image
+    def finish(index, tile, detected):
+        response_text, cached = detected
+        left, top, right, bottom = tile
+        boxes = compute_bounding_boxes(extract_bounding_box_json(response_text), right - left, bottom - top, label)
+        return {
+            'index': index,
+            'tile': list(tile),
+            'objects': [{'bbox': [x_min + left, y_min + top, x_max + left, y_max + top], 'label': box_label}
+                        for _, (x_min, y_min, x_max, y_max), box_label in boxes],
+            'cached': cached,
+        }
+
+    def generate():
+        start = time.perf_counter()
+        found, found_tiles = [], []
+        failed = 0
+        try:
+            # One JSON object per line with each tile's boxes as soon as it is done, duplicates across seams
+            # are merged in the last line
+            for result in batch_runner.run(enumerate(tiles), detect, finish):
+                if 'error' in result:
+                    failed += 1
+                    result['tile'] = list(tiles[result['index']])
+                else:
+                    found.extend(result['objects'])
+                    found_tiles.extend([result['tile']] * len(result['objects']))
+                yield json.dumps(result) + "\n"
+
+            with stage('nms'):
+                merged = merge_detections([obj['bbox'] for obj in found], [obj['label'] for obj in found],
+                                          found_tiles, width, height, app.config['TILED_NMS_THRESHOLD'])
+                objects = [{'bbox': box, 'label': box_label} for box, box_label in merged]
+
+            result = {'objects': objects, 'count': len(objects), 'image_path': None}
+            if render:
+                # Drawn on a downscaled copy, the coordinates stay those of the full image
+                with stage('render'):
+                    preview, factor = preview_image(image, app.config['TILED_PREVIEW_MAX_EDGE'])
+                scaled = [(i, [int(coord * factor) for coord in obj['bbox']], obj['label'])
+                          for i, obj in enumerate(objects)]
+                result['image_path'] = draw_bounding_boxes(preview, scaled)['image_path']
+            result.update({
+                'done': True,
+                'size': [width, height],
+                'tiles': len(tiles),
+                'failed_tiles': failed,
+                'seconds': round(time.perf_counter() - start, 3),
+                'preprocessing': {'tile_size': tile_size, 'overlap': overlap, 'original_bytes': upload.size},
             })
+            yield json.dumps(result) + "\n"
 
         except Exception as e:
-            print(f"Error processing bounding boxes: {str(e)}")
-            return jsonify({
-                'error': f'Failed to parse bounding box: {str(e)}',
-                'raw_response': bbox_text
-            }), 400
+            logger.exception("Tiled detection error: %s", e)
+            yield json.dumps({'error': str(e), 'done': True}) + "\n"
 
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/frames_process', methods=['POST'])
+def frames_process():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    if 'video' not in request.files:
+        return jsonify({'error': 'No video or frames uploaded'}), 400
+
+    file = request.files['video']
+    # task=bounding_boxes finds object_name in each frame, task=image_qa answers question about it
+    task = request.form.get('task', 'bounding_boxes')
+    if task not in ('bounding_boxes', 'image_qa'):
+        return jsonify({'error': 'task must be bounding_boxes or image_qa'}), 400
+    if task == 'bounding_boxes':
+        object_names = [name.strip() for name in request.form.get('object_name', 'object').split(',') if name.strip()]
+        if not object_names:
+            object_names = ['object']
+        label = ', '.join(object_names)
+        prompt = build_bounding_box_prompt(object_names)
+    else:
+        prompt = request.form.get('question', 'What is in this image?')
+    hash_threshold = request.form.get('hash_threshold', type=int)
+    max_gap = request.form.get('max_gap', type=int)
+    use_cache = response_cache_enabled(task)
+    coalesce = coalescing_enabled(task)
+
+    # Frames are decoded one at a time straight from the upload, the file is never read whole
+    frames = iter_frames(file.stream, file.filename)
+    try:
+        first = next(frames, None)
     except Exception as e:
-        print(f"API error: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return jsonify({'error': f'Failed to read frames: {str(e)}'}), 400
+    if first is None:
+        return jsonify({'error': 'No frames found'}), 400
+    frames = itertools.chain([first], itertools.islice(frames, app.config['FRAMES_MAX_FRAMES'] - 1))
+
+    # Frames read but not sent back yet, in order, with the kept frame each repeats (same_as) if it was skipped
+    entries = collections.deque()
+    counts = {'frames': 0, 'processed': 0}
+    read_error = []
+
+    def kept_frames():
+        try:
+            for index, name, seconds, image, reference, distance in frame_sampler.sample(frames, hash_threshold,
+                                                                                          max_gap):
+                entries.append({'frame': index, 'name': name, 'time': seconds, 'same_as': reference,
+                                'distance': distance})
+                counts['frames'] += 1
+                if reference is None:
+                    counts['processed'] += 1
+                    # Encoded now, an animated image reuses the same frame object for the next frame
+                    with stage('preprocess'):
+                        data, _ = encode_frame(image, app.config['PREPROCESS_MAX_EDGE'],
+                                               app.config['PREPROCESS_QUALITY'])
+                    yield index, (data, image.size)
+        except Exception as e:
+            # Keep what was read so far, e.g. a truncated video
+            logger.warning("Stopped reading frames: %s", e)
+            read_error.append(str(e))
+
+    # Runs on the batch model pool; the next frame is only read when a call finishes, so at most
+    # BATCH_CONCURRENCY encoded frames are held at once
+    def detect(index, frame):
+        data = frame[0]
+        # Queued behind interactive requests when the quota is tight
+        with call_priority('batch'):
+            return generate_text_for_image(client, task, "gemini-2.0-flash", prompt, data, 'image/jpeg',
+                                           use_cache=use_cache, coalesce=coalesce,
+                                           schema=BoundingBox if task == 'bounding_boxes' else None)
+
+    # Runs on the batch render pool
+    def finish(index, frame, detected):
+        response_text, cached = detected
+        if task == 'image_qa':
+            return {'index': index, 'answer': response_text, 'cached': cached}
+        _, (width, height) = frame
+        boxes = compute_bounding_boxes(extract_bounding_box_json(response_text), width, height, label)
+        return {
+            'index': index,
+            'objects': [{'bbox': bbox, 'label': box_label} for _, bbox, box_label in boxes],
+            'count': len(boxes),
+            'cached': cached,
+        }
+
+    def generate():
+        start = time.perf_counter()
+        # Results of kept frames that frames still to be sent back may repeat
+        results = {}
+        failed = 0
+
+        def ready():
+            # One JSON object per line and per frame, in frame order; a skipped frame goes out with the
+            # result of the frame it repeats as soon as that one is done
+            while entries:
+                entry = entries[0]
+                kept = entry['same_as'] is None
+                found = results.get(entry['frame'] if kept else entry['same_as'])
+                if found is None:
+                    return
+                if kept:
+                    # Later frames can only repeat this one, not any before it
+                    for index in [index for index in results if index < entry['frame']]:
+                        del results[index]
+                yield json.dumps(dict(entries.popleft(), **found)) + "\n"
+
+        try:
+            for result in batch_runner.run(kept_frames(), detect, finish):
+                index = result.pop('index')
+                if 'error' in result:
+                    failed += 1
+                results[index] = result
+                yield from ready()
+            yield from ready()
+
+            summary = {
+                'done': True,
+                'frames': counts['frames'],
+                'processed': counts['processed'],
+                'skipped': counts['frames'] - counts['processed'],
+                'failed': failed,
+                'seconds': round(time.perf_counter() - start, 3),
+            }
+            if read_error:
+                summary['error'] = f'Stopped reading frames: {read_error[0]}'
+            yield json.dumps(summary) + "\n"
+
+        except Exception as e:
+            logger.exception("Frame sequence error: %s", e)
+            yield json.dumps({'error': str(e), 'done': True}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 @app.route('/image_segmentation')
 def image_segmentation():
     return render_template('image_segmentation.html')
 
+# Prompt for image segmentation
+# (the JSON format is given by the SegmentMask response schema)
+SEGMENTATION_PROMPT = "Give the segmentation masks for the objects in the image."
+
+# Helper function to convert a segment's box_2d to pixel coordinates, None if it has no usable box
+def segmentation_box(segment, width, height):
+    y_min, x_min, y_max, x_max = (max(0, min(coord, 1000)) / 1000 for coord in segment.box_2d)
+    left, top = int(x_min * width), int(y_min * height)
+    right, bottom = int(round(x_max * width)), int(round(y_max * height))
+    if right <= left or bottom <= top:
+        return None
+    return left, top, right, bottom
+
+# Helper function to parse the model's segmentation masks and place them on the image
+def render_segmentation_masks(response_text, original_image, crops=True, render=True):
+    # Log the raw JSON response
+    logger.debug("Raw JSON response: %.2000s", response_text)
+
+    # Parse the JSON straight into SegmentMask objects
+    with stage('json_extract'):
+        mask_data = parse_items(response_text, SegmentMask)
+
+    # Decode every mask once, placed on the box the model gave for it
+    width, height = original_image.size
+    masks = MaskStack([], original_image.size)
+    for mask_info in mask_data:
+        masks.append(decode_mask(mask_info.mask), segmentation_box(mask_info, width, height))
+
+    result = {'segments': [], 'composite_path': None}
+    base = rgb_array(original_image) if render else None
+    if render:
+        result['composite_path'] = save_segmentation_composite(base, masks)
+
+    for i, mask_info in enumerate(mask_data):
+        result['segments'].append(describe_segment(masks, i, mask_info, base if crops else None))
+
+    return result
+
+# Helper function to build the segmentation response for an upload, shared by the sync and async modes
+def segmentation_result(response_text, upload, prepared, cached, crops=True, render=True):
+    result = render_segmentation_masks(response_text, upload.open_image(), crops=crops, render=render)
+    result['raw_response'] = response_text
+    result['cached'] = cached
+    result['preprocessing'] = prepared.summary()
+    return result
+
+# Helper function to blend all the masks over the image in a single pass and save one combined image
+def save_segmentation_composite(base, masks):
+    with stage('render'):
+        composite = Image.fromarray(composite_masks(base, masks, segment_colors(len(masks))))
+    with stage('save'):
+        return result_writer.save_image(composite, 'segments')
+
+# Helper function to build the compact per-object data for one mask, saving a crop when base is given
+def describe_segment(masks, i, mask_info, base=None):
+    # Enough for clients to draw the overlay themselves
+    bounds, mask = masks.extract(i)
+    segment = {'label': mask_info.label or f'Object {i+1}', 'bbox': None, 'area': 0,
+               'mask_rle': None, 'image_path': None}
+    if bounds is not None:
+        segment['bbox'] = list(bounds)
+        segment['mask_rle'], segment['area'] = encode_rle(mask)
+
+        # Optionally save a crop around the segment
+        if base is not None:
+            with stage('render'):
+                crop = Image.fromarray(composite_crop(base, mask, segment_color(i), bounds))
+            with stage('save'):
+                segment['image_path'] = result_writer.save_image(crop, f'segment_{i}')
+    return segment
+
 @app.route('/image_segmentation_process', methods=['POST'])
 def image_segmentation_process():
     # Check if API key is set and get client
@@ -715,112 +1844,97 @@ def image_segmentation_process():
 
     file = request.files['image']
 
-    # Save the uploaded file
-    image_path = save_uploaded_file(file)
+    # Read the uploaded file once, it is saved to disk in the background
+    upload = ingest_uploaded_file(file)
 
-    if not image_path:
-        return jsonify({'error': 'Failed to save image'}), 400
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
 
-    # Read the image file
-    with open(image_path, "rb") as image_file:
-        image_data = image_file.read()
+    image_data = upload.data
 
-    # Open the image for processing results later
-    original_image = Image.open(image_path)
+    # Downscale and re-encode the image before sending it to the model
+    prepared = prepare_upload(image_data, file.content_type)
+
+    # segment_crops=0 returns only the combined image, render=0 only the per-object data
+    crops = request.form.get('segment_crops', '1').lower() not in ('0', 'false', 'no', 'off')
+    render = request.form.get('render', '1').lower() not in ('0', 'false', 'no', 'off')
 
     # Prepare the prompt for image segmentation
-    prompt = """
-    Give the segmentation masks for objects in the image.
-    Output a JSON list of segmentation masks where each entry contains:
-    1. The 2D bounding box in the key "box_2d" with coordinates [y_min, x_min, y_max, x_max] in the 0-1000 range
-    2. The segmentation mask in key "mask" as a base64-encoded PNG image
-    3. The text label in the key "label" with a descriptive name of the object
-
-    Example format:
-    [
-      {
-        "box_2d": [100, 200, 400, 500],
-        "mask": "base64-encoded-png-data",
-        "label": "person"
-      }
-    ]
-    """
+    prompt = SEGMENTATION_PROMPT
 
     try:
         # Call Gemini API for segmentation using the gemini-2.5-pro-exp-03-25 model
-        print("Using Gemini 2.5 Pro Exp for image segmentation")
-        response = client.models.generate_content(
-            model="gemini-2.5-pro-exp-03-25",
-            contents=[prompt, types.Part.from_bytes(data=image_data, mime_type=file.content_type)]
-        )
-        print("Successfully processed image segmentation request")
-
-        # Extract JSON from response
-        response_text = response.text
-        if "```json" in response_text:
-            json_str = response_text.split("```json")[1].split("```")[0].strip()
-        elif "[" in response_text and "]" in response_text:
-            start = response_text.find("[")
-            end = response_text.rfind("]") + 1
-            json_str = response_text[start:end]
-        else:
-            json_str = response_text
-
-        # Log the raw JSON response
-        print(f"Raw JSON response: {json_str}")
-
-        # Parse JSON data
-        mask_data = json.loads(json_str)
-
-        # Process each mask
-        result_images = []
-
-        for i, mask_info in enumerate(mask_data):
-            # Extract base64 encoded mask
-            mask_base64 = mask_info.get("mask", "")
-            if "base64," in mask_base64:
-                mask_base64 = mask_base64.split("base64,")[1]
-
-            # Decode and load the mask image
-            mask_bytes = base64.b64decode(mask_base64)
-            mask_image = Image.open(BytesIO(mask_bytes))
+        logger.debug("Using Gemini 2.5 Pro Exp for image segmentation")
+        response_text, cached = generate_text_for_image(client, 'image_segmentation', "gemini-2.5-pro-exp-03-25",
+                                                        prompt, prepared.data, prepared.mime_type,
+                                                        schema=SegmentMask)
+        logger.debug("Successfully processed image segmentation request")
+
+        # Overlay the masks on the original image
+        return jsonify(segmentation_result(response_text, upload, prepared, cached, crops=crops, render=render))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-            # Convert images to RGBA
-            original_rgba = original_image.convert("RGBA")
-            mask_image = mask_image.convert("L")  # Convert mask to grayscale
+@app.route('/image_segmentation_stream', methods=['POST'])
+def image_segmentation_stream():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
 
-            # Create a bright colored overlay (different color for each mask)
-            colors = [(255, 0, 0, 128), (0, 255, 0, 128), (0, 0, 255, 128),
-                     (255, 255, 0, 128), (255, 0, 255, 128), (0, 255, 255, 128)]
-            color = colors[i % len(colors)]
-            overlay = Image.new("RGBA", mask_image.size, color)
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
 
-            # Use the mask to determine where to apply the color
-            overlay.putalpha(mask_image)
+    file = request.files['image']
+    crops = request.form.get('segment_crops', '1').lower() not in ('0', 'false', 'no', 'off')
+    render = request.form.get('render', '1').lower() not in ('0', 'false', 'no', 'off')
 
-            # Resize the overlay to match the original image if needed
-            if overlay.size != original_rgba.size:
-                overlay = overlay.resize(original_rgba.size)
+    # Read the uploaded file once, it is saved to disk in the background
+    upload = ingest_uploaded_file(file)
 
-            # Overlay the colored mask on the original image
-            result = Image.alpha_composite(original_rgba, overlay)
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
 
-            # Save the result
-            result_filename = f"segment_{i}_{os.urandom(4).hex()}.png"
-            result_path = os.path.join(app.config['RESULTS_FOLDER'], result_filename)
-            result.save(result_path)
+    # Downscale and re-encode the image before sending it to the model
+    prepared = prepare_upload(upload.data, file.content_type)
+    use_cache = response_cache_enabled('image_segmentation')
 
-            result_images.append({
-                'label': mask_info.get('label', f'Object {i+1}'),
-                'image_path': os.path.join('static', 'results', result_filename)
+    def generate():
+        try:
+            chunks, cached = stream_text_for_image(client, 'image_segmentation', "gemini-2.5-pro-exp-03-25",
+                                                   SEGMENTATION_PROMPT, prepared.data, prepared.mime_type,
+                                                   use_cache=use_cache, schema=SegmentMask)
+            original_image = upload.open_image()
+            width, height = original_image.size
+            base = rgb_array(original_image) if render else None
+
+            # Decode each mask and send its segment as soon as its JSON element is complete,
+            # the base64 text is dropped right after
+            parser = JsonArrayStreamParser()
+            masks = MaskStack([], original_image.size)
+            for chunk in chunks:
+                for element in parser.feed(chunk):
+                    mask_info = validate_item(element, SegmentMask)
+                    if mask_info is None:
+                        continue
+                    i = masks.append(decode_mask(mask_info.mask), segmentation_box(mask_info, width, height))
+                    segment = describe_segment(masks, i, mask_info, base if crops else None)
+                    yield format_sse({'segment': segment, 'done': False})
+
+            # Blend all the masks once the response is complete
+            yield format_sse({
+                'done': True,
+                'count': len(masks),
+                'composite_path': save_segmentation_composite(base, masks) if render else None,
+                'cached': cached,
+                'preprocessing': prepared.summary()
             })
 
-        return jsonify({
-            'segments': result_images,
-            'raw_response': response_text
-        })
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        except Exception as e:
+            logger.exception("Segmentation streaming error: %s", e)
+            yield format_sse({'error': str(e), 'done': True})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
 @app.route('/text_demos')
 def text_demos():
@@ -845,10 +1959,17 @@ def text_generation_process():
     if not prompt:
         return jsonify({'error': 'No prompt provided'}), 400
 
+    # stream=true sends the output as server-sent events while it is generated
+    stream = bool(data.get('stream'))
+
     try:
         # Handle different demo types
         if demo_type == 'simple':
             # Simple text generation
+            if stream:
+                chunks = client.models.generate_content_stream(model="gemini-2.0-flash", contents=prompt)
+                return text_stream_response(text_streams.start(stream_chunks(chunks)))
+
             response = client.models.generate_content(
                 model="gemini-2.0-flash",
                 contents=prompt
@@ -861,28 +1982,35 @@ def text_generation_process():
             if not system_instruction:
                 return jsonify({'error': 'No system instruction provided'}), 400
 
-            # Create a chat with system instruction
-            chat = client.models.start_chat(
-                model="gemini-2.0-flash",
-                system_instruction=system_instruction
-            )
+            # Continue the conversation when the page sends back its session id
+            api_key = session.get(API_KEY_SESSION_KEY)
+            chat = chat_sessions.get(data['session_id'], api_key) if data.get('session_id') else None
+            if chat is None or chat.system_instruction != system_instruction:
+                # Create a chat with system instruction
+                chat = chat_sessions.create(client, api_key, system_instruction)
 
             # Send the user prompt
-            response = chat.send_message(prompt)
-            return jsonify({'text': response.text})
+            return send_chat_message(chat, prompt, stream=stream)
 
         elif demo_type == 'reasoning':
             # Reasoning models
             # First, get the reasoning trace
-            response_with_trace = client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=f"""
+            reasoning_prompt = f"""
                 I need you to solve this problem step by step, showing your reasoning:
                 {prompt}
 
                 First, explain your thought process in detail.
-                Then, provide the final answer.
+                Then, provide the final answer, starting it with "Final answer:".
                 """
+
+            if stream:
+                # Reasoning and answer go out on separate channels
+                chunks = client.models.generate_content_stream(model="gemini-2.0-flash", contents=reasoning_prompt)
+                return text_stream_response(text_streams.start(split_reasoning_stream(stream_chunks(chunks))))
+
+            response_with_trace = client.models.generate_content(
+                model="gemini-2.0-flash",
+                contents=reasoning_prompt
             )
 
             # Extract reasoning and final answer
@@ -906,75 +2034,36 @@ def text_generation_process():
             })
 
         elif demo_type == 'structured':
-            # Structured output using Pydantic
-            # Define the prompt for structured data
-            structured_prompt = f"""
-            Generate structured data for cats based on this request: {prompt}
-
-            The response should be a JSON array where each item has:
-            - 'name': The cat's name
-            - 'color': The cat's fur color
-            - 'special_ability': The cat's unique special ability
-
-            Example format:
-            [
-              {{
-                \"name\": \"Whiskers\",
-                \"color\": \"Orange Tabby\",
-                \"special_ability\": \"Can find hidden treats anywhere\"
-              }}
-            ]
-
-            Return ONLY the JSON array, nothing else.
-            """
+            # Structured output: the Cat schema constrains the response to a bare JSON array
+            structured_prompt = f"Generate structured data for cats based on this request: {prompt}"
+            config = json_config(Cat)
+
+            if stream:
+                # Each cat is sent as soon as its JSON object is complete
+                chunks = client.models.generate_content_stream(model="gemini-2.0-flash", contents=structured_prompt,
+                                                               config=config)
+                return text_stream_response(text_streams.start(stream_json_array(stream_chunks(chunks), 'cat', Cat)))
 
             # Generate the structured data
             response = client.models.generate_content(
                 model="gemini-2.0-flash",
-                contents=structured_prompt
+                contents=structured_prompt,
+                config=config
             )
 
-            # Extract JSON from the response
-            response_text = response.text
-
-            # Try to find JSON between code blocks
-            if "```json" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                # Try any code block
-                parts = response_text.split("```")
-                for i, part in enumerate(parts):
-                    if i > 0 and i % 2 == 1:  # Inside a code block
-                        json_str = part.strip()
-                        if json_str.startswith("json"):
-                            json_str = json_str[4:].strip()
-                        break
-                else:
-                    # No valid code block found
-                    json_str = response_text
-            else:
-                # Try to extract JSON array directly
-                start_idx = response_text.find("[")
-                end_idx = response_text.rfind("]")
-                if start_idx != -1 and end_idx != -1:
-                    json_str = response_text[start_idx:end_idx+1]
-                else:
-                    json_str = response_text
-
-            # Parse the JSON data
+            # Parse and validate the JSON into Cat objects in one pass
             try:
-                structured_data = json.loads(json_str)
-                # Validate with Pydantic (optional)
-                # cats = [Cat(**cat_data) for cat_data in structured_data]
-                return jsonify({'structured': structured_data})
-            except json.JSONDecodeError:
-                return jsonify({'structured': json_str, 'error': 'Could not parse JSON'})
+                with stage('json_extract'):
+                    cats = parse_items(response.text, Cat)
+                return jsonify({'structured': [cat.model_dump() for cat in cats]})
+            except ValueError:
+                return jsonify({'structured': response.text, 'error': 'Could not parse JSON'})
 
         else:
             return jsonify({'error': f'Unknown demo type: {demo_type}'}), 400
 
     except Exception as e:
-        print(f"Error in text generation: {str(e)}")
+        logger.exception("Error in text generation: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/text_streaming_process')
@@ -984,37 +2073,194 @@ def text_streaming_process():
     if not client:
         return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
 
+    # A reconnecting EventSource sends the id of the last event it received
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id:
+        stream_id, _, last_seq = last_event_id.partition(':')
+        stream = text_streams.get(stream_id)
+        if stream is None or not last_seq.isdigit():
+            # Don't start the generation over, the client already has part of it
+            return Response(format_sse({'error': 'Stream expired', 'done': True}), mimetype='text/event-stream')
+        logger.info("Resuming stream %s after event %s", stream_id, last_seq)
+        return text_stream_response(stream, int(last_seq))
+
     prompt = request.args.get('prompt', '')
     if not prompt:
         return jsonify({'error': 'No prompt provided'}), 400
 
+    # Generate content with streaming, the model call runs on a stream worker so it can outlive a dropped connection
+    chunks = client.models.generate_content_stream(model="gemini-2.0-flash", contents=prompt)
+    return text_stream_response(text_streams.start(stream_chunks(chunks)))
+
+# Helper function to turn streamed model responses into (text, output tokens so far) pairs
+def stream_chunks(responses):
+    for chunk in responses:
+        usage = chunk.usage_metadata
+        yield chunk.text, usage.candidates_token_count if usage else None
+
+# Helper function to label streamed reasoning text, everything after the marker is the answer
+def split_reasoning_stream(chunks, marker='Final answer:'):
+    channel = 'reasoning'
+    pending = ''
+    for text, tokens in chunks:
+        if channel == 'answer':
+            yield {'channel': 'answer', 'text': text}, tokens
+            continue
+
+        pending += text or ''
+        index = pending.find(marker)
+        if index != -1:
+            # Switch channels at the marker
+            if pending[:index].strip():
+                yield {'channel': 'reasoning', 'text': pending[:index]}, tokens
+            channel = 'answer'
+            answer = pending[index + len(marker):].lstrip()
+            if answer:
+                yield {'channel': 'answer', 'text': answer}, tokens
+            pending = ''
+        elif len(pending) >= len(marker):
+            # Hold back just enough text to spot a marker split across chunks
+            keep = len(marker) - 1
+            yield {'channel': 'reasoning', 'text': pending[:-keep]}, tokens
+            pending = pending[-keep:]
+
+    if pending:
+        yield {'channel': channel, 'text': pending}, None
+
+# Helper function to send each element of a streamed JSON array as soon as it is complete and matches the schema
+def stream_json_array(chunks, key, item_model):
+    parser = JsonArrayStreamParser()
+    for text, tokens in chunks:
+        for element in parser.feed(text or ''):
+            item = validate_item(element, item_model)
+            if item is not None:
+                yield {key: item.model_dump()}, tokens
+
+# Helper function to send a text stream's events, with heartbeats while the model is quiet
+def text_stream_response(stream, after_seq=-1):
     def generate():
-        try:
-            # Generate content with streaming
-            response = client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=prompt,
-                stream=True
-            )
+        # Tell the browser how soon to reconnect if the connection drops
+        yield "retry: 1000\n\n"
+        for event in text_streams.events(stream, after_seq, heartbeat=app.config['STREAM_HEARTBEAT_SECONDS']):
+            if event is None:
+                yield ": heartbeat\n\n"
+                continue
+            event_id, data = event
+            yield format_sse(data, event_id)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    # Stop proxies from buffering the stream
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/chat_sessions', methods=['POST'])
+def create_chat_session():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    # JSON for text-only chats, multipart to talk about an image
+    data = request.get_json(silent=True) or request.form
+    system_instruction = data.get('system_instruction', '')
 
-            # Stream the response chunks
-            for chunk in response:
-                if hasattr(chunk, 'text'):
-                    # Send each chunk as a server-sent event
-                    data = json.dumps({'text': chunk.text, 'done': False})
-                    yield f"data: {data}\n\n"
-                    # Small delay to make streaming visible
-                    time.sleep(0.05)
+    prefix_parts = []
+    prefix_tokens = 0
+    upload = ingest_uploaded_file(request.files.get('image'))
+    if upload:
+        prepared = prepare_upload(upload.data, upload.mime_type)
+        prefix_parts.append(types.Part.from_bytes(data=prepared.data, mime_type=prepared.mime_type))
+        prefix_tokens = estimate_image_tokens(prepared.sent_size)
 
-            # Send completion event
-            yield f"data: {json.dumps({'done': True})}\n\n"
+    chat = chat_sessions.create(client, session.get(API_KEY_SESSION_KEY), system_instruction,
+                                prefix_parts, prefix_tokens)
+    return jsonify(chat.to_dict()), 201
 
+@app.route('/chat_sessions/<session_id>', methods=['GET', 'DELETE'])
+def chat_session(session_id):
+    api_key = session.get(API_KEY_SESSION_KEY)
+    if request.method == 'DELETE':
+        if not chat_sessions.delete(session_id, api_key):
+            return jsonify({'error': 'Chat not found'}), 404
+        return jsonify({'deleted': session_id})
+
+    chat = chat_sessions.get(session_id, api_key)
+    if chat is None:
+        return jsonify({'error': 'Chat not found'}), 404
+    return jsonify(chat.to_dict())
+
+@app.route('/chat_sessions/<session_id>/messages', methods=['POST'])
+def chat_session_message(session_id):
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    chat = chat_sessions.get(session_id, session.get(API_KEY_SESSION_KEY))
+    if chat is None:
+        return jsonify({'error': 'Chat not found'}), 404
+
+    data = request.get_json(silent=True) or {}
+    message = data.get('message', '')
+    if not message:
+        return jsonify({'error': 'No message provided'}), 400
+    return send_chat_message(chat, message, stream=bool(data.get('stream')))
+
+# Helper function to send the next message of a chat session, as JSON or server-sent events
+def send_chat_message(chat, message, stream=False):
+    try:
+        contents, config = chat_sessions.begin_turn(chat, message)
+    except ChatSessionBusy as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        logger.exception("Error preparing chat turn: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+    if stream:
+        try:
+            responses = chat.client.models.generate_content_stream(model=chat.model, contents=contents, config=config)
         except Exception as e:
-            print(f"Streaming error: {str(e)}")
-            error_data = json.dumps({'error': str(e), 'done': True})
-            yield f"data: {error_data}\n\n"
+            chat_sessions.abort_turn(chat)
+            logger.exception("Error in chat: %s", e)
+            return jsonify({'error': str(e)}), 500
+        response = text_stream_response(text_streams.start(chat_turn_chunks(chat, message, responses)))
+        response.headers['X-Chat-Session'] = chat.id
+        return response
 
-    return Response(generate(), mimetype='text/event-stream')
+    try:
+        with stage('model'):
+            response = chat.client.models.generate_content(model=chat.model, contents=contents, config=config)
+        text = response.text or ''
+    except Exception as e:
+        chat_sessions.abort_turn(chat)
+        logger.exception("Error in chat: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+    usage = chat_sessions.finish_turn(chat, message, text, response.usage_metadata)
+    logger.debug("Chat %s turn %d: %s", chat.id, chat.turn_count, usage, extra=usage)
+    return jsonify({'text': text, 'session_id': chat.id, 'usage': usage, 'chat': chat.to_dict()})
+
+# Helper function to stream a chat turn, recording the reply in the session once it is complete
+def chat_turn_chunks(chat, message, responses):
+    parts = []
+    usage_metadata = None
+    finished = False
+    try:
+        for chunk in responses:
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            text = chunk.text
+            if text:
+                parts.append(text)
+                yield {'role': 'model', 'text': text}, usage_metadata.candidates_token_count if usage_metadata else None
+        usage = chat_sessions.finish_turn(chat, message, ''.join(parts), usage_metadata)
+        finished = True
+        logger.debug("Chat %s turn %d: %s", chat.id, chat.turn_count, usage, extra=usage)
+        yield {'session_id': chat.id, 'usage': usage, 'chat': chat.to_dict()}, None
+    finally:
+        # A cancelled or failed turn is left out of the history
+        if not finished:
+            chat_sessions.abort_turn(chat)
 
 if __name__ == '__main__':
     app.run(debug=True)
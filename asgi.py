@@ -0,0 +1,492 @@
+import asyncio
+import io
+import logging
+import os
+import sys
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import request, jsonify, session
+from google.genai import types
+
+from app import (
+    app as flask_app,
+    configure_gemini_client,
+    ingest_uploaded_file,
+    response_cache_enabled,
+    prepare_image_call,
+    cache_answer,
+    near_duplicates_enabled,
+    find_similar_answer,
+    remember_similar_answer,
+    build_bounding_box_prompt,
+    bounding_box_result,
+    SEGMENTATION_PROMPT,
+    segmentation_result,
+    process_generation_response,
+    process_editing_response,
+    prepare_upload,
+    has_inline_image,
+    has_generated_image,
+    hedge_policy,
+    model_latency,
+    image_files,
+    API_KEY_SESSION_KEY,
+    single_flight,
+    coalescing_enabled,
+    result_writer,
+    upload_store,
+    wait_for_writes,
+)
+from singleflight import flight_key
+from hedging import run_hedged_async
+from instrumentation import stage, start_request, REQUEST_SECONDS
+from schemas import BoundingBox, SegmentMask
+
+logger = logging.getLogger(__name__)
+
+# Async execution mode
+#
+# Run with:  uvicorn asgi:app --port 8000
+#
+# The model-heavy *_process routes are served natively on the event loop and
+# await the SDK's async client, so a slow Gemini round trip no longer pins a
+# worker thread. Everything else (pages, settings, downloads, streaming) is
+# handed to the regular Flask app. The sync mode (python app.py) is unchanged.
+
+# Default number of in-flight calls allowed per model
+flask_app.config['ASYNC_MODEL_CONCURRENCY'] = int(os.environ.get('ASYNC_MODEL_CONCURRENCY', 64))
+# Per-model overrides, e.g. "gemini-2.5-pro-exp-03-25=8,imagen-3.0-generate-002=4"
+flask_app.config['ASYNC_MODEL_CONCURRENCY_OVERRIDES'] = {
+    model.strip(): int(limit)
+    for model, limit in (
+        item.split('=', 1) for item in os.environ.get('ASYNC_MODEL_CONCURRENCY_OVERRIDES', '').split(',') if '=' in item
+    )
+}
+
+# One semaphore per model, created lazily on the server's event loop
+_model_semaphores = {}
+
+def model_semaphore(model):
+    semaphore = _model_semaphores.get(model)
+    if semaphore is None:
+        limit = flask_app.config['ASYNC_MODEL_CONCURRENCY_OVERRIDES'].get(
+            model, flask_app.config['ASYNC_MODEL_CONCURRENCY'])
+        semaphore = _model_semaphores[model] = asyncio.Semaphore(limit)
+    return semaphore
+
+# Helper function to call generate_content through the async client, bounded per model
+async def generate_content_async(client, model, contents, config=None):
+    async with model_semaphore(model):
+        return await client.aio.models.generate_content(model=model, contents=contents, config=config)
+
+# Helper function to call generate_images through the async client, bounded per model
+async def generate_images_async(client, model, prompt):
+    async with model_semaphore(model):
+        return await client.aio.models.generate_images(
+            model=model,
+            prompt=prompt,
+            config=types.GenerateImagesConfig(number_of_images=1)
+        )
+
+# Helper function to read and preprocess an upload without blocking the event loop
+async def ingest_and_prepare_upload(file):
+    def ingest_and_prepare():
+        upload = ingest_uploaded_file(file)
+        if not upload:
+            return None, None
+        return upload, prepare_upload(upload.data, file.content_type)
+
+    return await asyncio.to_thread(ingest_and_prepare)
+
+# Async counterpart of app.generate_text_for_image
+async def generate_text_for_image_async(client, route, model, prompt, image_data, mime_type, image_file=None,
+                                        schema=None, use_cache=None):
+    if use_cache is None:
+        use_cache = response_cache_enabled(route)
+    coalesce = coalescing_enabled(route)
+    # Hashing the image and the cache lookup block, so they run off the event loop
+    contents, config, cache_key, cached_text = await asyncio.to_thread(
+        prepare_image_call, client, route, model, prompt, image_data, mime_type, use_cache=use_cache,
+        image_file=image_file, schema=schema)
+    if cached_text is not None:
+        return cached_text, True
+
+    async def call():
+        with stage('model'):
+            response = await generate_content_async(client, model, contents, config)
+        return response.text
+
+    if coalesce:
+        text, shared = await single_flight.do_async(cache_key, call)
+        if shared:
+            logger.debug("Shared an identical %s call already in flight", route)
+            return text, False
+    else:
+        text = await call()
+
+    if use_cache and text:
+        await asyncio.to_thread(cache_answer, route, cache_key, text)
+    return text, False
+
+# Async counterpart of app.generate_text_for_similar_image, returns (text, cached, match)
+async def generate_text_for_similar_image_async(client, route, model, prompt, prepared, schema=None):
+    use_cache = response_cache_enabled(route)
+    if not near_duplicates_enabled(use_cache, prepared):
+        text, cached = await generate_text_for_image_async(client, route, model, prompt, prepared.data,
+                                                           prepared.mime_type, schema=schema, use_cache=use_cache)
+        return text, cached, None
+
+    answer, pending = await asyncio.to_thread(find_similar_answer, client, route, model, prompt, prepared,
+                                              schema=schema)
+    if answer is not None:
+        return answer
+
+    # The response cache was already checked above, so it is filled here
+    text, _ = await generate_text_for_image_async(client, route, model, prompt, prepared.data, prepared.mime_type,
+                                                  schema=schema, use_cache=False)
+    if text:
+        await asyncio.to_thread(remember_similar_answer, route, pending, prepared, text)
+    return text, False, None
+
+# Async routes
+
+async def image_qa_process():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+    api_key = session.get(API_KEY_SESSION_KEY)
+
+    questions = [question.strip() for question in request.form.getlist('questions') if question.strip()]
+    if not questions:
+        questions = [request.form.get('question', 'What is in this image?')]
+    if len(questions) > flask_app.config['IMAGE_QA_MAX_QUESTIONS']:
+        return jsonify({'error': f"At most {flask_app.config['IMAGE_QA_MAX_QUESTIONS']} questions per request"}), 413
+    keep_image = request.form.get('keep_image', '').lower() in ('1', 'true', 'yes', 'on')
+    image_handle = request.form.get('image_handle')
+    image_file = None
+    image_data = mime_type = prepared = None
+    result = {}
+
+    if image_handle:
+        image_file = image_files.get(image_handle, api_key)
+        if image_file is None:
+            return jsonify({'error': 'Image handle not found or expired, please upload the image again'}), 404
+        result['image_path'] = image_file.image_path
+    else:
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image uploaded'}), 400
+
+        upload, prepared = await ingest_and_prepare_upload(request.files['image'])
+        if not upload:
+            return jsonify({'error': 'Failed to read image'}), 400
+        image_data, mime_type = prepared.data, prepared.mime_type
+        result['image_path'] = upload.path
+        result['preprocessing'] = prepared.summary()
+
+        if keep_image or len(questions) > 1:
+            try:
+                image_file, _ = await asyncio.to_thread(image_files.upload, client, api_key, image_data, mime_type,
+                                                        upload.path)
+            except Exception as e:
+                logger.warning("Could not upload image to the Files API: %s", e)
+
+    if image_file is not None:
+        result['image_handle'] = image_file.handle
+        result['image_handle_expires_in'] = image_file.expires_in()
+
+    try:
+        if len(questions) == 1 and image_file is None:
+            # Also reuses the answer about a visually identical earlier image
+            answer, cached, match = await generate_text_for_similar_image_async(
+                client, 'image_qa', "gemini-2.0-flash", questions[0], prepared)
+            if match:
+                result['near_duplicate'] = {'distance': match['distance']}
+            result.update({'answer': answer, 'cached': cached})
+            return jsonify(result)
+
+        answered = await asyncio.gather(*(
+            generate_text_for_image_async(client, 'image_qa', "gemini-2.0-flash", question,
+                                          image_data, mime_type, image_file=image_file)
+            for question in questions
+        ), return_exceptions=len(questions) > 1)
+        if len(questions) == 1:
+            answer, cached = answered[0]
+            result.update({'answer': answer, 'cached': cached})
+            return jsonify(result)
+
+        answers = []
+        for index, (question, item) in enumerate(zip(questions, answered)):
+            if isinstance(item, Exception):
+                answers.append({'index': index, 'question': question, 'error': str(item)})
+            else:
+                answers.append({'index': index, 'question': question, 'answer': item[0], 'cached': item[1]})
+        result['answers'] = answers
+        return jsonify(result)
+    except Exception as e:
+        logger.exception("Error in image QA: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+async def image_generation_process():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    prompt = request.form.get('prompt', '')
+    if not prompt:
+        return jsonify({'error': 'No prompt provided'}), 400
+
+    async def generate():
+        # Same fallback chain as the sync route: Gemini hedged with Imagen 3, then a placeholder
+        attempts = [
+            ("gemini-2.0-flash-exp-image-generation", lambda: generate_content_async(
+                client,
+                "gemini-2.0-flash-exp-image-generation",
+                prompt,
+                types.GenerateContentConfig(response_modalities=["Text", "Image"]),
+            ), has_inline_image),
+            ("imagen-3.0-generate-002", lambda: generate_images_async(
+                client, "imagen-3.0-generate-002", prompt), has_generated_image),
+        ]
+        try:
+            with stage('model'):
+                model, response = await run_hedged_async(attempts, hedge_policy, model_latency)
+            using_imagen_api = model == "imagen-3.0-generate-002"
+        except Exception as gemini_error:
+            logger.warning("Gemini API error: %s", gemini_error)
+            response = {"text": f"Could not generate image for: {prompt}"}
+            using_imagen_api = False
+
+        # Decoding and saving the image is CPU and disk work, keep it off the event loop
+        return await asyncio.to_thread(process_generation_response, response, using_imagen_api, prompt)
+
+    try:
+        if coalescing_enabled('image_generation'):
+            key = flight_key('image_generation', client.api_key_hash, prompt)
+            result, _ = await single_flight.do_async(key, generate)
+            result = dict(result)
+        else:
+            result = await generate()
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+async def image_editing_process():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+    edit_prompt = request.form.get('edit_prompt', 'Edit this image')
+
+    upload, prepared = await ingest_and_prepare_upload(file)
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
+
+    async def edit():
+        config = types.GenerateContentConfig(response_modalities=["Text", "Image"])
+        attempts = [
+            ("gemini-2.0-flash-exp-image-generation", lambda: generate_content_async(
+                client,
+                "gemini-2.0-flash-exp-image-generation",
+                [edit_prompt, types.Part.from_bytes(data=prepared.data, mime_type=prepared.mime_type)],
+                config,
+            ), has_inline_image),
+            # If that fails, try with a different approach
+            ("gemini-2.0-flash", lambda: generate_content_async(
+                client,
+                "gemini-2.0-flash",
+                [f"Edit this image: {edit_prompt}", types.Part.from_bytes(data=prepared.data, mime_type=prepared.mime_type)],
+                config,
+            ), has_inline_image),
+        ]
+        with stage('model'):
+            model, response = await run_hedged_async(attempts, hedge_policy, model_latency)
+        return await asyncio.to_thread(process_editing_response, response, upload.data, edit_prompt)
+
+    try:
+        if coalescing_enabled('image_editing'):
+            key = flight_key('image_editing', client.api_key_hash, edit_prompt, prepared.data)
+            result, _ = await single_flight.do_async(key, edit)
+            result = dict(result)
+        else:
+            result = await edit()
+        result['preprocessing'] = prepared.summary()
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+async def bounding_boxes_process():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+    object_name = request.form.get('object_name', 'object')
+
+    upload, prepared = await ingest_and_prepare_upload(file)
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
+
+    try:
+        response_text, cached, match = await generate_text_for_similar_image_async(
+            client, 'bounding_boxes', "gemini-2.0-flash", build_bounding_box_prompt(object_name), prepared,
+            schema=BoundingBox)
+        bbox_text = response_text.strip()
+
+        # Parse the boxes and draw them onto the image
+        try:
+            result = await asyncio.to_thread(bounding_box_result, bbox_text, upload, object_name, prepared, cached,
+                                             match)
+            return jsonify(result)
+        except Exception as e:
+            logger.warning("Error processing bounding boxes: %s", e)
+            return jsonify({
+                'error': f'Failed to parse bounding box: {str(e)}',
+                'raw_response': bbox_text
+            }), 400
+
+    except Exception as e:
+        logger.exception("API error: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+async def image_segmentation_process():
+    # Check if API key is set and get client
+    client = configure_gemini_client()
+    if not client:
+        return jsonify({'error': 'API key not set. Please configure your API key in settings.'}), 401
+
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+
+    upload, prepared = await ingest_and_prepare_upload(file)
+    if not upload:
+        return jsonify({'error': 'Failed to read image'}), 400
+
+    crops = request.form.get('segment_crops', '1').lower() not in ('0', 'false', 'no', 'off')
+    render = request.form.get('render', '1').lower() not in ('0', 'false', 'no', 'off')
+
+    try:
+        response_text, cached = await generate_text_for_image_async(
+            client, 'image_segmentation', "gemini-2.5-pro-exp-03-25",
+            SEGMENTATION_PROMPT, prepared.data, prepared.mime_type, schema=SegmentMask)
+        result = await asyncio.to_thread(segmentation_result, response_text, upload, prepared, cached,
+                                         crops=crops, render=render)
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+ASYNC_ROUTES = {
+    '/image_qa_process': image_qa_process,
+    '/image_generation_process': image_generation_process,
+    '/image_editing_process': image_editing_process,
+    '/bounding_boxes_process': bounding_boxes_process,
+    '/image_segmentation_process': image_segmentation_process,
+}
+
+# ASGI plumbing
+
+# Everything that isn't an async route goes to the regular Flask app (in a thread)
+wsgi_fallback = WsgiToAsgi(flask_app)
+
+# Build a WSGI environ for the buffered request so Flask's request/session objects work
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get('body', b''))
+        if not message.get('more_body', False):
+            return bytes(body)
+
+async def send_response(send, response):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(key.encode('latin-1'), value.encode('latin-1')) for key, value in response.headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    handler = ASYNC_ROUTES.get(scope.get('path')) if scope['type'] == 'http' and scope['method'] == 'POST' else None
+    if handler is None:
+        await wsgi_fallback(scope, receive, send)
+        return
+
+    # Timed and labelled like the routes of the Flask app, whose hooks don't run here
+    started = time.perf_counter()
+    request_id = start_request(handler.__name__)
+    environ = build_environ(scope, await read_body(receive))
+    # Flask's request context lives in a contextvar, so each request task gets its own
+    with flask_app.request_context(environ):
+        queued = result_writer.track_writes()
+        queued_uploads = upload_store.track_writes()
+        try:
+            response = flask_app.make_response(await handler())
+        except Exception as e:
+            logger.exception("Unhandled error in async route %s: %s", scope['path'], e)
+            response = flask_app.make_response((jsonify({'error': str(e)}), 500))
+    # The response names result images and uploads, another worker process may be asked for them next
+    await asyncio.to_thread(wait_for_writes, queued, queued_uploads)
+    REQUEST_SECONDS.observe(time.perf_counter() - started, route=handler.__name__, method=scope['method'],
+                            status=response.status_code)
+    response.headers['X-Request-ID'] = request_id
+    await send_response(send, response)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=int(os.environ.get('PORT', 8000)))
@@ -0,0 +1,176 @@
+import contextvars
+import logging
+import os
+import queue
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Archive members we treat as images
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff', '.heic', '.heif'}
+
+
+def is_image_name(name):
+    base = os.path.basename(name)
+    # Skip hidden files and macOS resource forks
+    if not base or base.startswith('.') or '__MACOSX/' in name:
+        return False
+    return os.path.splitext(base)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_archive_images(stream, filename):
+    """Yield (name, bytes) for each image in a zip or tar archive.
+
+    Tar archives (optionally compressed) are read as a stream, zip files need
+    a seekable stream (Werkzeug spools uploads to a temporary file).
+    """
+    if (filename or '').lower().endswith('.zip'):
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_image_name(info.filename):
+                    yield info.filename, archive.read(info)
+        return
+
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile() and is_image_name(member.name):
+                yield member.name, archive.extractfile(member).read()
+
+
+class RateLimiter:
+    """Spaces out calls to at most max_per_second, across all threads."""
+
+    def __init__(self, max_per_second=0):
+        self.interval = 1.0 / max_per_second if max_per_second else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class BatchRunner:
+    """Fans batch items out to a bounded pool of model calls.
+
+    Each item goes through detect() on the model pool (at most concurrency
+    calls in flight, paced by the rate limiter), then render() on a separate
+    pool so drawing never holds up a model slot. Results are yielded in the
+    order they finish.
+    """
+
+    def __init__(self, concurrency=8, render_workers=4, max_calls_per_second=0):
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(max_calls_per_second)
+        self._model_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-model')
+        self._render_executor = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix='batch-render')
+        self._lock = threading.Lock()
+
+        # Counters
+        self.batches = 0
+        self.items = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.throttled_seconds = 0.0
+
+    def run(self, items, detect, render, window=None):
+        """Run detect/render for each (index, item) and yield result dicts as they finish.
+
+        At most window items (by default the concurrency) are in flight at
+        once: the next item is only read from items when one finishes, so a
+        lazy iterable is consumed as fast as the model pool works through it
+        rather than queued in full. Closing the generator early (e.g. the
+        client went away) cancels the items that haven't started yet.
+        """
+        window = window or self.concurrency
+        results = queue.Queue()
+        # Added to from worker threads (render steps) and emptied by done callbacks, so always under its lock
+        futures = set()
+        futures_lock = threading.Lock()
+        with self._lock:
+            self.batches += 1
+
+        def on_error(index, e):
+            logger.warning("Batch item %s failed: %s", index, e)
+            with self._lock:
+                self.failed += 1
+            results.put({'index': index, 'error': str(e)})
+
+        def forget(future):
+            with futures_lock:
+                futures.discard(future)
+
+        def track(future):
+            with futures_lock:
+                futures.add(future)
+            # Runs forget() right away if the future is already done, so outside the lock
+            future.add_done_callback(forget)
+
+        def render_step(index, item, detected):
+            try:
+                results.put(render(index, item, detected))
+            except Exception as e:
+                on_error(index, e)
+
+        def detect_step(index, item):
+            waited = self.rate_limiter.acquire()
+            with self._lock:
+                self.in_flight += 1
+                self.throttled_seconds += waited
+            try:
+                detected = detect(index, item)
+            except Exception as e:
+                on_error(index, e)
+                return
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+            track(self._render_executor.submit(contextvars.copy_context().run, render_step, index, item, detected))
+
+        items = iter(items)
+        pending = 0
+        try:
+            while True:
+                # Top up the window, then hand back one result
+                while pending < window:
+                    next_item = next(items, None)
+                    if next_item is None:
+                        break
+                    index, item = next_item
+                    # Each item runs in a copy of the caller's context (its priority, the route its timings go to)
+                    track(self._model_executor.submit(contextvars.copy_context().run, detect_step, index, item))
+                    pending += 1
+                    with self._lock:
+                        self.items += 1
+                if not pending:
+                    return
+                yield results.get()
+                pending -= 1
+        finally:
+            with futures_lock:
+                unfinished = list(futures)
+            for future in unfinished:
+                future.cancel()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'concurrency': self.concurrency,
+                'batches': self.batches,
+                'items': self.items,
+                'failed': self.failed,
+                'in_flight': self.in_flight,
+                'throttled_seconds': round(self.throttled_seconds, 3),
+            }
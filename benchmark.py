@@ -0,0 +1,306 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from load_test import percentile
+from perceptual import HashIndex
+from rendering import draw_boxes
+
+# Offline benchmark of the *_process routes, served by the app in-process and
+# answered by the fake Gemini backend (fake_gemini.py), so no API key, quota
+# or network access is needed.
+#
+#   python benchmark.py                                       # every route, concurrency 1, 4 and 16
+#   python benchmark.py --routes bounding_boxes --concurrency 1 8 32 --latency 0.2 --error-rate 0.05
+#   python benchmark.py --save-baseline benchmark_baseline.json
+#   python benchmark.py --baseline benchmark_baseline.json    # exits with 1 on a regression
+#
+# Each route runs in a fresh process, so its CPU time and peak RSS aren't
+# mixed up with the others. CPU is the process time of all threads (the
+# server side and the load generator) plus the time the result writer's
+# worker processes spent encoding. The hot paths (JSON parsing and PIL
+# rendering of the model responses) are also timed on their own, without the
+# model latency, and are what the baseline comparison mostly guards; they
+# include handing a result to the writer, not its encoding. The box overlay
+# drawing is timed at several object counts (--overlay-objects), and the
+# near-duplicate lookup at several index sizes (--index-entries), filled with
+# random hashes: real photo hashes cluster more, so expect somewhat slower
+# lookups at the same size.
+
+# name -> (path, form or JSON body, sends an image)
+ROUTES = {
+    'image_qa': ('/image_qa_process', {'question': 'What is in this image?'}, True),
+    'image_qa_multi': ('/image_qa_process', {'questions': ['What is in this image?', 'What colour is the cat?',
+                                                           'Is it daytime?', 'What is in the background?']}, True),
+    'bounding_boxes': ('/bounding_boxes_process', {'object_name': 'cat'}, True),
+    'image_segmentation': ('/image_segmentation_process', {}, True),
+    'image_generation': ('/image_generation_process', {'prompt': 'A cat wearing a hat'}, False),
+    'image_editing': ('/image_editing_process', {'edit_prompt': 'Add a hat'}, True),
+    'text_generation': ('/text_generation_process', {'prompt': 'Write a haiku about cats', 'demo_type': 'simple'},
+                        False),
+    'text_structured': ('/text_generation_process', {'prompt': 'Two cats', 'demo_type': 'structured'}, False),
+    'text_streaming': ('/text_streaming_process', {'prompt': 'Write a haiku about cats'}, False),
+}
+
+# Relative slowdown, and absolute milliseconds, both needed before a number counts as a regression
+DEFAULT_TOLERANCE = 0.25
+NOISE_FLOOR_MS = 1.0
+
+
+def make_image(width, height):
+    # Noise compresses like a photo, unlike a flat test image
+    noise = Image.effect_noise((width, height), 48)
+    image = Image.merge('RGB', (noise, noise.point(lambda value: 255 - value), noise))
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def make_boxes(count, width, height):
+    # A grid of boxes spread over the image, with a handful of distinct labels
+    columns = max(1, int(count ** 0.5))
+    rows = -(-count // columns)
+    cell_width, cell_height = width // columns, height // rows
+    return [(i, [(i % columns) * cell_width + 4, (i // columns) * cell_height + 30,
+                 (i % columns + 1) * cell_width - 4, (i // columns + 1) * cell_height - 4], f'object {i % 5}')
+            for i in range(count)]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1024 / 1024
+
+
+def load_app(args):
+    # Configured through the environment, as the app reads it at import time
+    os.environ.update({
+        'GEMINI_BACKEND': 'fake',
+        'FAKE_GEMINI_LATENCY': str(args.latency),
+        'FAKE_GEMINI_JITTER': str(args.jitter),
+        'FAKE_GEMINI_ERROR_RATE': str(args.error_rate),
+        'RESPONSE_CACHE_DB': '',
+        'LOG_LEVEL': 'ERROR',
+    })
+    if args.recordings:
+        os.environ['FAKE_GEMINI_RECORDINGS'] = args.recordings
+    import app
+
+    # Keep the result and upload files out of the working tree
+    output_folder = tempfile.mkdtemp(prefix='benchmark_')
+    app.app.config['RESULTS_FOLDER'] = output_folder
+    app.result_writer.folder = output_folder
+    app.upload_store.folder = output_folder
+    app.fake_gemini.retry_delay = args.retry_delay
+    return app
+
+
+def run_route(name, args, output):
+    app = load_app(args)
+    path, form, needs_image = ROUTES[name]
+    image_bytes = make_image(args.width, args.height) if needs_image else None
+    clients = threading.local()
+
+    def one_request(_):
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = app.app.test_client()
+            with client.session_transaction() as session:
+                session[app.API_KEY_SESSION_KEY] = 'benchmark'
+        start = time.perf_counter()
+        if path == '/text_generation_process':
+            response = client.post(path, json=form)
+        elif path == '/text_streaming_process':
+            # An event stream, timed until its last event has arrived
+            response = client.get(path, query_string=form)
+        else:
+            # Every request makes its own model call, identical requests would otherwise be cached or coalesced
+            data = dict(form, no_cache='1', coalesce='0')
+            if needs_image:
+                data['image'] = (BytesIO(image_bytes), 'benchmark.jpg', 'image/jpeg')
+            response = client.post(path, data=data, content_type='multipart/form-data')
+        response.get_data()
+        return response.status_code == 200, time.perf_counter() - start
+
+    results = []
+    one_request(None)  # warm up
+    for concurrency in args.concurrency:
+        requests = max(args.requests, concurrency)
+        cpu_start = time.process_time() + app.result_writer.encode_seconds
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(one_request, range(requests)))
+        wall_time = time.perf_counter() - start
+        # Results encoded in the writer's worker processes count towards the CPU time too
+        app.result_writer.flush()
+        cpu_time = time.process_time() + app.result_writer.encode_seconds - cpu_start
+
+        latencies = [latency for ok, latency in outcomes if ok]
+        results.append({
+            'route': name,
+            'concurrency': concurrency,
+            'ok': len(latencies),
+            'errors': len(outcomes) - len(latencies),
+            'throughput': len(latencies) / wall_time if wall_time else 0.0,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'cpu_ms_per_request': cpu_time / requests * 1000,
+            'peak_rss_mb': peak_rss_mb(),
+        })
+    app.result_writer.close()
+    output.put(results)
+
+
+def run_hot_paths(args, output):
+    app = load_app(args)
+    recordings = app.fake_gemini.recordings
+    image = Image.open(BytesIO(make_image(args.width, args.height)))
+    image.load()
+    generated = app.fake_gemini.response('image')
+
+    hot_paths = {
+        'extract_bounding_box_json': lambda: app.extract_bounding_box_json(recordings['bounding_boxes']),
+        'render_bounding_boxes': lambda: app.render_bounding_boxes(recordings['bounding_boxes'], image.copy(),
+                                                                   'cat'),
+        'render_segmentation_masks': lambda: app.render_segmentation_masks(recordings['segmentation'],
+                                                                           image.copy()),
+        'render_segmentation_json_only': lambda: app.render_segmentation_masks(recordings['segmentation'],
+                                                                               image.copy(), render=False),
+        'process_generation_response': lambda: app.process_generation_response(generated, False, 'A cat'),
+    }
+    # Drawing alone (no parsing, copying or saving) against the number of objects on the image,
+    # on the same canvas each time as the cost doesn't depend on what is already drawn
+    canvas = image.copy()
+    for count in args.overlay_objects:
+        boxes = make_boxes(count, args.width, args.height)
+        hot_paths[f'draw_overlay_{count}_objects'] = (
+            lambda boxes=boxes: draw_boxes(canvas, boxes, app.font_cache.get(20)))
+    # Hashing the image as it is sent to the model, then searching an index of growing size
+    sent = app.prepare_image(make_image(args.width, args.height), 'image/png').data
+    hot_paths['image_phash'] = lambda: app.image_phash(sent)
+    random = np.random.default_rng(0)
+    for entries in args.index_entries:
+        hashes = random.integers(0, 2 ** 64 - 1, entries, dtype=np.uint64, endpoint=True)
+        index = HashIndex(app.app.config['NEAR_DUPLICATE_MAX_DISTANCE'])
+        index.extend(hashes)
+        # A stored hash with two bits flipped, as a re-encoded upload would be
+        query = int(hashes[entries // 2]) ^ 0b101
+        hot_paths[f'phash_lookup_{entries}_entries'] = lambda index=index, query=query: index.search(query)
+    results = {}
+    for name, func in hot_paths.items():
+        func()  # warm up
+        samples = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - start) * 1000)
+            # Don't let the background encoding of one sample slow down the next
+            app.result_writer.flush()
+        results[name] = statistics.median(samples)
+    app.result_writer.close()
+    output.put(results)
+
+
+def in_subprocess(target, *args):
+    context = multiprocessing.get_context('spawn')
+    output = context.Queue()
+    process = context.Process(target=target, args=args + (output,))
+    process.start()
+    result = output.get()
+    process.join()
+    return result
+
+
+def compare(current, baseline, tolerance):
+    """Yield (name, baseline ms, current ms, regressed) for every number both runs have."""
+    for name, before in baseline.get('hot_paths', {}).items():
+        after = current['hot_paths'].get(name)
+        if after is not None:
+            yield name, before, after, after > before * (1 + tolerance) and after - before > NOISE_FLOOR_MS
+
+    current_routes = {(row['route'], row['concurrency']): row for row in current['routes']}
+    for row in baseline.get('routes', []):
+        match = current_routes.get((row['route'], row['concurrency']))
+        if match is not None:
+            before, after = row['cpu_ms_per_request'], match['cpu_ms_per_request']
+            yield (f"{row['route']} cpu/request @{row['concurrency']}", before, after,
+                   after > before * (1 + tolerance) and after - before > NOISE_FLOOR_MS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the app offline against a fake Gemini backend')
+    parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=list(ROUTES))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=40, help='Requests per concurrency level')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds each fake model call takes')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Latency spread, as a fraction of --latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of model calls failing with 429/503')
+    parser.add_argument('--retry-delay', type=float, default=0.1, help='Retry hint sent with injected 429s')
+    parser.add_argument('--recordings', help='JSON file of recorded responses, see fake_gemini.load_recordings')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--iterations', type=int, default=20, help='Runs of each hot path')
+    parser.add_argument('--overlay-objects', nargs='+', type=int, default=[1, 10, 50, 200],
+                        help='Object counts to time the box overlay drawing at')
+    parser.add_argument('--index-entries', nargs='+', type=int, default=[10_000, 100_000, 1_000_000],
+                        help='Index sizes to time the near-duplicate lookup at')
+    parser.add_argument('--skip-routes', action='store_true', help='Only time the hot paths')
+    parser.add_argument('--save-baseline', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Compare with a saved baseline, exit with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    settings = {key: getattr(args, key) for key in ('latency', 'jitter', 'error_rate', 'width', 'height')}
+    current = {'settings': settings, 'routes': [], 'hot_paths': {}}
+
+    print(f"Hot paths on a {args.width}x{args.height} image, median of {args.iterations}")
+    current['hot_paths'] = in_subprocess(run_hot_paths, args)
+    for name, milliseconds in current['hot_paths'].items():
+        print(f"  {name:<32} {milliseconds:>9.2f} ms")
+
+    if not args.skip_routes:
+        print(f"\nRoutes, fake model latency {args.latency}s +/-{args.jitter:.0%}, error rate {args.error_rate:.0%}")
+        print(f"{'route':<20} {'conc':>5} {'ok':>5} {'err':>4} {'req/s':>8} {'p50 s':>7} {'p90 s':>7} "
+              f"{'p99 s':>7} {'cpu ms/req':>11} {'peak MB':>8}")
+        for name in args.routes:
+            for row in in_subprocess(run_route, name, args):
+                current['routes'].append(row)
+                print(f"{row['route']:<20} {row['concurrency']:>5} {row['ok']:>5} {row['errors']:>4} "
+                      f"{row['throughput']:>8.2f} {row['p50']:>7.3f} {row['p90']:>7.3f} {row['p99']:>7.3f} "
+                      f"{row['cpu_ms_per_request']:>11.1f} {row['peak_rss_mb']:>8.0f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(current, baseline_file, indent=2)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('settings') != settings:
+            print(f"\nWarning: the baseline was run with {baseline.get('settings')}")
+        print(f"\n{'compared with baseline':<44} {'before':>9} {'after':>9}")
+        regressions = 0
+        for name, before, after, regressed in compare(current, baseline, args.tolerance):
+            regressions += regressed
+            print(f"  {name:<42} {before:>9.2f} {after:>9.2f} {'REGRESSION' if regressed else ''}")
+        if regressions:
+            print(f"\n{regressions} regression(s) over {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import argparse
+import base64
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+# Benchmark of segmentation mask compositing: the old per-mask loop against
+# the vectorized compositing engine, on a synthetic image and model response.
+#
+#   python benchmark_segmentation.py --width 4000 --height 3000 --masks 20
+#
+# Each run happens in a fresh process so the peak memory numbers don't bleed
+# into each other. No API key or network access is needed.
+
+def make_response(width, height, count, mask_edge, object_size):
+    # A fake model response with count elliptical objects spread over the image,
+    # each mask covering its box like the model's do
+    segments = []
+    edge = int(object_size * 1000)
+    for i in range(count):
+        x = int((i * 0.137) % (1 - object_size) * 1000)
+        y = int((i * 0.291) % (1 - object_size) * 1000)
+        box = [y, x, y + edge, x + edge]
+        mask = Image.new("L", (mask_edge, mask_edge), 0)
+        draw = ImageDraw.Draw(mask)
+        draw.ellipse([0, 0, mask_edge - 1, mask_edge - 1], fill=255)
+        buffer = BytesIO()
+        mask.save(buffer, format="PNG")
+        segments.append({
+            "box_2d": box,
+            "mask": "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode(),
+            "label": f"object {i}"
+        })
+    return json.dumps(segments)
+
+def make_image(width, height):
+    # A gradient rather than a flat color so PNG encoding does real work
+    gradient = Image.linear_gradient("L").resize((width, height))
+    return Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), gradient.rotate(180)))
+
+def legacy_render(response_text, original_image, results_folder):
+    # The original implementation: one full-frame overlay, composite and PNG per mask
+    mask_data = json.loads(response_text)
+    result_images = []
+    for i, mask_info in enumerate(mask_data):
+        mask_base64 = mask_info.get("mask", "")
+        if "base64," in mask_base64:
+            mask_base64 = mask_base64.split("base64,")[1]
+        mask_image = Image.open(BytesIO(base64.b64decode(mask_base64)))
+
+        original_rgba = original_image.convert("RGBA")
+        mask_image = mask_image.convert("L")
+
+        colors = [(255, 0, 0, 128), (0, 255, 0, 128), (0, 0, 255, 128),
+                  (255, 255, 0, 128), (255, 0, 255, 128), (0, 255, 255, 128)]
+        overlay = Image.new("RGBA", mask_image.size, colors[i % len(colors)])
+        overlay.putalpha(mask_image)
+        if overlay.size != original_rgba.size:
+            overlay = overlay.resize(original_rgba.size)
+
+        result = Image.alpha_composite(original_rgba, overlay)
+        result_path = os.path.join(results_folder, f"segment_{i}.png")
+        result.save(result_path)
+        result_images.append(result_path)
+    return result_images
+
+def run_method(method, args, output):
+    results_folder = tempfile.mkdtemp(prefix="seg_bench_")
+    original_image = make_image(args.width, args.height)
+    response_text = make_response(args.width, args.height, args.masks, args.mask_edge, args.object_size)
+
+    if method == 'legacy':
+        render = lambda: legacy_render(response_text, original_image, results_folder)
+    else:
+        # Import lazily so the legacy run doesn't pay for numpy/app start-up in its memory figure
+        os.environ.setdefault('RESPONSE_CACHE_DB', '')
+        import app
+        app.app.config['RESULTS_FOLDER'] = results_folder
+        crops = method == 'vectorized'
+        render_images = method != 'json-only'
+        render = lambda: app.render_segmentation_masks(response_text, original_image, crops=crops,
+                                                       render=render_images)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    # The app logs the whole model response, keep it out of the report
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        render()
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    output.put({
+        'method': method,
+        'seconds': seconds,
+        'peak_mb': after * unit / 1024 / 1024,
+        'extra_peak_mb': (after - before) * unit / 1024 / 1024,
+        'files': len(os.listdir(results_folder)),
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark segmentation mask compositing')
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--masks', type=int, default=20)
+    parser.add_argument('--mask-edge', type=int, default=256, help='Size of the masks returned by the "model"')
+    parser.add_argument('--object-size', type=float, default=0.15,
+                        help='Width and height of each object as a fraction of the image')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    # vectorized-nocrops is the same engine with segment_crops=0, json-only with render=0
+    methods = ['legacy', 'vectorized', 'vectorized-nocrops', 'json-only']
+    context = multiprocessing.get_context('spawn')
+
+    print(f"{args.masks} masks on a {args.width}x{args.height} image")
+    print(f"{'method':<20} {'wall s':>8} {'peak MB':>9} {'+peak MB':>9} {'files':>6}")
+    for _ in range(args.repeat):
+        for method in methods:
+            output = context.Queue()
+            process = context.Process(target=run_method, args=(method, args, output))
+            process.start()
+            stats = output.get()
+            process.join()
+            print(f"{stats['method']:<20} {stats['seconds']:>8.2f} {stats['peak_mb']:>9.0f} "
+                  f"{stats['extra_peak_mb']:>9.0f} {stats['files']:>6}")
+
+if __name__ == '__main__':
+    main()
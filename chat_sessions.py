@@ -0,0 +1,306 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from google.genai import types
+
+from client_pool import hash_api_key
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """
+Summarize the conversation below in a few sentences. Keep every fact, name, number and decision
+that would be needed to continue it, and drop small talk.
+
+{conversation}
+"""
+
+
+# Rough token count for budgeting, about four characters per token
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+# Gemini bills an image as 258 tokens per 768x768 tile, small images as a single tile
+def estimate_image_tokens(size):
+    if not size:
+        return 258
+    width, height = size
+    return 258 * max(1, -(-width // 768)) * max(1, -(-height // 768))
+
+
+class ChatSessionBusy(Exception):
+    pass
+
+
+class ChatSession:
+    def __init__(self, api_key_hash, client, model, system_instruction, prefix_parts, prefix_tokens):
+        self.id = uuid.uuid4().hex
+        self.api_key_hash = api_key_hash
+        self.client = client
+        self.model = model
+        self.system_instruction = system_instruction
+        # Content shared by every turn (e.g. an image being discussed), sent inline when it isn't cached
+        self.prefix_parts = list(prefix_parts)
+        self.prefix_tokens = prefix_tokens
+        self.summary = ''
+        self.turns = []  # (role, text), oldest first
+        self.cache_name = None
+        self.cache_expires_at = None
+        self.busy = False
+        self.last_used = time.monotonic()
+
+        # Counters
+        self.turn_count = 0
+        self.summarized_turns = 0
+        self.cached_tokens = 0
+
+    def history_tokens(self):
+        return estimate_tokens(self.summary) + sum(estimate_tokens(text) for _, text in self.turns)
+
+    def to_dict(self):
+        return {
+            'session_id': self.id,
+            'model': self.model,
+            'context_cached': self.cache_name is not None,
+            'turns': self.turn_count,
+            'history_turns': len(self.turns),
+            'history_tokens': self.history_tokens(),
+            'summarized_turns': self.summarized_turns,
+            'cached_tokens': self.cached_tokens,
+        }
+
+
+class ChatSessionStore:
+    """Server-side multi-turn chats with a token budget for their history.
+
+    When the history grows past history_tokens the oldest turns are folded
+    into a running summary (or just dropped when summarize is off). The system
+    instruction and any shared prefix go into a Gemini context cache when they
+    are big enough to be cached, so later turns only send the new history.
+    Sessions idle for idle_timeout seconds are evicted and their cache deleted.
+    """
+
+    def __init__(self, model='gemini-2.0-flash-001', max_sessions=256, idle_timeout=1800, history_tokens=8000,
+                 cache_min_tokens=4096, summarize=True):
+        self.model = model
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.history_token_budget = history_tokens
+        self.cache_min_tokens = cache_min_tokens
+        self.summarize = summarize
+
+        # session id -> session, ordered least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.created = 0
+        self.evictions = 0
+        self.caches_created = 0
+        self.cache_failures = 0
+        self.summaries = 0
+        self.truncations = 0
+        self.turns = 0
+        self.cached_tokens = 0
+
+    def create(self, client, api_key, system_instruction='', prefix_parts=(), prefix_tokens=0):
+        session = ChatSession(hash_api_key(api_key), client, self.model, system_instruction,
+                              prefix_parts, prefix_tokens)
+        if prefix_tokens + estimate_tokens(system_instruction or '') >= self.cache_min_tokens:
+            self._create_cache(session)
+
+        with self._lock:
+            evicted = self._evict(time.monotonic())
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+                self.evictions += 1
+            self.created += 1
+        self._delete_caches(evicted)
+        return session
+
+    def get(self, session_id, api_key):
+        # Sessions belong to the API key that created them
+        with self._lock:
+            evicted = self._evict(time.monotonic())
+            session = self._sessions.get(session_id)
+            if session is not None and session.api_key_hash != hash_api_key(api_key):
+                session = None
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        self._delete_caches(evicted)
+        return session
+
+    def delete(self, session_id, api_key):
+        session = self.get(session_id, api_key)
+        if session is None:
+            return False
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        self._delete_caches([session])
+        return True
+
+    def begin_turn(self, session, message):
+        """Reserve the session for a turn and return the (contents, config) to send.
+
+        Raises ChatSessionBusy if another turn is still in progress. Every
+        begin_turn must be followed by finish_turn or abort_turn.
+        """
+        with self._lock:
+            if session.busy:
+                raise ChatSessionBusy('A message is already in progress for this chat')
+            session.busy = True
+            session.last_used = time.monotonic()
+
+        try:
+            self._fit_history(session, estimate_tokens(message))
+            self._refresh_cache(session)
+        except Exception:
+            self.abort_turn(session)
+            raise
+
+        contents = []
+        if session.prefix_parts and session.cache_name is None:
+            contents.append(types.Content(role='user', parts=session.prefix_parts))
+        if session.summary:
+            contents.append(types.Content(role='user', parts=[types.Part.from_text(
+                text=f"Summary of our conversation so far: {session.summary}")]))
+            contents.append(types.Content(role='model', parts=[types.Part.from_text(text='Understood.')]))
+        for role, text in session.turns:
+            contents.append(types.Content(role=role, parts=[types.Part.from_text(text=text)]))
+        contents.append(types.Content(role='user', parts=[types.Part.from_text(text=message)]))
+
+        if session.cache_name:
+            config = types.GenerateContentConfig(cached_content=session.cache_name)
+        else:
+            config = types.GenerateContentConfig(system_instruction=session.system_instruction or None)
+        return contents, config
+
+    def finish_turn(self, session, message, reply, usage_metadata=None):
+        # Record the exchange and return the token usage of the turn
+        usage = {
+            'prompt_tokens': getattr(usage_metadata, 'prompt_token_count', None),
+            'cached_tokens': getattr(usage_metadata, 'cached_content_token_count', None) or 0,
+            'output_tokens': getattr(usage_metadata, 'candidates_token_count', None),
+        }
+        with self._lock:
+            session.turns.append(('user', message))
+            session.turns.append(('model', reply))
+            session.turn_count += 1
+            session.cached_tokens += usage['cached_tokens']
+            session.last_used = time.monotonic()
+            session.busy = False
+            self.turns += 1
+            self.cached_tokens += usage['cached_tokens']
+        return usage
+
+    def abort_turn(self, session):
+        with self._lock:
+            session.busy = False
+
+    def _fit_history(self, session, incoming_tokens):
+        # Move the oldest exchanges out of the history until the new turn fits the budget
+        dropped = []
+        while (session.turns and len(session.turns) > 2
+               and session.history_tokens() + incoming_tokens > self.history_token_budget):
+            dropped.extend(session.turns[:2])
+            del session.turns[:2]
+        if not dropped:
+            return
+
+        session.summarized_turns += len(dropped) // 2
+        if not self.summarize:
+            with self._lock:
+                self.truncations += 1
+            return
+
+        conversation = '\n'.join(f"{role}: {text}" for role, text in dropped)
+        if session.summary:
+            conversation = f"Earlier summary: {session.summary}\n{conversation}"
+        try:
+            response = session.client.models.generate_content(
+                model=session.model,
+                contents=SUMMARY_PROMPT.format(conversation=conversation)
+            )
+            session.summary = (response.text or '').strip()
+            with self._lock:
+                self.summaries += 1
+        except Exception as e:
+            # Keep the previous summary, the dropped turns are lost
+            logger.warning("Could not summarize chat %s: %s", session.id, e)
+            with self._lock:
+                self.truncations += 1
+
+    def _create_cache(self, session):
+        contents = [types.Content(role='user', parts=session.prefix_parts)] if session.prefix_parts else None
+        try:
+            cache = session.client.caches.create(
+                model=session.model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=session.system_instruction or None,
+                    contents=contents,
+                    ttl=f"{self.idle_timeout}s",
+                    display_name=f"chat-{session.id}"
+                )
+            )
+        except Exception as e:
+            # Too small to cache, or caching isn't available for the key, send it inline
+            logger.info("Could not create context cache for chat %s: %s", session.id, e)
+            with self._lock:
+                self.cache_failures += 1
+            return
+        session.cache_name = cache.name
+        session.cache_expires_at = time.monotonic() + self.idle_timeout
+        with self._lock:
+            self.caches_created += 1
+
+    def _refresh_cache(self, session):
+        # Keep the cache alive as long as the session, it is deleted on eviction anyway
+        if session.cache_name is None or session.cache_expires_at - time.monotonic() > self.idle_timeout / 2:
+            return
+        try:
+            session.client.caches.update(name=session.cache_name,
+                                         config=types.UpdateCachedContentConfig(ttl=f"{self.idle_timeout}s"))
+            session.cache_expires_at = time.monotonic() + self.idle_timeout
+        except Exception as e:
+            logger.warning("Context cache for chat %s is gone, sending the context inline: %s", session.id, e)
+            session.cache_name = None
+
+    def _evict(self, now):
+        # Sessions are kept in recency order, so idle ones are always at the front
+        evicted = []
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.idle_timeout or session.busy:
+                break
+            self._sessions.popitem(last=False)
+            evicted.append(session)
+            self.evictions += 1
+        return evicted
+
+    def _delete_caches(self, sessions):
+        for session in sessions:
+            if session.cache_name:
+                try:
+                    session.client.caches.delete(name=session.cache_name)
+                except Exception as e:
+                    logger.warning("Could not delete context cache %s: %s", session.cache_name, e)
+                session.cache_name = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'max_sessions': self.max_sessions,
+                'created': self.created,
+                'evictions': self.evictions,
+                'caches_created': self.caches_created,
+                'cache_failures': self.cache_failures,
+                'summaries': self.summaries,
+                'truncations': self.truncations,
+                'turns': self.turns,
+                'cached_tokens': self.cached_tokens,
+            }
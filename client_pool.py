@@ -0,0 +1,93 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from google import genai
+
+
+# Hash an API key so the raw key is never used as a dictionary key or logged
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+class ClientPool:
+    """Process-wide registry of reusable genai.Client objects, one per API key.
+
+    Each genai.Client owns its own keep-alive HTTP connection pool, so handing
+    the same client to every request for a key lets warm requests skip client
+    construction and the TLS handshake to the Gemini endpoint.
+    """
+
+    def __init__(self, max_clients=32, idle_timeout=900, factory=None):
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self._factory = factory or (lambda api_key: genai.Client(api_key=api_key))
+
+        # key hash -> [client, last used timestamp], ordered least recently used first
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, api_key):
+        key = hash_api_key(api_key)
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Build the client outside the lock so a slow construction for one key
+        # does not block requests for other keys
+        client = self._factory(api_key)
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None:
+                # Another thread built a client for this key in the meantime, use theirs
+                entry[1] = now
+                self._clients.move_to_end(key)
+                return entry[0]
+
+            self._clients[key] = [client, now]
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+
+        return client
+
+    def discard(self, api_key):
+        # Drop the client for a key, e.g. when the key turned out to be invalid
+        with self._lock:
+            self._clients.pop(hash_api_key(api_key), None)
+
+    def _evict_idle(self, now):
+        # Entries are kept in recency order, so stale ones are always at the front
+        while self._clients:
+            key, (client, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            self._clients.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'live_clients': len(self._clients),
+                'max_clients': self.max_clients,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,169 @@
+import base64
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# Overlay colors, one per segment in turn
+SEGMENT_COLORS = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255)]
+# The same palette as float32 rows, built once for the blending code
+SEGMENT_PALETTE = np.array(SEGMENT_COLORS, dtype=np.float32)
+SEGMENT_PALETTE.flags.writeable = False
+
+# Upper bound on float32 elements per band of masks while blending (~4 MB per temporary)
+BLEND_BUDGET = 1024 * 1024
+
+
+def rgb_array(image):
+    return np.asarray(image.convert("RGB"))
+
+
+def decode_mask(mask_base64):
+    # Masks come back as base64 PNGs, sometimes as data URLs
+    if "base64," in mask_base64:
+        mask_base64 = mask_base64.split("base64,")[1]
+    with Image.open(BytesIO(base64.b64decode(mask_base64))) as mask_image:
+        return mask_image.convert("L")
+
+
+class MaskStack:
+    """Masks decoded once at the resolution the model returned them.
+
+    Each mask covers a box (left, top, right, bottom) of the target image, the
+    whole image when no box is given, and is zero outside it. Regions of a mask
+    are resampled to the target size on demand, only where they overlap its
+    box, so small objects cost little whatever the image size.
+    """
+
+    def __init__(self, mask_images, size, boxes=None):
+        self.size = size
+        self.masks = list(mask_images)
+        full_frame = (0, 0, size[0], size[1])
+        self.boxes = [box or full_frame for box in boxes] if boxes else [full_frame] * len(mask_images)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def append(self, mask_image, box=None):
+        # Add a mask as it arrives, returns its index
+        self.masks.append(mask_image)
+        self.boxes.append(box or (0, 0, self.size[0], self.size[1]))
+        return len(self.masks) - 1
+
+    def region(self, index, left, top, right, bottom):
+        # This region of the full-size mask as a uint8 array
+        box_left, box_top, box_right, box_bottom = self.boxes[index]
+        inner = (max(left, box_left), max(top, box_top), min(right, box_right), min(bottom, box_bottom))
+        if inner[0] >= inner[2] or inner[1] >= inner[3]:
+            return np.zeros((bottom - top, right - left), dtype=np.uint8)
+
+        # Resize only the part of the mask that lands inside the region
+        mask_image = self.masks[index]
+        box_width, box_height = box_right - box_left, box_bottom - box_top
+        if mask_image.size == (box_width, box_height):
+            piece = np.asarray(mask_image)[inner[1] - box_top:inner[3] - box_top, inner[0] - box_left:inner[2] - box_left]
+        else:
+            scale_x = mask_image.size[0] / box_width
+            scale_y = mask_image.size[1] / box_height
+            source = ((inner[0] - box_left) * scale_x, (inner[1] - box_top) * scale_y,
+                      (inner[2] - box_left) * scale_x, (inner[3] - box_top) * scale_y)
+            piece = np.asarray(mask_image.resize((inner[2] - inner[0], inner[3] - inner[1]),
+                                                 Image.Resampling.BILINEAR, box=source))
+
+        if inner == (left, top, right, bottom):
+            return piece
+        result = np.zeros((bottom - top, right - left), dtype=np.uint8)
+        result[inner[1] - top:inner[3] - top, inner[0] - left:inner[2] - left] = piece
+        return result
+
+    def band(self, top, bottom):
+        # Indices of the masks that reach into these rows, and an (n, rows, W) array of them
+        width = self.size[0]
+        indices = [i for i, box in enumerate(self.boxes) if box[1] < bottom and box[3] > top]
+        stacked = np.empty((len(indices), bottom - top, width), dtype=np.uint8)
+        for row, i in enumerate(indices):
+            stacked[row] = self.region(i, 0, top, width, bottom)
+        return indices, stacked
+
+    def extract(self, index):
+        """Return the tight (x_min, y_min, x_max, y_max) bounds of a mask and its pixels within them.
+
+        Both are None for an empty mask.
+        """
+        left, top, right, bottom = self.boxes[index]
+        mask = self.region(index, left, top, right, bottom)
+        rows = np.flatnonzero(mask.any(axis=1))
+        if rows.size == 0:
+            return None, None
+        cols = np.flatnonzero(mask.any(axis=0))
+        bounds = (left + int(cols[0]), top + int(rows[0]), left + int(cols[-1]) + 1, top + int(rows[-1]) + 1)
+        return bounds, mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+
+def segment_color(index):
+    return SEGMENT_PALETTE[index % len(SEGMENT_PALETTE)]
+
+
+def segment_colors(count):
+    return SEGMENT_PALETTE[np.arange(count) % len(SEGMENT_PALETTE)]
+
+
+def composite_masks(base, masks, colors):
+    """Blend every mask of a MaskStack over an (H, W, 3) uint8 base in one pass.
+
+    Each mask value is the overlay's opacity (0-255), and masks are layered in
+    order, later ones on top. Rows are processed in bands so the float
+    temporaries stay within BLEND_BUDGET whatever the image size, and each
+    band only blends the masks whose box reaches into it.
+    """
+    height, width = base.shape[:2]
+    result = base.copy()
+    if len(masks) == 0:
+        return result
+
+    band_rows = max(1, BLEND_BUDGET // (len(masks) * width))
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        indices, band = masks.band(top, bottom)
+        if not indices:
+            continue
+
+        alpha = band.astype(np.float32)
+        alpha *= 1.0 / 255.0
+
+        # visible[i] is how much of layer i survives the layers above it
+        visible = np.cumprod((1.0 - alpha)[::-1], axis=0)[::-1]
+        weights = alpha
+        weights[:-1] *= visible[1:]
+
+        blended = base[top:bottom].astype(np.float32) * visible[0][..., None]
+        blended += np.einsum('nhw,nc->hwc', weights, colors[indices])
+        np.clip(blended + 0.5, 0, 255, out=blended)
+        result[top:bottom] = blended.astype(np.uint8)
+
+    return result
+
+
+def encode_rle(mask, threshold=128):
+    """Run-length encode a mask as {'size': [h, w], 'counts': [...]}.
+
+    Pixels at or above threshold are set. Runs go down the columns and
+    alternate unset/set starting with unset, as in COCO's uncompressed RLE.
+    Returns the encoding and the number of set pixels.
+    """
+    binary = np.asarray(mask) >= threshold
+    flat = binary.ravel(order='F')
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size]))).tolist()
+    if flat.size and flat[0]:
+        counts.insert(0, 0)
+    return {'size': list(binary.shape), 'counts': counts}, int(binary.sum())
+
+
+def composite_crop(base, mask, color, bounds):
+    # A single mask blended over just the region it covers
+    x_min, y_min, x_max, y_max = bounds
+    alpha = mask[..., None].astype(np.float32) * (1.0 / 255.0)
+    region = base[y_min:y_max, x_min:x_max].astype(np.float32)
+    blended = region * (1.0 - alpha) + color * alpha
+    return np.clip(blended + 0.5, 0, 255).astype(np.uint8)
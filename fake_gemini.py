@@ -0,0 +1,354 @@
+import asyncio
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+
+from google.genai import errors, types
+from PIL import Image, ImageDraw
+
+# Stand-in for genai.Client that answers from recorded responses, for load
+# tests and benchmarks that shouldn't spend quota or need the network.
+#
+#   GEMINI_BACKEND=fake python app.py
+#
+# Responses are real google.genai types, so the app's parsing, rendering and
+# saving code runs exactly as it does against the API.
+
+STATUS_NAMES = {404: 'NOT_FOUND', 429: 'RESOURCE_EXHAUSTED', 500: 'INTERNAL', 503: 'UNAVAILABLE',
+                504: 'DEADLINE_EXCEEDED'}
+
+TEXT_ANSWER = ("The image shows a tabby cat sitting on a wooden windowsill next to a potted plant. "
+               "Sunlight comes in from the left and the background is a slightly blurred garden.")
+
+
+def _png(image):
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _mask_png(size=64):
+    mask = Image.new('L', (size, size), 0)
+    ImageDraw.Draw(mask).ellipse((size // 8, size // 8, size - size // 8, size - size // 8), fill=255)
+    return base64.b64encode(_png(mask)).decode('ascii')
+
+
+def default_recordings():
+    """Synthetic responses of each kind, shaped like the ones the API returns."""
+    boxes = [[120, 80, 620, 460, 'cat'], [300, 520, 900, 880, 'dog'], [40, 600, 240, 960, 'plant']]
+    masks = [{'box_2d': box[:4], 'mask': ('data:image/png;base64,' if i == 0 else '') + _mask_png(),
+              'label': box[4]} for i, box in enumerate(boxes)]
+    # Noise, so the generated image costs as much to decode and re-encode as a real one
+    noise = Image.effect_noise((1024, 1024), 64)
+    image = Image.merge('RGB', (noise, noise.transpose(Image.Transpose.ROTATE_90),
+                                noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    return {
+        'text': TEXT_ANSWER,
+        # Bare JSON, as the API answers calls with a response_schema
+        'bounding_boxes': json.dumps([{'box_2d': box[:4], 'label': box[4]} for box in boxes], indent=2),
+        'segmentation': json.dumps(masks),
+        'structured': json.dumps([
+            {'name': 'Whiskers', 'color': 'Orange Tabby', 'special_ability': 'Can find hidden treats anywhere'},
+            {'name': 'Shadow', 'color': 'Black', 'special_ability': 'Walks through walls at midnight'},
+        ]),
+        'reasoning': ("First I add the two numbers: 17 + 25 = 42. Then I check the result by subtracting "
+                      "25 from 42, which gives 17 again.\nFinal answer: 42"),
+        'image': base64.b64encode(_png(image)).decode('ascii'),
+    }
+
+
+def load_recordings(path):
+    """Recorded responses from a JSON file of {kind: response or [responses]}, on top of the defaults.
+
+    Kinds are text, bounding_boxes, segmentation, structured, reasoning
+    (model text) and image (a base64 encoded image). Several responses of
+    a kind are replayed in turn.
+    """
+    recordings = default_recordings()
+    if path:
+        with open(path) as recordings_file:
+            recordings.update(json.load(recordings_file))
+    return recordings
+
+
+def _json_only(text, config):
+    # Recordings made without a response_schema may wrap their JSON in a code block,
+    # which the API leaves out when it is asked for application/json
+    if getattr(config, 'response_mime_type', None) == 'application/json':
+        text = text.strip()
+        if text.startswith('```'):
+            text = text.split('\n', 1)[-1].rsplit('```', 1)[0].strip()
+    return text
+
+
+def _prompt_text(contents):
+    # Every piece of text the call sends, however the contents are shaped
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, types.Part):
+        return contents.text or ''
+    if isinstance(contents, types.Content):
+        return ' '.join(_prompt_text(part) for part in contents.parts or [])
+    if isinstance(contents, (list, tuple)):
+        return ' '.join(_prompt_text(item) for item in contents)
+    return ''
+
+
+def classify(model, contents, config=None):
+    """Which kind of recorded response a call should get."""
+    modalities = [modality.lower() for modality in getattr(config, 'response_modalities', None) or []]
+    if 'image-generation' in model or 'image' in modalities:
+        return 'image'
+    prompt = _prompt_text(contents).lower()
+    if 'segmentation mask' in prompt:
+        return 'segmentation'
+    if 'bounding box' in prompt:
+        return 'bounding_boxes'
+    if 'structured data' in prompt:
+        return 'structured'
+    if 'step by step' in prompt:
+        return 'reasoning'
+    return 'text'
+
+
+class FakeGeminiBackend:
+    """Recorded responses, latency and error injection shared by all fake clients.
+
+    Each call sleeps latency seconds (+/- jitter as a fraction) and fails with
+    probability error_rate, with one of error_codes. 429s carry a RetryInfo
+    hint of retry_delay seconds, like the real API.
+    """
+
+    def __init__(self, recordings=None, latency=0.5, jitter=0.2, error_rate=0.0, error_codes=(429, 503),
+                 retry_delay=1.0, stream_chunk_chars=24, seed=None):
+        self.recordings = recordings or default_recordings()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.retry_delay = retry_delay
+        self.stream_chunk_chars = stream_chunk_chars
+        self._random = random.Random(seed)
+        self._cycles = {}
+        # Recorded images decoded once, so the stand-in adds no CPU time of its own
+        self._images = {}
+        self._files = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.calls = 0
+        self.errors = 0
+        self.by_kind = {}
+
+    def delay(self):
+        with self._lock:
+            spread = self._random.uniform(-self.jitter, self.jitter)
+        return max(0.0, self.latency * (1 + spread))
+
+    def start_call(self, kind):
+        # Count the call and decide whether it fails
+        with self._lock:
+            self.calls += 1
+            self.by_kind[kind] = self.by_kind.get(kind, 0) + 1
+            failed = self.error_codes and self._random.random() < self.error_rate
+            code = self._random.choice(self.error_codes) if failed else None
+            if failed:
+                self.errors += 1
+        return code
+
+    def error(self, code):
+        body = {'error': {'code': code, 'message': 'Injected by the fake Gemini backend',
+                          'status': STATUS_NAMES.get(code, 'UNKNOWN')}}
+        if code == 429:
+            body['error']['details'] = [{'@type': 'type.googleapis.com/google.rpc.RetryInfo',
+                                         'retryDelay': f'{self.retry_delay:g}s'}]
+        if code < 500:
+            return errors.ClientError(code, body)
+        return errors.ServerError(code, body)
+
+    def recording(self, kind):
+        # Replays the recordings of a kind in turn
+        with self._lock:
+            cycle = self._cycles.get(kind)
+            if cycle is None:
+                values = self.recordings.get(kind, self.recordings['text'])
+                cycle = self._cycles[kind] = itertools.cycle(values if isinstance(values, list) else [values])
+            return next(cycle)
+
+    def image_bytes(self):
+        recorded = self.recording('image')
+        with self._lock:
+            data = self._images.get(recorded)
+            if data is None:
+                data = self._images[recorded] = base64.b64decode(recorded)
+            return data
+
+    def response(self, kind, config=None):
+        parts = []
+        if kind == 'image':
+            parts.append(types.Part(text='Here is the image you asked for.'))
+            parts.append(types.Part(inline_data=types.Blob(data=self.image_bytes(), mime_type='image/png')))
+            text = parts[0].text
+        else:
+            text = _json_only(self.recording(kind), config)
+            parts.append(types.Part(text=text))
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role='model', parts=parts), finish_reason='STOP')],
+            usage_metadata=self.usage(text, config),
+        )
+
+    def usage(self, text, config=None, output_tokens=None):
+        cached = 4096 if getattr(config, 'cached_content', None) else 0
+        output = output_tokens if output_tokens is not None else (len(text) + 3) // 4
+        return types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=cached + 300, cached_content_token_count=cached or None,
+            candidates_token_count=output, total_token_count=cached + 300 + output)
+
+    def stream(self, kind, config=None):
+        """(seconds to wait, response) for each chunk of a streamed response."""
+        text = _json_only(self.recording(kind), config)
+        pieces = [text[i:i + self.stream_chunk_chars] for i in range(0, len(text), self.stream_chunk_chars)] or ['']
+        total = self.delay()
+        # Half the latency before the first token, the rest spread over the chunks
+        waits = [total / 2] + [total / 2 / max(1, len(pieces) - 1)] * (len(pieces) - 1)
+        sent = ''
+        for wait, piece in zip(waits, pieces):
+            sent += piece
+            yield wait, types.GenerateContentResponse(
+                candidates=[types.Candidate(content=types.Content(role='model', parts=[types.Part(text=piece)]))],
+                usage_metadata=self.usage(sent, config),
+            )
+
+    def generated_images(self):
+        image = types.Image(image_bytes=self.image_bytes(), mime_type='image/png')
+        return types.GenerateImagesResponse(generated_images=[types.GeneratedImage(image=image)])
+
+    def upload(self, data, mime_type):
+        name = f'files/{uuid.uuid4().hex[:12]}'
+        uploaded = types.File(name=name, uri=f'https://generativelanguage.googleapis.com/v1beta/{name}',
+                              mime_type=mime_type, size_bytes=len(data), state='ACTIVE',
+                              expiration_time=datetime.now(timezone.utc) + timedelta(hours=48))
+        with self._lock:
+            self._files[name] = uploaded
+        return uploaded
+
+    def get_file(self, name):
+        with self._lock:
+            uploaded = self._files.get(name)
+        if uploaded is None:
+            raise self.error(404)
+        return uploaded
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'errors': self.errors, 'by_kind': dict(self.by_kind),
+                    'files': len(self._files)}
+
+
+class _FakeModels:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def generate_content(self, *, model, contents, config=None):
+        kind = classify(model, contents, config)
+        code = self._backend.start_call(kind)
+        time.sleep(self._backend.delay())
+        if code:
+            raise self._backend.error(code)
+        return self._backend.response(kind, config)
+
+    def generate_content_stream(self, *, model, contents, config=None):
+        kind = classify(model, contents, config)
+        code = self._backend.start_call(kind)
+        if code:
+            time.sleep(self._backend.delay() / 2)
+            raise self._backend.error(code)
+        for wait, chunk in self._backend.stream(kind, config):
+            time.sleep(wait)
+            yield chunk
+
+    def generate_images(self, *, model, prompt, config=None):
+        code = self._backend.start_call('image')
+        time.sleep(self._backend.delay())
+        if code:
+            raise self._backend.error(code)
+        return self._backend.generated_images()
+
+
+class _FakeAsyncModels:
+    def __init__(self, backend):
+        self._backend = backend
+
+    async def generate_content(self, *, model, contents, config=None):
+        kind = classify(model, contents, config)
+        code = self._backend.start_call(kind)
+        await asyncio.sleep(self._backend.delay())
+        if code:
+            raise self._backend.error(code)
+        return self._backend.response(kind, config)
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        kind = classify(model, contents, config)
+        code = self._backend.start_call(kind)
+
+        async def chunks():
+            if code:
+                await asyncio.sleep(self._backend.delay() / 2)
+                raise self._backend.error(code)
+            for wait, chunk in self._backend.stream(kind, config):
+                await asyncio.sleep(wait)
+                yield chunk
+
+        return chunks()
+
+    async def generate_images(self, *, model, prompt, config=None):
+        code = self._backend.start_call('image')
+        await asyncio.sleep(self._backend.delay())
+        if code:
+            raise self._backend.error(code)
+        return self._backend.generated_images()
+
+
+class _FakeFiles:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def upload(self, *, file, config=None):
+        return self._backend.upload(file.read(), getattr(config, 'mime_type', None) or 'application/octet-stream')
+
+    def get(self, *, name):
+        return self._backend.get_file(name)
+
+
+class _FakeCaches:
+    def create(self, *, model, config=None):
+        ttl = int(str(getattr(config, 'ttl', None) or '3600s').rstrip('s'))
+        return types.CachedContent(name=f'cachedContents/{uuid.uuid4().hex[:12]}', model=model,
+                                   expire_time=datetime.now(timezone.utc) + timedelta(seconds=ttl))
+
+    def update(self, *, name, config=None):
+        return types.CachedContent(name=name)
+
+    def delete(self, *, name):
+        return None
+
+
+class _FakeAio:
+    def __init__(self, backend):
+        self.models = _FakeAsyncModels(backend)
+
+
+class FakeGeminiClient:
+    """The parts of genai.Client the app uses, backed by a FakeGeminiBackend."""
+
+    def __init__(self, backend):
+        self.models = _FakeModels(backend)
+        self.aio = _FakeAio(backend)
+        self.files = _FakeFiles(backend)
+        self.caches = _FakeCaches()
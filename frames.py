@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+from io import BytesIO
+
+from PIL import Image, ImageOps, ImageSequence
+
+from batch import iter_archive_images
+from perceptual import phash, hamming
+
+logger = logging.getLogger(__name__)
+
+try:
+    # Decodes video containers; without it only animated images and archives of frames are read
+    import av
+except ImportError:
+    av = None
+
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.m4v', '.mkv', '.webm', '.avi', '.mpg', '.mpeg', '.ts'}
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz')
+
+
+def is_archive_name(name):
+    return (name or '').lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_video_name(name):
+    return os.path.splitext(name or '')[1].lower() in VIDEO_EXTENSIONS
+
+
+def iter_frames(stream, filename):
+    """Yield (name, seconds, PIL image) for each frame of a video, animated image or archive of frames.
+
+    Archives are read in their own order and have no timestamps. Videos need
+    PyAV; a ValueError is raised if it isn't installed.
+    """
+    if is_archive_name(filename):
+        for name, data in iter_archive_images(stream, filename):
+            image = Image.open(BytesIO(data))
+            ImageOps.exif_transpose(image, in_place=True)
+            yield name, None, image
+        return
+
+    if is_video_name(filename):
+        if av is None:
+            raise ValueError("Reading video needs PyAV (pip install av), or send the frames as an archive")
+        with av.open(stream) as container:
+            video = container.streams.video[0]
+            # Decode on FFmpeg's own threads
+            video.thread_type = 'AUTO'
+            for index, frame in enumerate(container.decode(video)):
+                yield f'frame_{index}', frame.time, frame.to_image()
+        return
+
+    # GIF, WebP, APNG or a single image
+    image = Image.open(stream)
+    seconds = 0.0
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        yield f'frame_{index}', round(seconds, 3), frame
+        seconds += frame.info.get('duration', 0) / 1000
+
+
+def encode_frame(image, max_edge=1536, quality=85):
+    """JPEG of a frame for the model, downscaled to max_edge, and the size it was sent at."""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > max_edge:
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue(), image.size
+
+
+class FrameSampler:
+    """Picks the frames of a sequence worth sending to the model.
+
+    Each frame is hashed with phash() and compared to the last frame that was
+    kept: frames within threshold bits of it are skipped and reuse its
+    result, so a static scene costs one model call. Comparing to the last
+    kept frame rather than the previous one means slow drift still adds up
+    to a new keyframe. With max_gap, a frame is kept at least that often.
+    """
+
+    def __init__(self, threshold=6, max_gap=0):
+        self.threshold = threshold
+        self.max_gap = max_gap
+        self._lock = threading.Lock()
+
+        # Counters
+        self.sequences = 0
+        self.frames = 0
+        self.kept = 0
+
+    def sample(self, frames, threshold=None, max_gap=None):
+        """Yield (index, name, seconds, image, reference, distance) for each frame.
+
+        reference is None for a kept frame, otherwise the index of the kept
+        frame it duplicates.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        max_gap = self.max_gap if max_gap is None else max_gap
+        with self._lock:
+            self.sequences += 1
+        last_index = last_hash = None
+
+        for index, (name, seconds, image) in enumerate(frames):
+            frame_hash = phash(image)
+            distance = None if last_hash is None else hamming(frame_hash, last_hash)
+            keep = (distance is None or distance > threshold
+                    or (max_gap and index - last_index >= max_gap))
+            with self._lock:
+                self.frames += 1
+                self.kept += bool(keep)
+            if keep:
+                last_index, last_hash = index, frame_hash
+                yield index, name, seconds, image, None, distance
+            else:
+                yield index, name, seconds, image, last_index, distance
+
+    def stats(self):
+        with self._lock:
+            return {
+                'threshold': self.threshold,
+                'max_gap': self.max_gap,
+                'sequences': self.sequences,
+                'frames': self.frames,
+                'kept': self.kept,
+                'skipped': self.frames - self.kept,
+            }
@@ -0,0 +1,297 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+from instrumentation import fallback_attempt
+
+logger = logging.getLogger(__name__)
+
+# Set once the hedged attempt running in this context has lost, see attempt_abandoned()
+_abandoned = contextvars.ContextVar('hedge_abandoned', default=None)
+
+
+class AttemptAbandoned(Exception):
+    pass
+
+
+@contextmanager
+def abandon_on(event):
+    # The attempt run inside the block stops at its next check once event is set
+    token = _abandoned.set(event)
+    try:
+        yield
+    finally:
+        _abandoned.reset(token)
+
+
+def attempt_abandoned():
+    """True once another attempt of the hedged call this runs in has won.
+
+    Checked between retries and while queueing for quota, a request already
+    sent to the API can't be taken back.
+    """
+    event = _abandoned.get()
+    return event is not None and event.is_set()
+
+
+def sleep_unless_abandoned(seconds):
+    # Like time.sleep, but a losing attempt wakes up as soon as the winner is known
+    event = _abandoned.get()
+    if event is None:
+        time.sleep(seconds)
+    else:
+        event.wait(seconds)
+
+
+class LatencyTracker:
+    """Keeps a window of recent successful call latencies per model."""
+
+    def __init__(self, window=500):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, seconds):
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, model, pct, min_samples=1):
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def timed(self, model, func):
+        start = time.perf_counter()
+        result = func()
+        self.record(model, time.perf_counter() - start)
+        return result
+
+    async def timed_async(self, model, func):
+        start = time.perf_counter()
+        result = await func()
+        self.record(model, time.perf_counter() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            models = list(self._samples)
+        result = {}
+        for model in models:
+            result[model] = {
+                'count': len(self._samples[model]),
+                'p50': self.percentile(model, 50),
+                'p90': self.percentile(model, 90),
+                'p99': self.percentile(model, 99),
+            }
+        return result
+
+
+class HedgePolicy:
+    """Decides how long to wait on one model before also trying the next one.
+
+    mode is 'serial' (only after a failure or unusable result), 'parallel'
+    (all at once) or 'hedge' (after a delay). delay is a number of seconds or
+    'auto', which uses the chosen percentile of the model's recent latency.
+    """
+
+    def __init__(self, mode='hedge', delay='auto', percentile=90, min_delay=0.5, max_delay=30.0,
+                 default_delay=8.0, min_samples=20):
+        self.mode = mode
+        self.delay = delay
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hedged_calls = 0
+        self.fallbacks_started = 0
+        self.abandoned = 0
+        self.cancelled = 0
+
+    def record(self, fallbacks_started, abandoned=0, cancelled=0):
+        # abandoned losers were already running when the winner came back, cancelled ones never started
+        with self._lock:
+            self.hedged_calls += 1
+            self.fallbacks_started += fallbacks_started
+            self.abandoned += abandoned
+            self.cancelled += cancelled
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'hedged_calls': self.hedged_calls,
+                'fallbacks_started': self.fallbacks_started,
+                'abandoned': self.abandoned,
+                'cancelled': self.cancelled,
+            }
+
+    def delay_for(self, model, tracker):
+        if self.mode == 'parallel':
+            return 0.0
+        if self.mode == 'serial':
+            return None
+        if self.delay != 'auto':
+            return float(self.delay)
+        observed = tracker.percentile(model, self.percentile, self.min_samples)
+        if observed is None:
+            return self.default_delay
+        return min(max(observed, self.min_delay), self.max_delay)
+
+
+class _HedgeState:
+    # Bookkeeping shared by the sync and async runners
+    def __init__(self, attempts, policy, tracker):
+        self.attempts = attempts
+        self.policy = policy
+        self.tracker = tracker
+        self.next_index = 0
+        self.last_launch = None
+        self.first_unusable = None
+        self.last_error = None
+
+    def hedge_timeout(self):
+        # Seconds left before the next attempt should be fired, None to wait indefinitely
+        if self.next_index >= len(self.attempts):
+            return None
+        previous_model = self.attempts[self.next_index - 1][0]
+        delay = self.policy.delay_for(previous_model, self.tracker)
+        if delay is None:
+            return None
+        return max(0.0, delay - (time.monotonic() - self.last_launch))
+
+    def handle(self, index, get_result):
+        # Returns (model, result) if this attempt produced something usable
+        model, _, is_usable = self.attempts[index]
+        try:
+            result = get_result()
+        except Exception as e:
+            logger.warning("%s failed: %s", model, e)
+            self.last_error = e
+            return None
+        if is_usable(result):
+            return model, result
+        logger.warning("%s returned no usable result", model)
+        if self.first_unusable is None:
+            self.first_unusable = (model, result)
+        return None
+
+    def finish(self):
+        # Nothing usable came back: prefer a completed (if unusable) response over an error
+        if self.first_unusable is not None:
+            return self.first_unusable
+        raise self.last_error or RuntimeError('All models failed')
+
+
+def run_hedged(attempts, policy, tracker, executor):
+    """Run a fallback chain of (model, func, is_usable) attempts with hedging.
+
+    Returns (model, result) for the first usable result. Calls still running
+    are abandoned: queued ones are cancelled, started ones stop at their next
+    retry or quota wait (see attempt_abandoned()), and a request already sent
+    finishes in the background with its result discarded.
+    """
+    state = _HedgeState(attempts, policy, tracker)
+    pending = {}
+    abandoned = threading.Event()
+
+    def launch():
+        model, func, _ = attempts[state.next_index]
+        if state.next_index > 0:
+            logger.info("Starting %s as a fallback", model)
+        index = state.next_index
+
+        def attempt():
+            # A hedge that was queued behind others never starts once there is a winner
+            if abandoned.is_set():
+                raise AttemptAbandoned(f"{model} was not needed")
+            # Model calls are labelled with their place in the fallback chain
+            with fallback_attempt(index), abandon_on(abandoned):
+                return tracker.timed(model, func)
+
+        # Carry the caller's context (e.g. its scheduling priority) into the worker thread
+        pending[executor.submit(contextvars.copy_context().run, attempt)] = index
+        state.next_index += 1
+        state.last_launch = time.monotonic()
+
+    launch()
+    while pending:
+        done, _ = wait(pending, timeout=state.hedge_timeout(), return_when=FIRST_COMPLETED)
+        if not done:
+            # The current model is slower than the hedge delay, fire the next one too
+            launch()
+            continue
+
+        for future in done:
+            winner = state.handle(pending.pop(future), future.result)
+            if winner is not None:
+                abandoned.set()
+                cancelled = sum(1 for loser in pending if loser.cancel())
+                policy.record(state.next_index - 1, abandoned=len(pending) - cancelled, cancelled=cancelled)
+                return winner
+
+        if not pending and state.next_index < len(attempts):
+            # Everything in flight failed, move on without waiting for the delay
+            launch()
+
+    policy.record(state.next_index - 1)
+    return state.finish()
+
+
+async def run_hedged_async(attempts, policy, tracker):
+    """Async version of run_hedged, attempts hold coroutine functions.
+
+    Losing calls are cancelled.
+    """
+    state = _HedgeState(attempts, policy, tracker)
+    pending = {}
+
+    def launch():
+        model, func, _ = attempts[state.next_index]
+        if state.next_index > 0:
+            logger.info("Starting %s as a fallback", model)
+        index = state.next_index
+
+        async def attempt():
+            with fallback_attempt(index):
+                return await tracker.timed_async(model, func)
+
+        pending[asyncio.ensure_future(attempt())] = index
+        state.next_index += 1
+        state.last_launch = time.monotonic()
+
+    launch()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=state.hedge_timeout(), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch()
+                continue
+
+            for task in done:
+                winner = state.handle(pending.pop(task), task.result)
+                if winner is not None:
+                    return winner
+
+            if not pending and state.next_index < len(attempts):
+                launch()
+
+        return state.finish()
+    finally:
+        for task in pending:
+            task.cancel()
+        policy.record(state.next_index - 1, abandoned=len(pending))
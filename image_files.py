@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from io import BytesIO
+
+from google.genai import types
+
+from client_pool import hash_api_key
+
+logger = logging.getLogger(__name__)
+
+
+class ImageFile:
+    """An image uploaded to the Gemini Files API, referred to by an opaque handle."""
+
+    def __init__(self, api_key_hash, sha256, name, uri, mime_type, expires_at, image_path=None):
+        self.handle = uuid.uuid4().hex
+        self.api_key_hash = api_key_hash
+        self.sha256 = sha256
+        self.name = name
+        self.uri = uri
+        self.mime_type = mime_type
+        self.expires_at = expires_at
+        self.image_path = image_path
+
+    def part(self):
+        return types.Part.from_uri(file_uri=self.uri, mime_type=self.mime_type)
+
+    def expires_in(self):
+        return max(0, int(self.expires_at - time.monotonic()))
+
+
+class ImageFileStore:
+    """Uploads each image once through the Files API and hands out reusable handles.
+
+    Files are deduplicated by the SHA-256 of the bytes sent and by API key, as
+    uploaded files belong to the key's project. Handles expire a safety margin
+    before the file itself does (the Files API keeps files for 48 hours), and
+    concurrent uploads of the same image share a single upload.
+    """
+
+    def __init__(self, max_files=1024, default_ttl=48 * 3600, expiry_margin=600, processing_timeout=30):
+        self.max_files = max_files
+        self.default_ttl = default_ttl
+        self.expiry_margin = expiry_margin
+        self.processing_timeout = processing_timeout
+
+        # handle -> file, and (key hash, sha256) -> file, both oldest first
+        self._handles = OrderedDict()
+        self._by_digest = OrderedDict()
+        # (key hash, sha256) -> Event set when an upload in progress finishes
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.uploads = 0
+        self.upload_failures = 0
+        self.reused = 0
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+        self.expired = 0
+
+    def upload(self, client, api_key, data, mime_type, image_path=None):
+        """Return (image_file, reused) for these image bytes, uploading them if needed."""
+        key = (hash_api_key(api_key), hashlib.sha256(data).hexdigest())
+        while True:
+            with self._lock:
+                self._expire(time.monotonic())
+                image_file = self._by_digest.get(key)
+                if image_file is not None:
+                    self.reused += 1
+                    self.bytes_saved += len(data)
+                    self._by_digest.move_to_end(key)
+                    return image_file, True
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    break
+            # Someone else is uploading these bytes, use their file once it's there
+            pending.wait()
+
+        try:
+            uploaded = self._upload(client, data, mime_type)
+            image_file = ImageFile(key[0], key[1], uploaded.name, uploaded.uri, uploaded.mime_type or mime_type,
+                                   self._expires_at(uploaded), image_path)
+            with self._lock:
+                self._handles[image_file.handle] = image_file
+                self._by_digest[key] = image_file
+                while len(self._handles) > self.max_files:
+                    self._forget(next(iter(self._handles.values())))
+                self.uploads += 1
+                self.bytes_uploaded += len(data)
+        except Exception:
+            with self._lock:
+                self.upload_failures += 1
+            raise
+        finally:
+            # Registered (or failed) before waiters wake up, so they never upload the same bytes again
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+        logger.info("Uploaded image as %s, %d bytes", uploaded.name, len(data))
+        return image_file, False
+
+    def get(self, handle, api_key):
+        # Handles only work for the API key that uploaded the file
+        with self._lock:
+            self._expire(time.monotonic())
+            image_file = self._handles.get(handle)
+            if image_file is None or image_file.api_key_hash != hash_api_key(api_key):
+                return None
+            return image_file
+
+    def _upload(self, client, data, mime_type):
+        uploaded = client.files.upload(file=BytesIO(data), config=types.UploadFileConfig(mime_type=mime_type))
+        # Files are usable once they leave the PROCESSING state, images normally skip it
+        deadline = time.monotonic() + self.processing_timeout
+        while uploaded.state is not None and uploaded.state.name == 'PROCESSING':
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"File {uploaded.name} is still processing")
+            time.sleep(0.5)
+            uploaded = client.files.get(name=uploaded.name)
+        if uploaded.state is not None and uploaded.state.name == 'FAILED':
+            raise RuntimeError(f"File {uploaded.name} could not be processed")
+        return uploaded
+
+    def _expires_at(self, uploaded):
+        # Trust the expiration the API reports, fall back to the documented TTL
+        ttl = self.default_ttl
+        if uploaded.expiration_time is not None:
+            ttl = (uploaded.expiration_time - datetime.now(timezone.utc)).total_seconds()
+        return time.monotonic() + ttl - self.expiry_margin
+
+    def _forget(self, image_file):
+        self._handles.pop(image_file.handle, None)
+        self._by_digest.pop((image_file.api_key_hash, image_file.sha256), None)
+
+    def _expire(self, now):
+        expired = [image_file for image_file in self._handles.values() if image_file.expires_at <= now]
+        for image_file in expired:
+            self._forget(image_file)
+        self.expired += len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._handles),
+                'uploads': self.uploads,
+                'upload_failures': self.upload_failures,
+                'reused': self.reused,
+                'bytes_uploaded': self.bytes_uploaded,
+                'bytes_saved': self.bytes_saved,
+                'expired': self.expired,
+            }
@@ -0,0 +1,146 @@
+import threading
+import time
+from io import BytesIO
+
+from PIL import ExifTags, Image, ImageOps
+
+# EXIF orientations whose upright image has width and height swapped
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+# Formats we can re-encode to, with the mime type sent to the model
+OUTPUT_FORMATS = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+    'PNG': 'image/png',
+}
+
+
+class PreparedImage:
+    """Image bytes as sent to the model, plus what's needed to map results back.
+
+    scale_x/scale_y convert pixel coordinates in the sent image to pixel
+    coordinates in the original upload, both upright as its EXIF
+    orientation says.
+    """
+
+    def __init__(self, data, mime_type, original_size, sent_size, original_bytes, seconds):
+        self.data = data
+        self.mime_type = mime_type
+        self.original_size = original_size
+        self.sent_size = sent_size
+        self.original_bytes = original_bytes
+        self.seconds = seconds
+
+    @property
+    def scale_x(self):
+        if not self.original_size or not self.sent_size:
+            return 1.0
+        return self.original_size[0] / self.sent_size[0]
+
+    @property
+    def scale_y(self):
+        if not self.original_size or not self.sent_size:
+            return 1.0
+        return self.original_size[1] / self.sent_size[1]
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - len(self.data)
+
+    def summary(self):
+        return {
+            'original_size': list(self.original_size) if self.original_size else None,
+            'sent_size': list(self.sent_size) if self.sent_size else None,
+            'original_bytes': self.original_bytes,
+            'sent_bytes': len(self.data),
+            'bytes_saved': self.bytes_saved,
+            'seconds': round(self.seconds, 4),
+        }
+
+
+class PreprocessStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.resized = 0
+        self.original_bytes = 0
+        self.sent_bytes = 0
+        self.seconds = 0.0
+
+    def record(self, prepared):
+        with self._lock:
+            self.images += 1
+            if prepared.sent_size and prepared.sent_size != prepared.original_size:
+                self.resized += 1
+            self.original_bytes += prepared.original_bytes
+            self.sent_bytes += len(prepared.data)
+            self.seconds += prepared.seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                'images': self.images,
+                'resized': self.resized,
+                'original_bytes': self.original_bytes,
+                'sent_bytes': self.sent_bytes,
+                'bytes_saved': self.original_bytes - self.sent_bytes,
+                'seconds': round(self.seconds, 4),
+            }
+
+
+def exif_orientation(image):
+    return image.getexif().get(ExifTags.Base.Orientation, 1)
+
+
+def passthrough_image(image_data, mime_type):
+    # Send the upload unchanged, still reporting its size so results can be mapped
+    start = time.perf_counter()
+    with Image.open(BytesIO(image_data)) as image:
+        size = image.size
+        orientation = exif_orientation(image)
+    if orientation != 1:
+        # Stored sideways: the model might read the pixels as stored while results are drawn upright
+        return prepare_image(image_data, mime_type, max_edge=max(size),
+                             output_format='PNG' if mime_type == 'image/png' else 'JPEG', quality=95)
+    return PreparedImage(image_data, mime_type, size, size, len(image_data), time.perf_counter() - start)
+
+
+def prepare_image(image_data, mime_type, max_edge=1536, output_format='JPEG', quality=85):
+    """Turn an upload upright, downscale it to max_edge, re-encode it and drop EXIF and other metadata."""
+    start = time.perf_counter()
+    image = Image.open(BytesIO(image_data))
+    width, height = image.size
+    # Sizes are of the upright image, that's the one results are drawn on
+    original_size = (height, width) if exif_orientation(image) in TRANSPOSED_ORIENTATIONS else (width, height)
+    had_metadata = bool(image.info.get('exif') or image.info.get('icc_profile') or image.info.get('xmp'))
+
+    needs_resize = max(original_size) > max_edge
+    if needs_resize:
+        # Let the JPEG decoder skip straight to a smaller scale when it can
+        image.draft('RGB', (max_edge, max_edge))
+
+    # Before the EXIF is dropped, or the model would get the pixels as stored, sideways
+    ImageOps.exif_transpose(image, in_place=True)
+
+    if output_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    if needs_resize:
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    # Saving without exif/icc arguments strips the metadata
+    buffer = BytesIO()
+    save_args = {'optimize': True} if output_format == 'PNG' else {'quality': quality}
+    image.save(buffer, format=output_format, **save_args)
+    data = buffer.getvalue()
+    sent_size = image.size
+    sent_mime_type = OUTPUT_FORMATS[output_format]
+
+    # A small, clean image can come out bigger after re-encoding, keep the original then
+    if not needs_resize and not had_metadata and len(data) >= len(image_data):
+        data, sent_mime_type = image_data, mime_type
+
+    return PreparedImage(data, sent_mime_type, original_size, sent_size, len(image_data),
+                         time.perf_counter() - start)
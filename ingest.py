@@ -0,0 +1,222 @@
+import contextvars
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+# Upload writes queued by the current request, see UploadStore.track_writes()
+_queued_writes = contextvars.ContextVar('queued_upload_writes', default=None)
+
+
+class Upload:
+    """An uploaded file read once.
+
+    Small uploads stay in memory: the same bytes are handed to the model call
+    and to PIL, and are written to disk in the background under a
+    content-addressed name. Larger ones are spooled straight to that file and
+    only read back when a caller asks for their bytes.
+    """
+
+    def __init__(self, data, sha256, filename, mime_type, path, size=None):
+        self._data = data
+        self.sha256 = sha256
+        self.filename = filename
+        self.mime_type = mime_type
+        self.path = path
+        self.size = len(data) if size is None else size
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.path, 'rb') as stored:
+                self._data = stored.read()
+        return self._data
+
+    def open(self):
+        # A binary stream over the upload, without reading a spooled one into memory
+        if self._data is None:
+            return open(self.path, 'rb')
+        return BytesIO(self._data)
+
+    def open_image(self):
+        # Upright, like the image the model is sent, so results line up with it
+        image = Image.open(self.open())
+        ImageOps.exif_transpose(image, in_place=True)
+        return image
+
+
+class UploadStore:
+    def __init__(self, folder, executor, chunk_size=1024 * 1024, spool_max_size=16 * 1024 * 1024):
+        self.folder = folder
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.spool_max_size = spool_max_size
+        self._lock = threading.Lock()
+        self._pending = {}
+
+        # Counters
+        self.uploads = 0
+        self.bytes_read = 0
+        self.written = 0
+        self.spooled = 0
+        self.deduplicated = 0
+        self.write_errors = 0
+
+    def ingest(self, file):
+        # Read the upload stream in chunks, hashing as we go
+        hasher = hashlib.sha256()
+        buffer = BytesIO()
+        spool = None
+        size = 0
+        with stage('ingest'):
+            try:
+                while True:
+                    chunk = file.stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    # Past the threshold the rest goes to a temporary file that is later renamed into place
+                    if spool is None and size > self.spool_max_size:
+                        spool = tempfile.NamedTemporaryFile(dir=self.folder, suffix='.tmp', delete=False)
+                        spool.write(buffer.getvalue())
+                        buffer = None
+                    (buffer if spool is None else spool).write(chunk)
+            except Exception:
+                if spool is not None:
+                    spool.close()
+                    os.remove(spool.name)
+                raise
+            if spool is not None:
+                spool.close()
+
+        if spool is None:
+            return self._store(buffer.getvalue(), hasher.hexdigest(), file.filename, file.content_type)
+        return self._store_spooled(spool.name, size, hasher.hexdigest(), file.filename, file.content_type)
+
+    def ingest_bytes(self, data, filename, mime_type=None):
+        # For images that did not arrive as their own upload, e.g. archive members
+        if mime_type is None:
+            mime_type = mimetypes.guess_type(filename or '')[0]
+        return self._store(data, hashlib.sha256(data).hexdigest(), filename, mime_type)
+
+    def _store(self, data, digest, filename, mime_type):
+        if not data:
+            return None
+
+        path = os.path.join(self.folder, f"{digest}{self._extension(filename, mime_type)}")
+        name = os.path.basename(path)
+        submitted = False
+        with self._lock:
+            self.uploads += 1
+            self.bytes_read += len(data)
+            future = self._pending.get(name)
+            # Identical uploads map to the same file, so there is nothing to write twice
+            if future is not None or os.path.exists(path):
+                self.deduplicated += 1
+            else:
+                # The write is timed under the route of the request that uploaded the file
+                future = self.executor.submit(contextvars.copy_context().run, self._persist, path, data)
+                self._pending[name] = future
+                submitted = True
+        if submitted:
+            future.add_done_callback(lambda done: self._finished(name, done))
+
+        # The path goes out with the response, so the request waits for the write before answering
+        if future is not None:
+            queued = _queued_writes.get()
+            if queued is not None:
+                queued.append(future)
+        return Upload(data, digest, filename, mime_type, path)
+
+    def _store_spooled(self, temp_path, size, digest, filename, mime_type):
+        # The spooled file is already complete, so it is renamed into place right away
+        path = os.path.join(self.folder, f"{digest}{self._extension(filename, mime_type)}")
+        with self._lock:
+            self.uploads += 1
+            self.bytes_read += size
+            self.spooled += 1
+            duplicate = os.path.exists(path)
+            if duplicate:
+                self.deduplicated += 1
+        if duplicate:
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+        return Upload(None, digest, filename, mime_type, path, size=size)
+
+    def _finished(self, name, future):
+        with self._lock:
+            if self._pending.get(name) is future:
+                del self._pending[name]
+
+    def _persist(self, path, data):
+        # Write to a temporary name first so readers never see a partial file
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with stage('disk_write'):
+                with open(temp_path, 'wb') as temp_file:
+                    temp_file.write(data)
+                os.replace(temp_path, path)
+            with self._lock:
+                self.written += 1
+        except OSError as e:
+            logger.error("Error writing upload %s: %s", path, e)
+            with self._lock:
+                self.write_errors += 1
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def wait(self, filename, timeout=30):
+        """Block until an upload that is still being written is on disk (or failed)."""
+        with self._lock:
+            future = self._pending.get(os.path.basename(filename))
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+
+    def track_writes(self):
+        """Collect the upload writes queued from this context from now on, returns them for wait_for()."""
+        queued = []
+        _queued_writes.set(queued)
+        return queued
+
+    def wait_for(self, queued, timeout=30):
+        """Block until the collected writes are on disk (or failed), emptying the collection."""
+        while queued:
+            try:
+                queued.pop().result(timeout=timeout)
+            except Exception:
+                pass
+
+    @staticmethod
+    def _extension(filename, mime_type):
+        extension = os.path.splitext(filename or '')[1].lower()
+        if not extension and mime_type:
+            extension = mimetypes.guess_extension(mime_type) or ''
+        # Only keep short, plain extensions from user supplied names
+        if len(extension) > 6 or not extension[1:].isalnum():
+            return ''
+        return extension
+
+    def stats(self):
+        with self._lock:
+            return {
+                'uploads': self.uploads,
+                'bytes_read': self.bytes_read,
+                'written': self.written,
+                'spooled': self.spooled,
+                'deduplicated': self.deduplicated,
+                'write_errors': self.write_errors,
+            }
@@ -0,0 +1,277 @@
+import bisect
+import contextvars
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Request the current code runs for, carried into worker threads that copy the caller's context
+_route = contextvars.ContextVar('route', default='-')
+_request_id = contextvars.ContextVar('request_id', default=None)
+# Position of the model in a fallback chain, 0 for the first choice
+_fallback_attempt = contextvars.ContextVar('fallback_attempt', default=0)
+
+# Seconds, from a quick cache hit up to a slow image generation with retries
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            # Buckets are cumulative in the exposition format
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(round(total, 6))}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """Counters and histograms rendered in the Prometheus text exposition format.
+
+    Collectors are called at scrape time and return {subsystem: stats dict};
+    their numeric values are exported as the app_stats gauge, so the runtime
+    counters behind /stats can be scraped too.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        samples = []
+        for collect in self._collectors:
+            for subsystem, stats in collect().items():
+                samples.extend((subsystem, name, value) for name, value in _flatten(stats))
+        if samples:
+            lines.append('# HELP app_stats Runtime counters of the shared subsystems, as reported by /stats')
+            lines.append('# TYPE app_stats gauge')
+            for subsystem, name, value in samples:
+                lines.append(f'app_stats{_format_labels(("subsystem", "stat"), (subsystem, name))} '
+                             f'{_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _flatten(stats, prefix=''):
+    # Nested dicts become dotted names, anything that isn't a number is skipped
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f'{prefix}{name}.')
+        elif isinstance(value, bool):
+            yield f'{prefix}{name}', int(value)
+        elif isinstance(value, (int, float)):
+            yield f'{prefix}{name}', value
+
+
+metrics = MetricsRegistry()
+REQUEST_SECONDS = metrics.histogram(
+    'http_request_duration_seconds', 'Time until the response starts, by route and status',
+    ('route', 'method', 'status'))
+STAGE_SECONDS = metrics.histogram(
+    'stage_duration_seconds', 'Time spent in each stage of handling a request', ('route', 'stage'))
+MODEL_CALL_SECONDS = metrics.histogram(
+    'model_call_duration_seconds', 'Duration of each Gemini API call, by model and fallback attempt',
+    ('route', 'model', 'attempt', 'outcome'))
+STAGE_ERRORS = metrics.counter(
+    'stage_errors_total', 'Stages that raised an exception', ('route', 'stage'))
+
+
+def current_route():
+    return _route.get()
+
+
+def start_request(route, request_id=None):
+    """Label everything that follows with this route, returns the request id."""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    _route.set(route)
+    _request_id.set(request_id)
+    return request_id
+
+
+@contextmanager
+def route_context(route):
+    # For work done outside a request, e.g. background jobs
+    token = _route.set(route)
+    try:
+        yield
+    finally:
+        _route.reset(token)
+
+
+@contextmanager
+def fallback_attempt(index):
+    token = _fallback_attempt.set(index)
+    try:
+        yield
+    finally:
+        _fallback_attempt.reset(token)
+
+
+def observe_stage(name, seconds):
+    STAGE_SECONDS.observe(seconds, route=_route.get(), stage=name)
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the current request into stage_duration_seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(route=_route.get(), stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, route=_route.get(), stage=name)
+
+
+def observe_model_call(model, seconds, outcome):
+    MODEL_CALL_SECONDS.observe(seconds, route=_route.get(), model=model, attempt=_fallback_attempt.get(),
+                               outcome=outcome)
+
+
+# Logging
+
+# Attributes every LogRecord has, anything else was passed through extra= and is logged as a field
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'route',
+                                                                               'request_id'}
+
+
+# Libraries that would drown out the app's own logs
+QUIET_LOGGERS = ('PIL', 'httpx', 'httpcore', 'urllib3')
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds the route and request id of the current request to every record."""
+
+    def filter(self, record):
+        record.route = _route.get()
+        record.request_id = _request_id.get() or '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the request context and any extra= fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'route': getattr(record, 'route', '-'),
+            'request_id': getattr(record, 'request_id', '-'),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level='INFO', log_format='text'):
+    """Send the app's logs to stderr, as JSON lines or plain text.
+
+    Records below level are dropped before their message is formatted, so
+    debug logging (e.g. raw model responses) costs next to nothing when off.
+    """
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if getattr(handler, '_app_handler', False)]:
+        root.removeHandler(handler)
+
+    handler = logging.StreamHandler()
+    handler._app_handler = True
+    handler.addFilter(RequestContextFilter())
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(name)s [%(route)s %(request_id)s] %(message)s'))
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    # PIL logs every PNG chunk at DEBUG and httpx every API request at INFO
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
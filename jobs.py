@@ -0,0 +1,157 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from client_pool import hash_api_key
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind, func, api_key_hash):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.func = func
+        self.api_key_hash = api_key_hash
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        data = {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'done': self.finished,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        if self.status == 'done':
+            data['result'] = self.result
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+
+class JobStore:
+    """Bounded job queue served by a pool of worker threads.
+
+    Finished jobs are kept for result_ttl seconds so clients can poll or
+    subscribe for their result, then dropped.
+    """
+
+    def __init__(self, workers=4, max_queued=64, result_ttl=600):
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._changed = threading.Condition()
+
+        # Counters
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, kind, func, api_key):
+        job = Job(kind, func, hash_api_key(api_key))
+        with self._changed:
+            self._expire_finished()
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._changed:
+                del self._jobs[job.id]
+                self.rejected += 1
+            raise JobQueueFull(f'Job queue is full ({self._queue.maxsize} jobs waiting)')
+        with self._changed:
+            self.submitted += 1
+        return job
+
+    def get(self, job_id, api_key):
+        # Jobs, and the results in them, only exist for the API key that submitted them
+        with self._changed:
+            self._expire_finished()
+            job = self._jobs.get(job_id)
+            if job is None or not api_key or job.api_key_hash != hash_api_key(api_key):
+                return None
+            return job
+
+    def wait_for_change(self, job_id, last_status, timeout):
+        # Block until the job leaves last_status, or the timeout passes
+        with self._changed:
+            self._changed.wait_for(
+                lambda: job_id not in self._jobs or self._jobs[job_id].status != last_status,
+                timeout=timeout
+            )
+            return self._jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            with self._changed:
+                job.status = 'running'
+                job.started_at = time.time()
+                self._changed.notify_all()
+            try:
+                result = job.func()
+                status, error = 'done', None
+            except Exception as e:
+                logger.warning("Job %s (%s) failed: %s", job.id, job.kind, e)
+                result, status, error = None, 'failed', str(e)
+            with self._changed:
+                job.result = result
+                job.error = error
+                job.status = status
+                job.finished_at = time.time()
+                # The closure may hold uploaded image bytes, don't keep it around
+                job.func = None
+                if status == 'done':
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self._changed.notify_all()
+            self._queue.task_done()
+
+    def _expire_finished(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self.expired += len(expired)
+
+    def stats(self):
+        with self._changed:
+            running = sum(1 for job in self._jobs.values() if job.status == 'running')
+            return {
+                'queued': self._queue.qsize(),
+                'max_queued': self._queue.maxsize,
+                'running': running,
+                'workers': len(self._workers),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+                'expired': self.expired,
+            }
@@ -0,0 +1,96 @@
+import json
+import re
+
+# Characters that matter outside and inside JSON strings
+_STRUCTURE = re.compile(r'[\[\]{}"]')
+_STRING_END = re.compile(r'["\\]')
+
+
+class JsonArrayStreamParser:
+    """Incrementally parses a JSON array arriving in pieces, e.g. a streamed model response.
+
+    feed() takes the next piece of text and returns the elements of the
+    top-level array that were completed by it, already decoded. Anything
+    before the opening '[' (prose, a ```json fence) and after the closing ']'
+    is ignored. Only objects and arrays are returned as elements; bare
+    numbers or strings in the top-level array are skipped.
+
+    Only the text of the element being parsed is kept, so memory stays
+    bounded by the largest element rather than the whole response.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._element_start = None
+        self.started = False
+        self.finished = False
+        self.count = 0
+
+    def feed(self, text):
+        if self.finished or not text:
+            return []
+        self._buffer += text
+        elements = []
+
+        while self._pos < len(self._buffer):
+            if self._in_string:
+                match = _STRING_END.search(self._buffer, self._pos)
+                if match is None:
+                    self._pos = len(self._buffer)
+                    break
+                if match.group() == '\\':
+                    # Skip the escaped character, wait for it if it hasn't arrived yet
+                    if match.end() >= len(self._buffer):
+                        self._pos = match.start()
+                        break
+                    self._pos = match.end() + 1
+                    continue
+                self._in_string = False
+                self._pos = match.end()
+                continue
+
+            if not self.started:
+                start = self._buffer.find('[', self._pos)
+                if start == -1:
+                    # Nothing useful yet, don't hold on to the preamble
+                    self._buffer, self._pos = '', 0
+                    break
+                self.started = True
+                self._depth = 1
+                self._pos = start + 1
+                continue
+
+            match = _STRUCTURE.search(self._buffer, self._pos)
+            if match is None:
+                self._pos = len(self._buffer)
+                break
+            char = match.group()
+            self._pos = match.end()
+
+            if char == '"':
+                self._in_string = True
+            elif char in '[{':
+                if self._depth == 1:
+                    self._element_start = match.start()
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 1 and self._element_start is not None:
+                    elements.append(json.loads(self._buffer[self._element_start:self._pos]))
+                    self.count += 1
+                    self._element_start = None
+                elif self._depth == 0:
+                    self.finished = True
+                    break
+
+        # Drop text we are done with
+        keep_from = self._element_start if self._element_start is not None else self._pos
+        if keep_from:
+            self._buffer = self._buffer[keep_from:]
+            self._pos -= keep_from
+            if self._element_start is not None:
+                self._element_start = 0
+        return elements
@@ -0,0 +1,117 @@
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Load test comparing the sync (Flask) and async (ASGI) execution modes.
+#
+# Start both servers first, e.g.:
+#   python app.py                      # sync mode on :5000
+#   uvicorn asgi:app --port 8000       # async mode on :8000
+# then:
+#   python load_test.py --api-key $GEMINI_API_KEY --image cat.jpg --route image_qa
+#
+# Start the servers with GEMINI_BACKEND=fake to load test without spending quota
+# (any --api-key works then), or use benchmark.py for an in-process run.
+
+ROUTES = {
+    'image_qa': ('/image_qa_process', {'question': 'What is in this image?'}, True),
+    'bounding_boxes': ('/bounding_boxes_process', {'object_name': 'cat'}, True),
+    'image_segmentation': ('/image_segmentation_process', {}, True),
+    'image_editing': ('/image_editing_process', {'edit_prompt': 'Add a hat'}, True),
+    'image_generation': ('/image_generation_process', {'prompt': 'A cat wearing a hat'}, False),
+}
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def login(base_url, api_key):
+    # Store the API key in the server-side session and keep the cookie
+    session = requests.Session()
+    session.post(f'{base_url}/save_settings', data={'api_key': api_key}, allow_redirects=False)
+    return session.cookies.get_dict()
+
+def run_target(name, base_url, args, image_bytes):
+    path, form, needs_image = ROUTES[args.route]
+    form = dict(form)
+    if not args.allow_cache:
+        form['no_cache'] = '1'
+    if args.no_preprocess:
+        form['preprocess'] = '0'
+    cookies = login(base_url, args.api_key)
+
+    def one_request(_):
+        files = {'image': ('load_test.jpg', image_bytes, args.mime_type)} if needs_image else None
+        start = time.perf_counter()
+        try:
+            response = requests.post(f'{base_url}{path}', data=form, files=files, cookies=cookies,
+                                     timeout=args.timeout)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        return ok, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(one_request, range(args.requests)))
+    wall_time = time.perf_counter() - start
+
+    latencies = [latency for ok, latency in results if ok]
+    errors = sum(1 for ok, _ in results if not ok)
+    return {
+        'name': name,
+        'ok': len(latencies),
+        'errors': errors,
+        'wall_time': wall_time,
+        'throughput': len(latencies) / wall_time if wall_time else 0.0,
+        'mean': statistics.mean(latencies) if latencies else 0.0,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare sync and async execution modes under load')
+    parser.add_argument('--sync-url', default='http://localhost:5000')
+    parser.add_argument('--async-url', default='http://localhost:8000')
+    parser.add_argument('--api-key', required=True)
+    parser.add_argument('--route', choices=sorted(ROUTES), default='image_qa')
+    parser.add_argument('--image', help='Image file to upload (required for image routes)')
+    parser.add_argument('--mime-type', default='image/jpeg')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--allow-cache', action='store_true',
+                        help='Let repeated requests be answered from the response cache')
+    parser.add_argument('--no-preprocess', action='store_true',
+                        help='Send uploads to the model unchanged, to measure what preprocessing saves')
+    parser.add_argument('--only', choices=['sync', 'async'], help='Only test one mode')
+    args = parser.parse_args()
+
+    image_bytes = None
+    if ROUTES[args.route][2]:
+        if not args.image:
+            parser.error(f'--image is required for {args.route}')
+        with open(args.image, 'rb') as image_file:
+            image_bytes = image_file.read()
+
+    targets = [('sync', args.sync_url), ('async', args.async_url)]
+    if args.only:
+        targets = [target for target in targets if target[0] == args.only]
+
+    print(f"{args.requests} requests to {args.route}, concurrency {args.concurrency}")
+    print(f"{'mode':<6} {'ok':>5} {'err':>5} {'wall s':>8} {'req/s':>8} {'mean s':>8} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8}")
+    for name, base_url in targets:
+        stats = run_target(name, base_url, args, image_bytes)
+        print(f"{stats['name']:<6} {stats['ok']:>5} {stats['errors']:>5} {stats['wall_time']:>8.2f} "
+              f"{stats['throughput']:>8.2f} {stats['mean']:>8.3f} {stats['p50']:>8.3f} "
+              f"{stats['p90']:>8.3f} {stats['p99']:>8.3f}")
+
+if __name__ == '__main__':
+    main()
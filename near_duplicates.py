@@ -0,0 +1,101 @@
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+from perceptual import HashIndex
+
+
+class NearDuplicateCache:
+    """Finds earlier answers about images that look the same as a new one.
+
+    The response cache is keyed on the exact image bytes, so a re-upload
+    that was recompressed, resized or had its EXIF changed misses it. This
+    index maps the perceptual hash of each answered image, under a namespace
+    (route, model, prompt and schema), to the response cache key of its
+    answer and the size of the image the model saw. The answers themselves
+    stay in the response cache: an entry whose answer has expired there is
+    a miss. When max_entries is reached the older half is forgotten.
+    """
+
+    def __init__(self, response_cache, max_distance=4, max_entries=1_000_000):
+        self.response_cache = response_cache
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.index = HashIndex(max_distance)
+        # Per index position: SHA-256 response cache key, (width, height) sent to the model
+        self._keys = np.zeros((1024, 32), dtype=np.uint8)
+        self._sizes = np.zeros((1024, 2), dtype=np.uint32)
+        self._lock = threading.Lock()
+
+        # Counters
+        self.lookups = 0
+        self.hits = 0
+        self.expired = 0
+        self.added = 0
+        self.evicted = 0
+        self.lookup_seconds = 0.0
+
+    @staticmethod
+    def namespace(*parts):
+        # 64-bit tag of what was asked, images only match answers to the same question
+        digest = hashlib.sha256(json.dumps(parts).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def get(self, namespace, image_hash, max_distance=None):
+        """(answer, distance, size) for the closest earlier image within max_distance bits, or None."""
+        start = time.perf_counter()
+        with self._lock:
+            matches = self.index.search(image_hash, namespace, max_distance)
+            # A few of the closest, in case the nearest answer has expired
+            candidates = [(self._keys[position].tobytes().hex(), distance, tuple(self._sizes[position].tolist()))
+                          for position, distance in matches[:4]]
+            self.lookups += 1
+            self.lookup_seconds += time.perf_counter() - start
+
+        for key, distance, size in candidates:
+            value = self.response_cache.get(key)
+            if value is not None:
+                with self._lock:
+                    self.hits += 1
+                return value, distance, size
+        if candidates:
+            with self._lock:
+                self.expired += 1
+        return None
+
+    def add(self, namespace, image_hash, cache_key, size):
+        """Remember that the answer stored under cache_key was about an image with this hash and size."""
+        with self._lock:
+            if len(self.index) >= self.max_entries:
+                # Rebuilding the index once is much cheaper than removing entries one at a time
+                dropped = self.index.truncate(self.max_entries // 2)
+                kept = len(self.index)
+                self._keys[:kept] = self._keys[dropped:dropped + kept]
+                self._sizes[:kept] = self._sizes[dropped:dropped + kept]
+                self.evicted += dropped
+
+            position = self.index.add(image_hash, namespace)
+            if position >= len(self._keys):
+                self._keys = np.concatenate([self._keys, np.zeros_like(self._keys)])
+                self._sizes = np.concatenate([self._sizes, np.zeros_like(self._sizes)])
+            self._keys[position] = np.frombuffer(bytes.fromhex(cache_key), dtype=np.uint8)
+            self._sizes[position] = size
+            self.added += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self.index),
+                'max_entries': self.max_entries,
+                'max_distance': self.max_distance,
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'expired': self.expired,
+                'added': self.added,
+                'evicted': self.evicted,
+                'hit_rate': round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                'avg_lookup_ms': round(self.lookup_seconds / self.lookups * 1000, 4) if self.lookups else 0.0,
+            }
@@ -0,0 +1,138 @@
+from array import array
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(size):
+    # Orthonormal DCT-II basis, the 2D transform of X is C @ X @ C.T
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def _grayscale(image, width, height):
+    # Shrink before converting, a box filter over a full frame is cheaper than converting every pixel
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    return np.asarray(image.resize((width, height), Image.Resampling.BOX).convert('L'), dtype=np.float64)
+
+
+def phash(image, hash_size=8, highfreq_factor=4):
+    """64-bit perceptual hash of a PIL image, from the low frequencies of its DCT.
+
+    Unchanged by resizing, recompression and metadata; small edits flip a
+    few bits, so images are compared by the Hamming distance of their hashes.
+    """
+    size = hash_size * highfreq_factor
+    dct = _dct_matrix(size)
+    low = (dct @ _grayscale(image, size, size) @ dct.T)[:hash_size, :hash_size]
+    return int.from_bytes(np.packbits(low > np.median(low)).tobytes(), 'big')
+
+
+def dhash(image, hash_size=8):
+    # Cheaper than phash: whether each pixel is brighter than its right neighbour
+    pixels = _grayscale(image, hash_size + 1, hash_size)
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """64-bit hashes searchable by Hamming distance, with multi-index hashing.
+
+    Each hash is split into max_distance + 1 chunks. Two hashes at most
+    max_distance bits apart agree on at least one whole chunk, so a search
+    only compares the entries sharing a chunk with the query instead of
+    scanning them all. Hashes and tags are kept in flat numpy arrays and the
+    chunk tables hold 4-byte positions, under 100 bytes per entry in all.
+
+    Not thread-safe, callers hold their own lock.
+    """
+
+    def __init__(self, max_distance=4, capacity=1024):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        bits = [64 // chunks + (i < 64 % chunks) for i in range(chunks)]
+        self._chunks = [(sum(bits[:i]), (1 << size) - 1) for i, size in enumerate(bits)]
+        # chunk value -> positions of the entries that have it, one table per chunk
+        self._tables = [{} for _ in self._chunks]
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._tags = np.zeros(capacity, dtype=np.uint64)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, count):
+        if self._size + count > len(self._hashes):
+            capacity = max(2 * len(self._hashes), self._size + count)
+            for name in ('_hashes', '_tags'):
+                grown = np.zeros(capacity, dtype=np.uint64)
+                grown[:self._size] = getattr(self, name)[:self._size]
+                setattr(self, name, grown)
+
+    def add(self, value, tag=0):
+        """Add a hash, returns its position."""
+        self._reserve(1)
+        position = self._size
+        self._hashes[position] = value
+        self._tags[position] = tag
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            bucket = table.get((value >> shift) & mask)
+            if bucket is None:
+                bucket = table[(value >> shift) & mask] = array('I')
+            bucket.append(position)
+        self._size += 1
+        return position
+
+    def extend(self, values, tags=0):
+        # Many hashes at once, grouped per chunk value with numpy instead of one by one
+        values = np.asarray(values, dtype=np.uint64)
+        self._reserve(len(values))
+        start, self._size = self._size, self._size + len(values)
+        self._hashes[start:self._size] = values
+        self._tags[start:self._size] = tags
+        positions = np.arange(start, self._size, dtype=np.uint32)
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            chunks = (values >> np.uint64(shift)) & np.uint64(mask)
+            order = np.argsort(chunks, kind='stable')
+            keys, firsts = np.unique(chunks[order], return_index=True)
+            for key, group in zip(keys.tolist(), np.split(positions[order], firsts[1:])):
+                table.setdefault(key, array('I')).frombytes(group.tobytes())
+
+    def search(self, value, tag=0, max_distance=None):
+        """(position, distance) of the entries with this tag within max_distance bits, closest first."""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        buckets = [table.get((value >> shift) & mask) for table, (shift, mask) in zip(self._tables, self._chunks)]
+        buckets = [np.frombuffer(bucket, dtype=np.uint32) for bucket in buckets if bucket]
+        if not buckets:
+            return []
+        positions = np.concatenate(buckets)
+        distances = np.bitwise_count(self._hashes[positions] ^ np.uint64(value))
+        found = (distances <= max_distance) & (self._tags[positions] == np.uint64(tag))
+        # An entry matching on several chunks is found once per chunk
+        positions, firsts = np.unique(positions[found], return_index=True)
+        distances = distances[found][firsts]
+        order = np.argsort(distances, kind='stable')
+        return list(zip(positions[order].tolist(), distances[order].tolist()))
+
+    def truncate(self, keep):
+        """Drop all but the newest keep entries, returns how many were dropped.
+
+        The kept entries move down by that many positions.
+        """
+        dropped = max(0, self._size - keep)
+        hashes = self._hashes[dropped:self._size].copy()
+        tags = self._tags[dropped:self._size].copy()
+        self._tables = [{} for _ in self._chunks]
+        self._size = 0
+        for start in range(0, len(hashes), 1 << 20):
+            self.extend(hashes[start:start + (1 << 20)], tags[start:start + (1 << 20)])
+        return dropped
@@ -0,0 +1,130 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import ImageDraw, ImageFont
+
+from compositing import SEGMENT_COLORS
+
+logger = logging.getLogger(__name__)
+
+# TrueType fonts tried in order, by name (looked up on the font path) or full path
+FONT_CANDIDATES = (
+    'arial.ttf',
+    'Arial.ttf',
+    'DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    'LiberationSans-Regular.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',
+    '/System/Library/Fonts/Supplemental/Arial.ttf',
+    '/Library/Fonts/Arial.ttf',
+)
+
+# Box colors, the same palette as the segmentation overlays
+BOX_COLORS = tuple(SEGMENT_COLORS)
+LABEL_TEXT_COLOR = (255, 255, 255)
+
+
+class FontCache:
+    """Fonts shared by every request, one per size.
+
+    The TrueType file is resolved once, when the cache is created, instead
+    of failing over to the default font on each request; without any of the
+    candidates Pillow's built-in scalable font is used. Sizes are kept in a
+    small LRU, as a FreeType face is a few hundred KB.
+    """
+
+    def __init__(self, font_path=None, max_sizes=16):
+        self.max_sizes = max_sizes
+        self.font_path = self._resolve(font_path)
+        self._fonts = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _resolve(font_path):
+        for candidate in ((font_path,) if font_path else ()) + FONT_CANDIDATES:
+            try:
+                ImageFont.truetype(candidate, 12)
+                logger.debug("Using font %s", candidate)
+                return candidate
+            except OSError:
+                continue
+        if font_path:
+            logger.warning("Font %s not found, using the default font", font_path)
+        return None
+
+    def get(self, size):
+        with self._lock:
+            font = self._fonts.get(size)
+            if font is not None:
+                self._fonts.move_to_end(size)
+                self.hits += 1
+                return font
+            self.misses += 1
+
+        if self.font_path:
+            font = ImageFont.truetype(self.font_path, size)
+        else:
+            font = ImageFont.load_default(size)
+
+        with self._lock:
+            self._fonts[size] = font
+            while len(self._fonts) > self.max_sizes:
+                self._fonts.popitem(last=False)
+        return font
+
+    def stats(self):
+        with self._lock:
+            return {
+                'font': self.font_path or 'default',
+                'sizes': len(self._fonts),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def box_color(index):
+    return BOX_COLORS[index % len(BOX_COLORS)]
+
+
+def draw_boxes(image, boxes, font, width=3, padding=5, label_offset=25):
+    """Draw (index, [x_min, y_min, x_max, y_max], label) boxes with labels onto image, in place.
+
+    Everything goes through one ImageDraw: the outlines first, then the label
+    backgrounds, then the label text, so a label is never covered by a
+    neighbouring box. Label sizes are measured once per distinct label.
+    """
+    draw = ImageDraw.Draw(image)
+    text_bboxes = {}
+    labels = []
+    for i, (x_min, y_min, x_max, y_max), label in boxes:
+        color = box_color(i)
+        draw.rectangle([(x_min, y_min), (x_max, y_max)], outline=color, width=width)
+
+        text_bbox = text_bboxes.get(label)
+        if text_bbox is None:
+            text_bbox = text_bboxes[label] = draw.textbbox((0, 0), label, font=font)
+        origin = (x_min, y_min - label_offset)
+        labels.append((origin, label, color, text_bbox))
+
+    for (x, y), label, color, (left, top, right, bottom) in labels:
+        draw.rectangle([x + left - padding, y + top - padding, x + right + padding, y + bottom + padding], fill=color)
+    for origin, label, color, _ in labels:
+        draw.text(origin, label, fill=LABEL_TEXT_COLOR, font=font)
+
+
+def draw_outlined_text(draw, position, text, font, fill=(255, 255, 255), outline=(0, 0, 0)):
+    # A one pixel outline keeps the text readable on any background
+    x, y = position
+    for dx, dy in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+        draw.text((x + dx, y + dy), text, font=font, fill=outline)
+    draw.text(position, text, font=font, fill=fill)
+
+
+def draw_centered_text(draw, center_x, y, text, font, fill=(0, 0, 0)):
+    draw.text((center_x - draw.textlength(text, font=font) // 2, y), text, font=font, fill=fill)
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Collapse whitespace and case so trivially different prompts share a cache entry
+def normalize_prompt(prompt):
+    return ' '.join(prompt.split()).casefold()
+
+
+# Build a content-addressed key from the model, the image bytes and the prompt
+def make_cache_key(model, image_data, prompt, image_hash=None, schema=None, api_key_hash=None):
+    # Callers that already know the image's SHA-256 can pass it instead of the bytes
+    if image_hash is None:
+        image_hash = hashlib.sha256(image_data).hexdigest()
+    # Scoped to the API key, one key's answers (and uploads) are never served to another
+    key_material = [api_key_hash, model, image_hash, normalize_prompt(prompt)]
+    # Structured output is keyed on its response schema too
+    if schema is not None:
+        key_material.append(schema)
+    key_material = json.dumps(key_material)
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+
+class MemoryBackend:
+    """In-memory LRU tier bounded by the total size of the stored values."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.evictions = 0
+        # key -> (value bytes, expires at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        # Values larger than the whole budget are never worth keeping in memory
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at)
+            self.current_bytes += len(value)
+            while self.current_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self.current_bytes -= len(value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            }
+
+
+class SQLiteBackend:
+    """On-disk tier that survives restarts.
+
+    Every purge_every writes, expired entries are deleted and, past
+    max_entries or max_bytes of stored values, the entries closest to
+    expiring go first.
+    """
+
+    def __init__(self, path, max_entries=100000, max_bytes=1024 * 1024 * 1024, purge_every=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.purge_every = purge_every
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        # Counters
+        self.expired = 0
+        self.evictions = 0
+
+        with self._lock:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS response_cache ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS response_cache_expires_at ON response_cache (expires_at)'
+            )
+            self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires_at FROM response_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= time.time():
+                self._conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+                self._conn.commit()
+                return None
+            return bytes(value), expires_at
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, expires_at)
+            )
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._purge_expired()
+                self._evict()
+            self._conn.commit()
+
+    def purge_expired(self):
+        with self._lock:
+            removed = self._purge_expired()
+            self._conn.commit()
+        return removed
+
+    def _purge_expired(self):
+        removed = self._conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),)).rowcount
+        self.expired += removed
+        return removed
+
+    def _evict(self):
+        # Trim to the caps, entries that expire soonest first and those that never expire last
+        entries, size = self._conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM response_cache'
+        ).fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            'SELECT key, LENGTH(value) FROM response_cache ORDER BY expires_at IS NULL, expires_at'
+        )
+        evicted = []
+        for key, length in rows:
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            entries -= 1
+            size -= length
+        self._conn.executemany('DELETE FROM response_cache WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM response_cache'
+            ).fetchone()
+            return {
+                'entries': entries,
+                'bytes': size,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'path': self.path,
+            }
+
+
+class ResponseCache:
+    """Two-tier cache for model responses: memory first, then disk.
+
+    Values are JSON-serialisable objects (usually the model's response text).
+    """
+
+    def __init__(self, memory=None, disk=None, default_ttl=3600):
+        self.memory = memory
+        self.disk = disk
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.sets = 0
+
+    def get(self, key):
+        if self.memory is not None:
+            value = self.memory.get(key)
+            if value is not None:
+                self._count('memory_hits')
+                return json.loads(value)
+
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                # Promote to the memory tier for the next lookup
+                if self.memory is not None:
+                    self.memory.set(key, value, expires_at)
+                self._count('disk_hits')
+                return json.loads(value)
+
+        self._count('misses')
+        return None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        encoded = json.dumps(value).encode('utf-8')
+        if self.memory is not None:
+            self.memory.set(key, encoded, expires_at)
+        if self.disk is not None:
+            self.disk.set(key, encoded, expires_at)
+        self._count('sets')
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            result = {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'sets': self.sets,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            }
+        if self.memory is not None:
+            result['memory'] = self.memory.stats()
+        if self.disk is not None:
+            result['disk'] = self.disk.stats()
+        return result
@@ -0,0 +1,282 @@
+import contextvars
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from PIL import Image
+
+from instrumentation import STAGE_SECONDS, current_route
+
+logger = logging.getLogger(__name__)
+
+try:
+    # Registers an AVIF encoder with Pillow when installed (Pillow < 11.2 has none of its own)
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# Writes queued by the current request (or job), see ResultWriter.track_writes()
+_queued_writes = contextvars.ContextVar('queued_writes', default=None)
+
+# Format -> file extension of the encoders the writer can use
+EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg', 'WEBP': '.webp', 'AVIF': '.avif'}
+
+# Leading bytes of the encoded formats that are written as they are -> extension
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+)
+
+
+def sniff_extension(data):
+    """Extension of an already encoded PNG, JPEG, GIF or WebP image, None for anything else."""
+    for signature, extension in SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+def _encode(path, payload, image_format, options):
+    # Runs in a worker process: build the image, encode it and write it atomically
+    started = time.thread_time()
+    if payload[0] == 'pixels':
+        _, mode, size, raw = payload
+        image = Image.frombytes(mode, size, raw)
+    else:
+        image = Image.open(BytesIO(payload[1]))
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        image.save(temp_path, format=image_format, **options)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.path.getsize(path), time.thread_time() - started
+
+
+def _warm_up():
+    return os.getpid()
+
+
+class ResultWriter:
+    """Encodes and writes the result images off the request path.
+
+    save_image() hands the pixels to a pool of worker processes and returns
+    the result's URL path straight away, so a request can go on with its
+    work (or queue more results) while they encode. A path must not leave
+    the process before its file is written, another worker process of the
+    server could be asked for it: requests collect their writes with
+    track_writes() and wait_for() them before answering. Images the model
+    already returned encoded (PNG, JPEG, WebP, GIF) are written as they are
+    by save_bytes(), without a decode or re-encode.
+    """
+
+    def __init__(self, folder, url_prefix, image_format='PNG', quality=85, png_compress_level=1, processes=2):
+        self.folder = folder
+        self.url_prefix = url_prefix
+        self.image_format = image_format.upper()
+        if self.image_format == 'JPG':
+            self.image_format = 'JPEG'
+        Image.init()
+        if self.image_format == 'AVIF' and 'AVIF' not in Image.SAVE:
+            logger.warning("No AVIF encoder available (install pillow-avif-plugin), writing WebP results instead")
+            self.image_format = 'WEBP'
+        if self.image_format not in EXTENSIONS:
+            raise ValueError(f"Unsupported result format: {image_format}")
+
+        if self.image_format == 'PNG':
+            self.options = {'compress_level': png_compress_level}
+        else:
+            self.options = {'quality': quality}
+            if self.image_format == 'WEBP':
+                # method 6 is the slowest for a few percent smaller files
+                self.options['method'] = 4
+
+        # Encoding is CPU bound, so it gets processes; 0 encodes on threads instead
+        self.processes = processes
+        if processes > 0:
+            # Workers are forked up front, before the app starts any threads of its own
+            methods = multiprocessing.get_all_start_methods()
+            self._context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+            self.encoder = ProcessPoolExecutor(max_workers=processes, mp_context=self._context)
+            self.encoder.submit(_warm_up).result()
+        else:
+            self.encoder = ThreadPoolExecutor(max_workers=2, thread_name_prefix='result-encoder')
+        # Already encoded bytes only need writing
+        self.io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='result-writer')
+
+        # filename -> future of the write still in progress
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.submitted = 0
+        self.restarts = 0
+        self.encoded = 0
+        self.passed_through = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+
+    def _new_filename(self, prefix, extension):
+        return f"{prefix}_{os.urandom(4).hex()}{extension}"
+
+    def _submit_encode(self, *args):
+        encoder = self.encoder
+        try:
+            return encoder.submit(_encode, *args)
+        except BrokenProcessPool:
+            # A worker died (killed, out of memory) and took the pool with it, later results need a new one
+            with self._lock:
+                if self.encoder is encoder:
+                    logger.warning("Result encoder pool is broken, starting a new one")
+                    self.encoder = ProcessPoolExecutor(max_workers=self.processes, mp_context=self._context)
+                    self.restarts += 1
+            encoder.shutdown(wait=False)
+            return self.encoder.submit(_encode, *args)
+
+    def save_image(self, image, prefix):
+        """Queue a PIL image for encoding, returns its URL path."""
+        if image.mode == 'P':
+            # The palette doesn't survive tobytes()
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        payload = ('pixels', image.mode, image.size, image.tobytes())
+        filename = self._new_filename(prefix, EXTENSIONS[self.image_format])
+        future = self._submit_encode(os.path.join(self.folder, filename), payload, self.image_format, self.options)
+        return self._track(filename, future, encoded=True)
+
+    def save_bytes(self, data, prefix):
+        """Write an image the model returned, as it is if it's already PNG/JPEG/WebP/GIF.
+
+        Anything else is decoded and encoded in the configured format. Raises
+        if the bytes are not an image at all, like Image.open() would.
+        """
+        extension = sniff_extension(data)
+        if extension is None:
+            # Only reads the header, so garbage fails here rather than in the worker
+            Image.open(BytesIO(data))
+            filename = self._new_filename(prefix, EXTENSIONS[self.image_format])
+            future = self._submit_encode(os.path.join(self.folder, filename), ('encoded', data), self.image_format,
+                                         self.options)
+            return self._track(filename, future, encoded=True)
+
+        filename = self._new_filename(prefix, extension)
+        future = self.io_executor.submit(self._write, os.path.join(self.folder, filename), data)
+        return self._track(filename, future, encoded=False)
+
+    @staticmethod
+    def _write(path, data):
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return len(data), 0.0
+
+    def _track(self, filename, future, encoded):
+        route = current_route()
+        queued = _queued_writes.get()
+        if queued is not None:
+            queued.append(future)
+        with self._lock:
+            self._pending[filename] = future
+            self.submitted += 1
+        future.add_done_callback(lambda done: self._finished(filename, done, encoded, route))
+        return os.path.join(self.url_prefix, filename)
+
+    def _finished(self, filename, future, encoded, route):
+        error = future.exception()
+        with self._lock:
+            self._pending.pop(filename, None)
+            if error is not None:
+                self.failed += 1
+            else:
+                size, seconds = future.result()
+                self.bytes_written += size
+                if encoded:
+                    self.encoded += 1
+                    self.encode_seconds += seconds
+                else:
+                    self.passed_through += 1
+        if error is not None:
+            logger.error("Error writing result %s: %s", filename, error)
+        elif encoded:
+            # CPU time in the worker, under the route that produced the image
+            STAGE_SECONDS.observe(seconds, route=route, stage='encode')
+
+    def wait(self, filename, timeout=30):
+        """Block until a result that is still being written is on disk (or failed)."""
+        with self._lock:
+            future = self._pending.get(os.path.basename(filename))
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+
+    def track_writes(self):
+        """Collect the writes queued from this context from now on, returns them for wait_for().
+
+        Call it at the start of a request; threads started with a copy of the
+        context add to the same collection.
+        """
+        queued = []
+        _queued_writes.set(queued)
+        return queued
+
+    def wait_for(self, queued, timeout=30):
+        """Block until the collected writes are on disk (or failed), emptying the collection."""
+        while queued:
+            try:
+                queued.pop().result(timeout=timeout)
+            except Exception:
+                pass
+
+    def flush(self, timeout=None):
+        # Wait for every pending write, e.g. before shutting down or reading the counters
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+
+    def close(self):
+        # Finish the pending writes and stop the workers; needed when the app runs inside a
+        # multiprocessing child, which joins its own children before the pool would shut down
+        self.flush()
+        self.encoder.shutdown()
+        self.io_executor.shutdown()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'format': self.image_format,
+                'processes': self.processes,
+                'restarts': self.restarts,
+                'pending': len(self._pending),
+                'submitted': self.submitted,
+                'encoded': self.encoded,
+                'passed_through': self.passed_through,
+                'failed': self.failed,
+                'bytes_written': self.bytes_written,
+                'encode_cpu_seconds': round(self.encode_seconds, 3),
+            }
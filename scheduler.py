@@ -0,0 +1,464 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from hedging import AttemptAbandoned, LatencyTracker, attempt_abandoned, sleep_unless_abandoned
+from instrumentation import observe_model_call, observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first: people waiting on a page, then batch requests, then background jobs
+PRIORITIES = {'interactive': 0, 'batch': 1, 'background': 2}
+
+# Priority of the model calls made by the current request or job
+_call_priority = contextvars.ContextVar('call_priority', default='interactive')
+
+# HTTP codes worth retrying: rate limited, and the API being overloaded or briefly unavailable
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+
+# Longest a queued call sleeps between checks of whether its hedged attempt was abandoned
+ABANDON_CHECK_INTERVAL = 0.25
+
+
+@contextmanager
+def call_priority(priority):
+    # Model calls made inside the block are queued with this priority
+    token = _call_priority.set(priority)
+    try:
+        yield
+    finally:
+        _call_priority.reset(token)
+
+
+def is_rate_limited(error):
+    return getattr(error, 'code', None) == 429 or getattr(error, 'status', None) == 'RESOURCE_EXHAUSTED'
+
+
+def retry_after(error):
+    """Seconds the API asked us to wait before retrying, or None if it didn't say."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers:
+        value = headers.get('retry-after')
+        if value and value.strip().replace('.', '', 1).isdigit():
+            return float(value)
+
+    # Gemini puts a google.rpc.RetryInfo with e.g. "retryDelay": "37s" in the error details
+    details = getattr(error, 'details', None)
+    if isinstance(details, dict):
+        details = details.get('error', details).get('details')
+    for detail in details if isinstance(details, list) else ():
+        if isinstance(detail, dict) and 'RetryInfo' in detail.get('@type', ''):
+            match = re.fullmatch(r'([\d.]+)s', str(detail.get('retryDelay', '')))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+def _observe(model, started, error=None):
+    # Every API request is timed, including the ones that get retried
+    outcome = 'ok' if error is None else 'rate_limited' if is_rate_limited(error) else 'error'
+    observe_model_call(model, time.perf_counter() - started, outcome)
+
+
+class SchedulerTimeout(Exception):
+    pass
+
+
+class TokenBucket:
+    """Admission state of one (API key, model) pair.
+
+    rate is in calls per second, 0 for no limit. A 429 pauses the bucket and,
+    when the configured limit is unknown or too high, lowers the rate to what
+    actually got through in the last quota window (a minute for Gemini's
+    per-minute quotas); it creeps back up after each quiet window. Without a
+    configured limit the learned one is dropped again, back to unlimited,
+    once it has doubled without another 429 or after recovery_windows quiet
+    windows, e.g. when the quota was raised or the bucket sat idle.
+    """
+
+    def __init__(self, rate, burst, window=60, recovery_windows=10):
+        self.window = window
+        self.recovery_windows = recovery_windows
+        self.configured_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.limited_at = None
+        # Last 429, and the rate at which a learned limit is given up again
+        self.last_limited = None
+        self.ceiling = None
+        # Start times of recent calls, to learn the real quota from
+        self.recent = deque()
+        # Heap of (priority, seq) of the callers waiting their turn
+        self.waiters = []
+
+    def wait_time(self, now):
+        # Seconds until the next call may start, 0 if it can start now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.limited_at is not None and now - self.limited_at > self.window:
+            # A quiet window since the last 429, allow a little more
+            self.rate *= 1.1
+            self.limited_at = now
+            if self.configured_rate:
+                if self.rate >= self.configured_rate:
+                    self.rate, self.limited_at = self.configured_rate, None
+            elif self.rate >= self.ceiling or now - self.last_limited > self.recovery_windows * self.window:
+                # Only ever a guess, stop limiting once it is clearly out of date
+                self.rate, self.limited_at, self.ceiling = 0, None, None
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate:
+            self.tokens -= 1
+        self.recent.append(now)
+        while self.recent and now - self.recent[0] > self.window:
+            self.recent.popleft()
+
+    def rate_limited(self, now, pause):
+        self.blocked_until = max(self.blocked_until, now + pause)
+        while self.recent and now - self.recent[0] > self.window:
+            self.recent.popleft()
+        # Aim a little under what got through in the last window
+        learned = max(1, len(self.recent)) * 0.8 / self.window
+        self.rate = min(self.rate, learned) if self.rate else learned
+        if not self.configured_rate:
+            self.ceiling = 2 * self.rate
+        self.tokens = 0.0
+        self.limited_at = self.last_limited = now
+
+
+class CallScheduler:
+    """Admits every Gemini model call through a token bucket per (API key, model).
+
+    Callers queue in priority order (see PRIORITIES) and are admitted as the
+    bucket allows. Rate limited and overloaded calls are retried with jittered
+    exponential backoff, honouring the API's retry-after hint; a 429 also
+    pauses everyone else on the same bucket for that long, so a burst of
+    requests backs off together instead of hammering the quota.
+    """
+
+    def __init__(self, requests_per_minute=0, overrides=None, max_retries=4, base_delay=1.0, max_delay=60.0,
+                 max_wait=120.0, quota_window=60):
+        self.requests_per_minute = requests_per_minute
+        self.quota_window = quota_window
+        self.overrides = overrides or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.waits = LatencyTracker()
+        self._buckets = {}
+        self._seq = itertools.count()
+        self._changed = threading.Condition()
+
+        # Counters
+        self.admitted = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.timeouts = 0
+        self.abandoned = 0
+
+    def wrap(self, client, api_key_hash):
+        return ScheduledClient(client, self, api_key_hash)
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            per_minute = self.overrides.get(key[1], self.requests_per_minute)
+            # Allow bursts of a tenth of the window's quota
+            rate = per_minute / 60
+            bucket = self._buckets[key] = TokenBucket(rate, max(1, int(rate * self.quota_window / 10)), self.quota_window)
+        return bucket
+
+    def _poll(self, bucket, entry, now):
+        # Seconds the entry still has to wait, None while others are ahead of it, 0 once admitted
+        if bucket.waiters[0] != entry:
+            return None
+        wait = bucket.wait_time(now)
+        if wait == 0:
+            heapq.heappop(bucket.waiters)
+            bucket.take(now)
+            self.admitted += 1
+            self._changed.notify_all()
+        return wait
+
+    def _leave(self, bucket, entry):
+        # Give up a place in the queue (timed out or cancelled)
+        if entry in bucket.waiters:
+            bucket.waiters.remove(entry)
+            heapq.heapify(bucket.waiters)
+            self._changed.notify_all()
+
+    def _finish_wait(self, priority, started):
+        waited = time.monotonic() - started
+        self.waits.record(priority, waited)
+        observe_stage('queue_wait', waited)
+        if waited > 0.001:
+            with self._changed:
+                self.throttled += 1
+
+    def acquire(self, key, priority, entry=None):
+        """Block until a call for key may start. Returns the queue entry, retries pass it back to keep their place."""
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        with self._changed:
+            bucket = self._bucket(key)
+            entry = entry or (PRIORITIES.get(priority, 0), next(self._seq))
+            heapq.heappush(bucket.waiters, entry)
+            # The new entry may be ahead of the current head
+            self._changed.notify_all()
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._poll(bucket, entry, now)
+                    if wait == 0:
+                        break
+                    if now >= deadline:
+                        self.timeouts += 1
+                        raise SchedulerTimeout(f"Waited over {self.max_wait:.0f}s for {key[1]} quota")
+                    if attempt_abandoned():
+                        # Another model already answered the hedged call, give the quota to someone else
+                        self.abandoned += 1
+                        raise AttemptAbandoned(f"{key[1]} call no longer needed")
+                    self._changed.wait(min(wait or deadline - now, deadline - now, ABANDON_CHECK_INTERVAL))
+            except BaseException:
+                self._leave(bucket, entry)
+                raise
+        self._finish_wait(priority, started)
+        return entry
+
+    async def acquire_async(self, key, priority, entry=None):
+        # Same as acquire, but polls so the event loop is never blocked on the lock's condition
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        with self._changed:
+            bucket = self._bucket(key)
+            entry = entry or (PRIORITIES.get(priority, 0), next(self._seq))
+            heapq.heappush(bucket.waiters, entry)
+            self._changed.notify_all()
+        try:
+            while True:
+                now = time.monotonic()
+                with self._changed:
+                    wait = self._poll(bucket, entry, now)
+                if wait == 0:
+                    break
+                if now >= deadline:
+                    with self._changed:
+                        self.timeouts += 1
+                    raise SchedulerTimeout(f"Waited over {self.max_wait:.0f}s for {key[1]} quota")
+                await asyncio.sleep(min(wait or 0.02, deadline - now))
+        except BaseException:
+            with self._changed:
+                self._leave(bucket, entry)
+            raise
+        self._finish_wait(priority, started)
+        return entry
+
+    def retry_delay(self, key, error, attempt):
+        """Seconds to wait before retrying after error, or None if it shouldn't be retried."""
+        if getattr(error, 'code', None) not in RETRYABLE_CODES and not is_rate_limited(error):
+            return None
+        if attempt >= self.max_retries:
+            with self._changed:
+                self.gave_up += 1
+            return None
+
+        # Full jitter, unless the API told us how long to wait
+        hint = retry_after(error)
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if hint is not None:
+            delay = hint + random.uniform(0, self.base_delay)
+
+        with self._changed:
+            self.retries += 1
+            if is_rate_limited(error):
+                self.rate_limited += 1
+                # Everyone on this key and model waits, the retry keeps its place in the queue
+                self._bucket(key).rate_limited(time.monotonic(), delay)
+                self._changed.notify_all()
+                delay = 0.0
+        logger.warning("%s returned %s, retry %d of %d", key[1], getattr(error, 'code', ''), attempt + 1,
+                       self.max_retries)
+        return delay
+
+    def call(self, api_key_hash, model, func):
+        key = (api_key_hash, model)
+        priority = _call_priority.get()
+        entry = None
+        for attempt in itertools.count():
+            entry = self.acquire(key, priority, entry)
+            started = time.perf_counter()
+            try:
+                result = func()
+            except Exception as e:
+                _observe(model, started, e)
+                delay = self.retry_delay(key, e, attempt)
+                if delay is None:
+                    raise
+                # A losing hedged attempt stops here instead of retrying
+                sleep_unless_abandoned(delay)
+                if attempt_abandoned():
+                    with self._changed:
+                        self.abandoned += 1
+                    raise AttemptAbandoned(f"{model} call no longer needed") from e
+                continue
+            _observe(model, started)
+            return result
+
+    async def call_async(self, api_key_hash, model, func):
+        key = (api_key_hash, model)
+        priority = _call_priority.get()
+        entry = None
+        for attempt in itertools.count():
+            entry = await self.acquire_async(key, priority, entry)
+            started = time.perf_counter()
+            try:
+                result = await func()
+            except Exception as e:
+                _observe(model, started, e)
+                delay = self.retry_delay(key, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            _observe(model, started)
+            return result
+
+    def call_stream(self, api_key_hash, model, func):
+        # Streams are only retried if they fail before the first chunk
+        key = (api_key_hash, model)
+        priority = _call_priority.get()
+        entry = None
+        for attempt in itertools.count():
+            entry = self.acquire(key, priority, entry)
+            started = False
+            call_started = time.perf_counter()
+            try:
+                for chunk in func():
+                    started = True
+                    yield chunk
+            except Exception as e:
+                _observe(model, call_started, e)
+                delay = None if started else self.retry_delay(key, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            _observe(model, call_started)
+            return
+
+    def stats(self):
+        with self._changed:
+            queued = {priority: 0 for priority in PRIORITIES}
+            names = {rank: priority for priority, rank in PRIORITIES.items()}
+            paused = 0
+            now = time.monotonic()
+            for bucket in self._buckets.values():
+                for rank, _ in bucket.waiters:
+                    queued[names.get(rank, 'interactive')] += 1
+                if bucket.blocked_until > now:
+                    paused += 1
+            result = {
+                'queued': queued,
+                'queue_depth': sum(queued.values()),
+                'buckets': len(self._buckets),
+                'paused_buckets': paused,
+                'admitted': self.admitted,
+                'throttled': self.throttled,
+                'rate_limited': self.rate_limited,
+                'retries': self.retries,
+                'gave_up': self.gave_up,
+                'timeouts': self.timeouts,
+                'abandoned': self.abandoned,
+            }
+        result['wait_seconds'] = self.waits.stats()
+        return result
+
+
+class _ScheduledModels:
+    # Stands in for client.models, sending the calls that hit a model's quota through the scheduler
+    def __init__(self, models, scheduler, api_key_hash):
+        self._models = models
+        self._scheduler = scheduler
+        self._api_key_hash = api_key_hash
+
+    def generate_content(self, *, model, **kwargs):
+        return self._scheduler.call(self._api_key_hash, model,
+                                    lambda: self._models.generate_content(model=model, **kwargs))
+
+    def generate_images(self, *, model, **kwargs):
+        return self._scheduler.call(self._api_key_hash, model,
+                                    lambda: self._models.generate_images(model=model, **kwargs))
+
+    def generate_content_stream(self, *, model, **kwargs):
+        return self._scheduler.call_stream(self._api_key_hash, model,
+                                           lambda: self._models.generate_content_stream(model=model, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+
+class _ScheduledAsyncModels:
+    # Stands in for client.aio.models
+    def __init__(self, models, scheduler, api_key_hash):
+        self._models = models
+        self._scheduler = scheduler
+        self._api_key_hash = api_key_hash
+
+    async def generate_content(self, *, model, **kwargs):
+        return await self._scheduler.call_async(self._api_key_hash, model,
+                                                lambda: self._models.generate_content(model=model, **kwargs))
+
+    async def generate_images(self, *, model, **kwargs):
+        return await self._scheduler.call_async(self._api_key_hash, model,
+                                                lambda: self._models.generate_images(model=model, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+
+class _ScheduledAio:
+    def __init__(self, aio, scheduler, api_key_hash):
+        self._aio = aio
+        self.models = _ScheduledAsyncModels(aio.models, scheduler, api_key_hash)
+
+    def __getattr__(self, name):
+        return getattr(self._aio, name)
+
+
+class ScheduledClient:
+    """A genai.Client whose model calls (sync and async) go through a CallScheduler.
+
+    Everything else (files, caches, ...) is the wrapped client's own.
+    """
+
+    def __init__(self, client, scheduler, api_key_hash):
+        self._client = client
+        # Answers are only shared between callers with the same key, it's part of cache and flight keys
+        self.api_key_hash = api_key_hash
+        self.models = _ScheduledModels(client.models, scheduler, api_key_hash)
+        self.aio = _ScheduledAio(client.aio, scheduler, api_key_hash)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
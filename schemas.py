@@ -0,0 +1,74 @@
+import json
+import logging
+from functools import lru_cache
+
+from google.genai import types
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+# Response schemas, sent to the model as response_schema so it returns bare JSON of this shape
+
+class Cat(BaseModel):
+    name: str = Field(..., description="The cat's name")
+    color: str = Field(..., description="The cat's fur color")
+    special_ability: str = Field(..., description="The cat's unique special ability")
+
+
+class BoundingBox(BaseModel):
+    box_2d: list[int] = Field(..., min_length=4, max_length=4,
+                              description="[y_min, x_min, y_max, x_max] normalized to the 0-1000 range")
+    label: str = Field(..., description="The object type")
+
+
+class SegmentMask(BaseModel):
+    box_2d: list[int] = Field(..., min_length=4, max_length=4,
+                              description="[y_min, x_min, y_max, x_max] normalized to the 0-1000 range")
+    mask: str = Field(..., description="Segmentation mask inside box_2d, as a base64 encoded PNG image")
+    label: str = Field(..., description="A descriptive name of the object")
+
+
+def json_config(item_model, **kwargs):
+    """Config asking the model for a JSON array of item_model objects and nothing else."""
+    return types.GenerateContentConfig(response_mime_type='application/json', response_schema=list[item_model],
+                                       **kwargs)
+
+
+@lru_cache(maxsize=None)
+def _list_adapter(item_model):
+    return TypeAdapter(list[item_model])
+
+
+@lru_cache(maxsize=None)
+def schema_key(item_model):
+    # Part of the response cache key, so answers to an older schema aren't reused
+    return json.dumps(item_model.model_json_schema(), sort_keys=True, separators=(',', ':'))
+
+
+def parse_items(text, item_model):
+    """Parse the model's JSON array straight into item_model objects.
+
+    The whole array is validated in one pass. If some elements don't match
+    the schema only those are dropped; text that isn't a JSON array raises
+    ValueError.
+    """
+    try:
+        return _list_adapter(item_model).validate_json(text)
+    except ValidationError:
+        # Not valid JSON at all raises here
+        data = json.loads(text)
+    if not isinstance(data, list):
+        raise ValueError("Response is not a JSON array")
+    items = [item for item in (validate_item(element, item_model) for element in data) if item is not None]
+    logger.debug("Dropped %d of %d %s elements that don't match the schema", len(data) - len(items), len(data),
+                 item_model.__name__)
+    return items
+
+
+def validate_item(element, item_model):
+    # One element of a streamed array, None if it doesn't match the schema
+    try:
+        return item_model.model_validate(element)
+    except ValidationError:
+        return None
@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import json
+import threading
+
+# Result handed to followers when the call they were waiting on failed
+_FAILED = object()
+
+
+def flight_key(*parts):
+    """Hash everything that makes two calls identical (model, prompt, image bytes, config) into a key."""
+    hasher = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            hasher.update(hashlib.sha256(part).digest())
+        else:
+            if hasattr(part, 'model_dump'):
+                part = part.model_dump(exclude_none=True)
+            hasher.update(json.dumps(part, sort_keys=True, default=str).encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = _FAILED
+
+
+class SingleFlight:
+    """Lets concurrent identical calls share one execution.
+
+    The first caller for a key runs the call and everyone who asks for the
+    same key while it is running gets its result. If that call fails the
+    waiters don't inherit the error (it may be specific to the first caller,
+    e.g. a bad API key): one of them runs the call again instead.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        # Flights of the async mode, all on the server's event loop
+        self._async_flights = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.calls = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def do(self, key, func):
+        """Return (result, shared), shared being True if another caller's call produced it."""
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                    self.calls += 1
+
+            if leader:
+                try:
+                    flight.result = func()
+                    return flight.result, False
+                except BaseException:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                finally:
+                    with self._lock:
+                        del self._flights[key]
+                    flight.done.set()
+
+            flight.done.wait()
+            if flight.result is not _FAILED:
+                with self._lock:
+                    self.coalesced += 1
+                return flight.result, True
+
+    async def do_async(self, key, func):
+        # Async version of do(), func is a coroutine function
+        while True:
+            future = self._async_flights.get(key)
+            if future is None:
+                future = self._async_flights[key] = asyncio.get_running_loop().create_future()
+                with self._lock:
+                    self.calls += 1
+                result = _FAILED
+                try:
+                    result = await func()
+                    return result, False
+                except BaseException:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                finally:
+                    del self._async_flights[key]
+                    future.set_result(result)
+
+            # Shielded so a follower going away doesn't cancel the shared call
+            result = await asyncio.shield(future)
+            if result is not _FAILED:
+                with self._lock:
+                    self.coalesced += 1
+                return result, True
+
+    def stats(self):
+        with self._lock:
+            requests = self.calls + self.coalesced
+            return {
+                'in_flight': len(self._flights) + len(self._async_flights),
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'failures': self.failures,
+                'coalesced_rate': round(self.coalesced / requests, 4) if requests else 0.0,
+            }
@@ -12,23 +12,16 @@ document.addEventListener('DOMContentLoaded', function() {
             document.getElementById('simpleTextLoading').classList.remove('d-none');
             document.getElementById('simpleTextResult').classList.add('d-none');
             
-            // Send request to server
-            fetch('/text_generation_process', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ prompt: prompt, demo_type: 'simple' }),
-            })
-            .then(response => response.json())
-            .then(data => {
-                // Hide loading indicator
+            // Stream the result as it is generated
+            const outputElement = document.getElementById('simpleTextOutput');
+            outputElement.innerHTML = '';
+            streamTextDemo({ prompt: prompt, demo_type: 'simple' }, data => {
+                // Hide loading indicator and show the result on the first chunk
                 document.getElementById('simpleTextLoading').classList.add('d-none');
-                
-                // Display result
-                const outputElement = document.getElementById('simpleTextOutput');
-                outputElement.innerHTML = data.text;
                 document.getElementById('simpleTextResult').classList.remove('d-none');
+                if (data.text) {
+                    outputElement.innerHTML += data.text;
+                }
             })
             .catch(error => {
                 console.error('Error:', error);
@@ -71,6 +64,11 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (data.done) {
                     // Stream complete, close connection
                     eventSource.close();
+                    if (data.error) {
+                        showToast(`Streaming error: ${data.error}`, 'danger');
+                    } else if (data.metrics) {
+                        console.log(`First token after ${data.metrics.ttft}s, ${data.metrics.tokens_per_second} tokens/s`);
+                    }
                 } else {
                     // Append new content
                     outputElement.innerHTML += data.text;
@@ -79,8 +77,11 @@ document.addEventListener('DOMContentLoaded', function() {
             
             // Handle errors
             eventSource.onerror = function(error) {
+                // The browser reconnects by itself and the server resumes from the last event received
+                if (eventSource.readyState !== EventSource.CLOSED) {
+                    return;
+                }
                 console.error('EventSource error:', error);
-                eventSource.close();
                 document.getElementById('streamingTextLoading').classList.add('d-none');
                 showToast('Error with streaming connection', 'danger');
             };
@@ -90,6 +91,8 @@ document.addEventListener('DOMContentLoaded', function() {
     // System Prompt
     const systemPromptForm = document.getElementById('systemPromptForm');
     if (systemPromptForm) {
+        // The conversation is kept on the server, a changed system instruction starts a new one
+        let chatSessionId = null;
         systemPromptForm.addEventListener('submit', function(e) {
             e.preventDefault();
             const systemInstruction = document.getElementById('systemInstruction').value;
@@ -99,27 +102,25 @@ document.addEventListener('DOMContentLoaded', function() {
             document.getElementById('systemPromptLoading').classList.remove('d-none');
             document.getElementById('systemPromptResult').classList.add('d-none');
             
-            // Send request to server
-            fetch('/text_generation_process', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ 
-                    prompt: userPrompt, 
-                    system_instruction: systemInstruction,
-                    demo_type: 'system'
-                }),
-            })
-            .then(response => response.json())
-            .then(data => {
-                // Hide loading indicator
+            // Stream the model's turn as it is generated
+            const outputElement = document.getElementById('systemPromptOutput');
+            outputElement.innerHTML = '';
+            streamTextDemo({ 
+                prompt: userPrompt, 
+                system_instruction: systemInstruction,
+                session_id: chatSessionId,
+                demo_type: 'system'
+            }, data => {
+                // Hide loading indicator and show the result on the first chunk
                 document.getElementById('systemPromptLoading').classList.add('d-none');
-                
-                // Display result
-                const outputElement = document.getElementById('systemPromptOutput');
-                outputElement.innerHTML = data.text;
                 document.getElementById('systemPromptResult').classList.remove('d-none');
+                if (data.role === 'model' && data.text) {
+                    outputElement.innerHTML += data.text;
+                }
+                if (data.session_id) {
+                    chatSessionId = data.session_id;
+                    console.log(`Chat turn ${data.chat.turns}, ${data.usage.cached_tokens} cached tokens`);
+                }
             })
             .catch(error => {
                 console.error('Error:', error);
@@ -140,23 +141,18 @@ document.addEventListener('DOMContentLoaded', function() {
             document.getElementById('reasoningLoading').classList.remove('d-none');
             document.getElementById('reasoningResult').classList.add('d-none');
             
-            // Send request to server
-            fetch('/text_generation_process', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ prompt: prompt, demo_type: 'reasoning' }),
-            })
-            .then(response => response.json())
-            .then(data => {
-                // Hide loading indicator
+            // Stream the reasoning and the answer into their own boxes
+            const traceElement = document.getElementById('reasoningTrace');
+            const outputElement = document.getElementById('reasoningOutput');
+            traceElement.innerHTML = '';
+            outputElement.innerHTML = '';
+            streamTextDemo({ prompt: prompt, demo_type: 'reasoning' }, data => {
+                // Hide loading indicator and show the result on the first chunk
                 document.getElementById('reasoningLoading').classList.add('d-none');
-                
-                // Display result
-                document.getElementById('reasoningTrace').innerHTML = data.reasoning;
-                document.getElementById('reasoningOutput').innerHTML = data.text;
                 document.getElementById('reasoningResult').classList.remove('d-none');
+                if (data.text) {
+                    (data.channel === 'answer' ? outputElement : traceElement).innerHTML += data.text;
+                }
             })
             .catch(error => {
                 console.error('Error:', error);
@@ -177,36 +173,18 @@ document.addEventListener('DOMContentLoaded', function() {
             document.getElementById('structuredLoading').classList.remove('d-none');
             document.getElementById('structuredResult').classList.add('d-none');
             
-            // Send request to server
-            fetch('/text_generation_process', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ prompt: prompt, demo_type: 'structured' }),
-            })
-            .then(response => response.json())
-            .then(data => {
-                // Hide loading indicator
+            // Show each cat as soon as it has been generated
+            const outputElement = document.getElementById('structuredOutput');
+            const cats = [];
+            outputElement.textContent = '';
+            streamTextDemo({ prompt: prompt, demo_type: 'structured' }, data => {
+                // Hide loading indicator and show the result on the first cat
                 document.getElementById('structuredLoading').classList.add('d-none');
-                
-                // Display result
-                const outputElement = document.getElementById('structuredOutput');
-                
-                // Format JSON if it's a string
-                if (typeof data.structured === 'string') {
-                    try {
-                        const jsonObj = JSON.parse(data.structured);
-                        outputElement.textContent = JSON.stringify(jsonObj, null, 2);
-                    } catch (e) {
-                        outputElement.textContent = data.structured;
-                    }
-                } else {
-                    // It's already an object
-                    outputElement.textContent = JSON.stringify(data.structured, null, 2);
-                }
-                
                 document.getElementById('structuredResult').classList.remove('d-none');
+                if (data.cat) {
+                    cats.push(data.cat);
+                    outputElement.textContent = JSON.stringify(cats, null, 2);
+                }
             })
             .catch(error => {
                 console.error('Error:', error);
@@ -217,6 +195,52 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 });
 
+// Helper function to send a text demo request with stream=true and handle each server-sent event as it arrives
+async function streamTextDemo(body, onEvent) {
+    const response = await fetch('/text_generation_process', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ ...body, stream: true }),
+    });
+    if (!response.ok) {
+        const data = await response.json();
+        throw new Error(data.error || response.statusText);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            return;
+        }
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            const dataLines = rawEvent.split('\n').filter(line => line.startsWith('data: '));
+            if (dataLines.length === 0) {
+                // Heartbeat or retry hint
+                continue;
+            }
+            const data = JSON.parse(dataLines.map(line => line.slice(6)).join('\n'));
+            if (data.done && data.error) {
+                throw new Error(data.error);
+            }
+            onEvent(data);
+            if (data.done) {
+                return data;
+            }
+        }
+    }
+}
+
 // Helper function to show toast notifications
 function showToast(message, type = 'info') {
     // Check if toast container exists, create if not
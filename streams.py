@@ -0,0 +1,207 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from hedging import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+
+class TextStream:
+    def __init__(self, buffer_size):
+        self.id = uuid.uuid4().hex
+        # (seq, data) of the most recent events, for clients resuming with Last-Event-ID
+        self.events = deque(maxlen=buffer_size)
+        self.next_seq = 0
+        self.finished = False
+        self.cancelled = False
+        self.consumers = 0
+        self.detached_at = None
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.finished_at = None
+        self.tokens = 0
+        self.chars = 0
+
+    def metrics(self):
+        ttft = self.first_token_at - self.started_at if self.first_token_at is not None else None
+        end = self.finished_at or time.monotonic()
+        generating = end - self.first_token_at if self.first_token_at is not None else 0.0
+        return {
+            'ttft': round(ttft, 4) if ttft is not None else None,
+            'seconds': round(end - self.started_at, 4),
+            'tokens': self.tokens,
+            'tokens_per_second': round(self.tokens / generating, 2) if generating > 0 else None,
+        }
+
+
+class StreamRegistry:
+    """Runs upstream text streams on worker threads and fans their events out to SSE clients.
+
+    Events are kept in a short per-stream buffer so a client that reconnects
+    with Last-Event-ID picks up where it left off. When no client has been
+    attached for resume_seconds the upstream call is cancelled, and finished
+    streams are dropped resume_seconds after they end.
+    """
+
+    def __init__(self, workers=16, buffer_size=512, resume_seconds=10):
+        self.buffer_size = buffer_size
+        self.resume_seconds = resume_seconds
+        self.metrics = LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='text-stream')
+        self._streams = {}
+        self._changed = threading.Condition()
+
+        # Counters
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.resumed = 0
+
+    def start(self, chunks):
+        """Start consuming chunks, an iterator of (data, tokens) pairs, and return the stream.
+
+        data is the next piece of text, or a dict to send as the event (e.g.
+        text labelled with a channel, or a parsed object). tokens is the
+        running output token count reported upstream, or None when it isn't
+        known (it is then estimated from the text length).
+        """
+        stream = TextStream(self.buffer_size)
+        with self._changed:
+            self._expire()
+            self._streams[stream.id] = stream
+            self.started += 1
+        # Model calls made while producing are labelled with the caller's route
+        self._executor.submit(contextvars.copy_context().run, self._produce, stream, chunks)
+        return stream
+
+    def get(self, stream_id):
+        with self._changed:
+            self._expire()
+            return self._streams.get(stream_id)
+
+    def _publish(self, stream, data):
+        with self._changed:
+            stream.events.append((stream.next_seq, data))
+            stream.next_seq += 1
+            self._changed.notify_all()
+
+    def _abandoned(self, stream):
+        with self._changed:
+            return (stream.consumers == 0 and stream.detached_at is not None
+                    and time.monotonic() - stream.detached_at > self.resume_seconds)
+
+    def _produce(self, stream, chunks):
+        error = None
+        try:
+            for data, tokens in chunks:
+                if self._abandoned(stream):
+                    # Nobody is listening any more, stop paying for the generation
+                    stream.cancelled = True
+                    break
+                if isinstance(data, str):
+                    data = {'text': data}
+                if not data or data.get('text') == '':
+                    continue
+                if stream.first_token_at is None:
+                    stream.first_token_at = time.monotonic()
+                stream.chars += len(data.get('text') or '')
+                stream.tokens = tokens if tokens else max(stream.tokens, round(stream.chars / 4))
+                data['done'] = False
+                self._publish(stream, data)
+        except Exception as e:
+            logger.warning("Streaming error: %s", e)
+            error = str(e)
+        finally:
+            # Closing the generator closes the upstream HTTP response
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+
+        stream.finished_at = time.monotonic()
+        metrics = stream.metrics()
+        if metrics['ttft'] is not None:
+            self.metrics.record('ttft', metrics['ttft'])
+        if metrics['tokens_per_second'] is not None:
+            self.metrics.record('tokens_per_second', metrics['tokens_per_second'])
+
+        final = {'done': True, 'metrics': metrics}
+        if error:
+            final['error'] = error
+        self._publish(stream, final)
+        with self._changed:
+            stream.finished = True
+            if stream.cancelled:
+                self.cancelled += 1
+                logger.info("Cancelled stream %s, the client went away", stream.id)
+            elif error:
+                self.failed += 1
+            else:
+                self.completed += 1
+            self._changed.notify_all()
+
+    def events(self, stream, after_seq=-1, heartbeat=15):
+        """Yield (event_id, data) for each event after after_seq, and None when idle for heartbeat seconds.
+
+        Ends after the final event. Closing the generator detaches the client.
+        """
+        with self._changed:
+            stream.consumers += 1
+            stream.detached_at = None
+            if after_seq >= 0:
+                self.resumed += 1
+        seq = after_seq
+        try:
+            while True:
+                with self._changed:
+                    self._changed.wait_for(lambda: stream.next_seq > seq + 1 or stream.finished, timeout=heartbeat)
+                    # Events we haven't sent may have already left the buffer
+                    missed = bool(stream.events) and stream.events[0][0] > seq + 1
+                    pending = [event for event in stream.events if event[0] > seq]
+                    finished = stream.finished
+
+                if missed:
+                    yield f'{stream.id}:{stream.next_seq}', {'error': 'Stream can no longer be resumed', 'done': True}
+                    return
+                if not pending:
+                    if finished:
+                        return
+                    yield None
+                    continue
+
+                for event_seq, data in pending:
+                    seq = event_seq
+                    yield f'{stream.id}:{event_seq}', data
+                    if data.get('done'):
+                        return
+        finally:
+            with self._changed:
+                stream.consumers -= 1
+                if stream.consumers == 0:
+                    stream.detached_at = time.monotonic()
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [stream_id for stream_id, stream in self._streams.items()
+                   if stream.finished and stream.consumers == 0 and now - stream.finished_at > self.resume_seconds]
+        for stream_id in expired:
+            del self._streams[stream_id]
+
+    def stats(self):
+        with self._changed:
+            active = sum(1 for stream in self._streams.values() if not stream.finished)
+            result = {
+                'active': active,
+                'started': self.started,
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'failed': self.failed,
+                'resumed': self.resumed,
+            }
+        result.update(self.metrics.stats())
+        return result
@@ -0,0 +1,243 @@
+import struct
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+
+def open_large_image(fp, max_pixels):
+    """Open an image stream of up to max_pixels, past Pillow's process-wide decompression bomb limit.
+
+    Image.open() refuses anything over twice Image.MAX_IMAGE_PIXELS, which
+    stays at its default for every other route; this tries the format
+    plugins the same way, then checks the size against max_pixels instead.
+    Raises Image.DecompressionBombError over that, UnidentifiedImageError
+    for anything that isn't an image.
+    """
+    Image.init()
+    prefix = fp.read(16)
+    for format_id in Image.ID:
+        factory, accept = Image.OPEN[format_id]
+        # accept() returns a string when the prefix matches but the variant is unsupported
+        accepted = not accept or accept(prefix)
+        if not accepted or isinstance(accepted, str):
+            continue
+        fp.seek(0)
+        try:
+            image = factory(fp, None)
+        except (SyntaxError, IndexError, TypeError, struct.error):
+            continue
+        width, height = image.size
+        if width * height > max_pixels:
+            raise Image.DecompressionBombError(f"Image size ({width * height} pixels) exceeds limit of "
+                                               f"{max_pixels} pixels")
+        return image
+    raise UnidentifiedImageError("cannot identify image file")
+
+
+def plan_tiles(width, height, tile_size=1024, overlap=128):
+    """(left, top, right, bottom) of overlapping tiles covering the image, row by row.
+
+    Tiles step by tile_size - overlap and the last row and column are aligned
+    to the image's edge, so every tile is full size unless the image is
+    smaller than one tile.
+    """
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        stride = max(1, tile_size - overlap)
+        positions = list(range(0, length - tile_size, stride))
+        positions.append(length - tile_size)
+        return positions
+
+    return [(left, top, min(left + tile_size, width), min(top + tile_size, height))
+            for top in starts(height) for left in starts(width)]
+
+
+def encode_tile(image, tile, quality=85):
+    # The image must already be loaded, crops of it are then safe from several threads
+    crop = image.crop(tile)
+    if crop.mode != 'RGB':
+        crop = crop.convert('RGB')
+    buffer = BytesIO()
+    crop.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def seam_edges(boxes, tiles, width, height, margin=2):
+    """Which of its tile's left, top, right and bottom edges each box was cut off at.
+
+    Only tile edges inside the image count, a box reaching the image's own
+    border is whole on that side.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    tiles = np.asarray(tiles, dtype=np.float64).reshape(-1, 4)
+    return np.stack([
+        (boxes[:, 0] <= tiles[:, 0] + margin) & (tiles[:, 0] > 0),
+        (boxes[:, 1] <= tiles[:, 1] + margin) & (tiles[:, 1] > 0),
+        (boxes[:, 2] >= tiles[:, 2] - margin) & (tiles[:, 2] < width),
+        (boxes[:, 3] >= tiles[:, 3] - margin) & (tiles[:, 3] < height),
+    ], axis=1)
+
+
+def seam_scores(boxes, cut, penalty=0.5):
+    """Score each box by its area, lowered if it was cut off at a seam.
+
+    A cut box is usually the partial copy of an object that another tile saw
+    whole, so it should lose against that one in nms().
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    areas = np.maximum(boxes[:, 2] - boxes[:, 0], 0) * np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+    return areas * np.where(cut, penalty, 1.0)
+
+
+def join_seam_pieces(boxes, labels, tiles, edges, threshold=0.5):
+    """Groups of indices of boxes that are pieces of one object cut apart at a seam.
+
+    Two boxes are pieces of the same object when their tiles are side by
+    side neighbours, the first is cut at the edge facing the second and the
+    second at the edge facing the first (so both reach into the strip the
+    tiles share), they have the same label, and they line up across the
+    seam: their extents along it overlap by more than threshold of the
+    shorter one. Pieces of an object spanning several tiles are chained.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    labels = np.asarray(labels, dtype=object)
+    # Boxes cut at each of their tile's edges, by tile
+    by_tile = {}
+    for i in np.flatnonzero(edges.any(axis=1)).tolist():
+        by_tile.setdefault(tuple(tiles[i]), []).append(i)
+
+    def lined_up(first, second, low, high):
+        # Overlap of the [low, high] extents of every pair, as a share of the shorter one
+        a, b = boxes[first], boxes[second]
+        overlap = np.minimum(a[:, None, high], b[None, :, high]) - np.maximum(a[:, None, low], b[None, :, low])
+        shorter = np.minimum((a[:, high] - a[:, low])[:, None], (b[:, high] - b[:, low])[None, :])
+        return overlap > threshold * shorter
+
+    parents = {}
+
+    def root(i):
+        parents.setdefault(i, i)
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    # The next tile to the right in the same row, and the next one down in the same column
+    rows, columns = {}, {}
+    for tile in sorted(by_tile):
+        rows.setdefault(tile[1], []).append(tile)
+        columns.setdefault(tile[0], []).append(tile)
+    right_of = {a: b for row in rows.values() for a, b in zip(row, row[1:]) if b[0] < a[2]}
+    below = {a: b for column in columns.values() for a, b in zip(column, column[1:]) if b[1] < a[3]}
+
+    for tile, pieces in by_tile.items():
+        for neighbour, facing, opposite, low, high in ((right_of.get(tile), 2, 0, 1, 3), (below.get(tile), 3, 1, 0, 2)):
+            if neighbour is None:
+                continue
+            first = np.array([i for i in pieces if edges[i, facing]], dtype=np.intp)
+            second = np.array([j for j in by_tile[neighbour] if edges[j, opposite]], dtype=np.intp)
+            if not len(first) or not len(second):
+                continue
+            joined = lined_up(first, second, low, high) & (labels[first][:, None] == labels[second][None, :])
+            for a, b in np.argwhere(joined).tolist():
+                parents[root(int(first[a]))] = root(int(second[b]))
+
+    groups = {}
+    for i in list(parents):
+        groups.setdefault(root(i), []).append(i)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+def nms(boxes, scores, labels, sources=None, threshold=0.5):
+    """Indices of the boxes left after non-maximum suppression, best first.
+
+    Overlap is measured as intersection over the smaller box's area, so a
+    partial box from a tile seam is suppressed by the whole one even though
+    their IoU is low. Boxes with different labels never suppress each other,
+    and with sources (a set of tiles per box) neither do boxes found in the
+    same tile, which are separate detections.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if not len(boxes):
+        return []
+    scores = np.asarray(scores, dtype=np.float64)
+
+    # Move each label's boxes to their own region so they can't overlap another label's
+    label_ids = np.unique(np.asarray(labels, dtype=object), return_inverse=True)[1]
+    shifted = boxes + ((boxes.max() + 1) * label_ids)[:, None]
+    x1, y1, x2, y2 = shifted.T
+    areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(int(best))
+        # The best remaining box against all the others at once
+        inter = (np.maximum(0, np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]))
+                 * np.maximum(0, np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest])))
+        smaller = np.minimum(areas[best], areas[rest])
+        overlap = np.divide(inter, smaller, out=np.zeros_like(inter), where=smaller > 0)
+        suppressed = overlap > threshold
+        if sources is not None:
+            # Only the few overlapping boxes need their tiles compared
+            for position in np.flatnonzero(suppressed):
+                if not sources[best].isdisjoint(sources[rest[position]]):
+                    suppressed[position] = False
+        order = rest[~suppressed]
+    return keep
+
+
+def merge_detections(boxes, labels, tiles, width, height, threshold=0.5, margin=2):
+    """Merge the boxes every tile found (in image coordinates) into one (box, label) per object.
+
+    Pieces of an object larger than the overlap are joined across the seams
+    first, then copies of an object seen by several tiles are reduced to the
+    best one, preferring a copy that wasn't cut off. Boxes from the same
+    tile are always kept apart.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    labels = list(labels)
+    tiles = [tuple(tile) for tile in tiles]
+    if not len(boxes):
+        return []
+    edges = seam_edges(boxes, tiles, width, height, margin)
+    cut = edges.any(axis=1)
+
+    # Each joined object replaces its pieces, and counts as seen by all their tiles
+    merged_boxes, merged_labels, sources, merged_cut = [], [], [], []
+    joined = set()
+    for group in join_seam_pieces(boxes, labels, tiles, edges, threshold):
+        joined.update(group)
+        pieces = boxes[group]
+        merged_boxes.append(np.concatenate([pieces[:, :2].min(axis=0), pieces[:, 2:].max(axis=0)]))
+        merged_labels.append(labels[group[0]])
+        sources.append(frozenset(tiles[i] for i in group))
+        merged_cut.append(False)
+    for i in range(len(boxes)):
+        if i not in joined:
+            merged_boxes.append(boxes[i])
+            merged_labels.append(labels[i])
+            sources.append(frozenset([tiles[i]]))
+            merged_cut.append(bool(cut[i]))
+
+    keep = nms(merged_boxes, seam_scores(merged_boxes, merged_cut), merged_labels, sources, threshold)
+    return [([int(coord) for coord in merged_boxes[i]], merged_labels[i]) for i in sorted(keep)]
+
+
+def preview_image(image, max_edge=4096):
+    """A copy of the image no larger than max_edge, and the factor its coordinates are scaled by."""
+    width, height = image.size
+    factor = min(1.0, max_edge / max(width, height))
+    if factor == 1.0:
+        return image.copy(), factor
+    preview = image
+    # Shrink by whole factors first, it's much cheaper than resampling a huge image in one go
+    reduce_by = int(1 / factor) // 2
+    if reduce_by > 1:
+        preview = preview.reduce(reduce_by)
+    size = (max(1, round(width * factor)), max(1, round(height * factor)))
+    preview = preview.resize(size, Image.Resampling.LANCZOS)
+    return preview, factor